@@ -1,8 +1,11 @@
 import numpy as np
 import pandas as pd
 from pandas.tseries.offsets import *
-from scipy.stats.mstats import gmean
 import datetime
+import os
+
+from modeling.estimator import EwmEstimator, ewm_batch
+from modeling.recorder import HistRecorder
 
 
 class Exc(Exception):
@@ -36,6 +39,19 @@ class Agent:
         horizon_days:     Горизонт прогнозирования рабочих дней
         min_hist_days:    Минимальное количество рабочих дней, для которых возможно посчитать доходность за минимальный период
         min_rent_days:    Минимальный период расчёта рентабельности для последующего перевода в годовую рентабельность
+        calc_mode:        Способ расчёта показателей: 'full' - gather/preprocess/fit/predict, 'increm' - инкрементально,
+                          'batch' - одним проходом по всем инструментам
+        estim:            Инкрементальная оценка доходности и волатильности инструментов
+        param_hist, part_req_hist, port_hist, price_hist, port_data_hist:
+                          Накопители историй (*_hist_df формируются из них при обращении)
+        hist_cap:         Максимальное количество строк истории в памяти, остальное сбрасывается на диск (None - без ограничения)
+        hist_dir:         Папка для сброса истории на диск (None - временная папка)
+        param_cache:      Кэш статистик инструментов по датам для режима 'batch', общий для нескольких прогонов (None - без кэша)
+        alloc:            Распределение долей отобранных инструментов (например, markowitz.AllocMarkowitz),
+                          None - доли пропорциональны total_2
+        select:           Отбор инструментов (например, selection.SelectDecorr), None - топ top_thres по total_2
+        profit_cache:     Кэш доходностей на горизонт вперёд (profit_cache.ProfitCache), общий для нескольких прогонов
+                          (None - доходности считаются каждый период)
 
     """
 
@@ -54,6 +70,13 @@ class Agent:
         horizon_days=248,
         min_hist_days=248,
         min_rent_days=248,
+        calc_mode="batch",
+        hist_cap=None,
+        hist_dir=None,
+        param_cache=None,
+        alloc=None,
+        select=None,
+        profit_cache=None,
     ):
         """
             Установка всех переменных (которые меняются при активности) в начальное состояние
@@ -61,26 +84,58 @@ class Agent:
         Args:
 
         """
-        self.param_hist_df = pd.DataFrame(
-            columns=["date", "instr_id", "profit_mean", "total_1", "profit_std", "total_2"]
+        self.hist_cap = hist_cap
+        self.hist_dir = hist_dir
+
+        for name in ["param_hist", "part_req_hist", "port_hist", "price_hist", "port_data_hist"]:
+            if hasattr(self, name):
+                getattr(self, name).clear()
+
+        instr_cat = {"instr_id": self.envir._instr_ids}
+        self.param_hist = self.new_hist(
+            "param_hist",
+            {
+                "date": "datetime64[ns]",
+                "instr_id": np.int32,
+                "profit_mean": float,
+                "total_1": float,
+                "profit_std": float,
+                "total_2": float,
+            },
+            instr_cat,
         )
-        self.part_req_hist_df = pd.DataFrame(columns=["date", "instr_id", "part"])
-        self.port_hist_df = pd.DataFrame(columns=["date", "instr_id", "quantity"])
-        self.price_hist_df = pd.DataFrame(columns=["date", "instr_id", "price"])
-        self.port_data_hist_df = pd.DataFrame(
-            columns=[
-                "date",
-                "instr_id",
-                "quantity",
-                "manager",
-                "instr",
-                "min_sum",
-                "surcharge",
-                "discount",
-                "price",
-                "value",
-                "part",
-            ]
+        self.part_req_hist = self.new_hist(
+            "part_req_hist",
+            {"date": "datetime64[ns]", "instr_id": np.int32, "bet_thres^pow": float, "part": float, "total_2": float},
+            instr_cat,
+        )
+        self.port_hist = self.new_hist(
+            "port_hist", {"date": "datetime64[ns]", "instr_id": np.int32, "quantity": float}, instr_cat
+        )
+        self.price_hist = self.new_hist(
+            "price_hist", {"date": "datetime64[ns]", "instr_id": np.int32, "price": float}, instr_cat
+        )
+        self.port_data_hist = self.new_hist(
+            "port_data_hist",
+            {
+                "date": "datetime64[ns]",
+                "instr_id": np.int32,
+                "quantity": float,
+                "manager": np.int32,
+                "instr": np.int32,
+                "min_sum": float,
+                "surcharge": float,
+                "discount": float,
+                "price": float,
+                "value": float,
+                "part": float,
+                "fee": float,
+            },
+            {
+                "instr_id": self.envir._instr_ids,
+                "manager": self.envir._spr_df["manager"].values,
+                "instr": self.envir._spr_df["instr"].values,
+            },
         )
 
         self.min_thres = min_thres
@@ -91,10 +146,49 @@ class Agent:
         self.horizon_days = horizon_days
         self.min_hist_days = min_hist_days
         self.min_rent_days = min_rent_days
+        self.calc_mode = calc_mode
+        self.param_cache = param_cache
+        self.alloc = alloc
+        self.select = select
+        self.profit_cache = profit_cache
+        self.estim = EwmEstimator(
+            horizon_days=self.horizon_days, hist_days=2 * (self.min_hist_days + self.min_rent_days)
+        )
+
+    def new_hist(self, name, columns, categories):
+        return HistRecorder(
+            columns,
+            categories=categories,
+            cap=self.hist_cap,
+            spill_dir=None if self.hist_dir is None else os.path.join(self.hist_dir, name),
+        )
 
-    def action(self):
+    @property
+    def param_hist_df(self):
+        return self.param_hist.to_df()
+
+    @property
+    def part_req_hist_df(self):
+        return self.part_req_hist.to_df()
+
+    @property
+    def port_hist_df(self):
+        return self.port_hist.to_df()
+
+    @property
+    def price_hist_df(self):
+        return self.price_hist.to_df()
+
+    @property
+    def port_data_hist_df(self):
+        return self.port_data_hist.to_df()
+
+    def action(self, finish=True):
         """
         Запуск функционирования агента циклом смены периодов
+
+        Args:
+            finish: Передать управление superviser для сохранения истории по окончании
         """
 
         # Цикл функционирования агента и смены периодов
@@ -104,7 +198,8 @@ class Agent:
             self.new_period()
 
         # Передача управления superviser для сохранения в историю
-        self.suvis.action_finish()
+        if finish:
+            self.suvis.action_finish()
 
     def new_period(self):
         """
@@ -114,37 +209,123 @@ class Agent:
         # print('#=====================================================================================================')
         # print(self.envir.date, end = ' ')
 
+        probe = self.envir.probe
+        probe.period_start(self.envir.date)
+
         self.calc_param()  # Запускать только 1 раз за 1 дату - иначе данные дублируются
 
-        self.chang_port()
+        with probe.phase("chang_port"):
+            self.chang_port()
+
+        probe.period_end(self.envir.date)
+
+        # Передача управления superviser для сохранения истории периода
+        if hasattr(self, "suvis"):
+            self.suvis.action_period()
 
     def calc_param(self):
         """
         Расчёт показателей инструментов: средняя доходность, волатильность и т.д.
         """
 
-        # Цикл обхода инструментов по справочнику
-        for index, spr_se in self.envir.spr_df.iterrows():
+        with self.envir.probe.phase("calc_param") as phase:
+            if self.calc_mode == "batch":
+                self.calc_param_batch()
+            else:
+                self.calc_param_loop()
+            phase.rows = len(self.param_df)
 
-            # gather
-            price_hist_temp_df = self.gather(instr_id=spr_se["instr_id"])
+        with self.envir.probe.phase("hist_append") as phase:
+            self.append_hist()
+            phase.rows = len(self.param_df) + len(self.port_data_df)
 
-            # Если история собрана менее чем за 2 года, то не рассматривать инвестицию
-            if len(price_hist_temp_df) < (self.min_hist_days + self.min_rent_days):
-                continue
+        return True
 
-            # preprocess
-            price_hist_temp_df = self.preprocess(price_hist_temp_df)
-            # print('price_hist_temp_df')
-            # print(price_hist_temp_df)
+    def append_hist(self):
+        """
+        Сохранение в историю параметров, портфеля, цен и полных данных портфеля, расчёт стоимости портфеля
+        """
+        # Сохранение в историю текущих параметров
+        self.param_hist.append(
+            date=self.envir.date,
+            instr_id=self.envir.registry.codes(self.param_df["instr_id"]),
+            profit_mean=self.param_df["profit_mean"].values,
+            total_1=self.param_df["total_1"].values,
+            profit_std=self.param_df["profit_std"].values,
+            total_2=self.param_df["total_2"].values,
+        )
 
-            # fit
-            price_hist_temp_df = self.fit(price_hist_temp_df)
+        # Сохранение в историю текущего портфеля
+        port_code_arr = np.array(self.envir._port_codes, dtype=int)
+        self.port_hist.append(
+            date=self.envir.date, instr_id=port_code_arr, quantity=self.envir._quantity[port_code_arr]
+        )
 
+        # Сохранение в историю текущих цен
+        price_code_arr = np.flatnonzero(self.envir.instr_mask)
+        self.price_hist.append(
+            date=self.envir.date, instr_id=price_code_arr, price=self.envir.price_arr[price_code_arr]
+        )
 
+        # Сохранение в историю полных данных портфеля с долями
+        data_code_arr = port_code_arr[self.envir.instr_mask[port_code_arr]]
+        port_data_df = self.envir._spr_df.iloc[data_code_arr].reset_index(drop=True)
+        port_data_df.insert(1, "quantity", self.envir._quantity[data_code_arr])
+        port_data_df["price"] = self.envir.price_arr[data_code_arr]
+        port_data_df["value"] = port_data_df["quantity"] * port_data_df["price"] * (1 - port_data_df["discount"])
+        port_data_df["part"] = (
+            0 if port_data_df["value"].sum() == 0 else port_data_df["value"] / port_data_df["value"].sum()
+        )
+        # port_data_df['date'] = self.envir.date
+        self.port_data_df = port_data_df
+
+        self.port_data_hist.append(
+            date=self.envir.date,
+            instr_id=data_code_arr,
+            quantity=port_data_df["quantity"].values,
+            manager=data_code_arr,
+            instr=data_code_arr,
+            min_sum=port_data_df["min_sum"].values,
+            surcharge=port_data_df["surcharge"].values,
+            discount=port_data_df["discount"].values,
+            price=port_data_df["price"].values,
+            value=port_data_df["value"].values,
+            part=port_data_df["part"].values,
+            fee=port_data_df["fee"].values,
+        )
+
+        # Подсчёт текущей суммарной стоимости портфеля в приведённых ценах
+        self.port_summ_value = port_data_df["value"].sum()
+
+    def calc_param_loop(self):
+        """
+        Расчёт показателей инструментов поштучно циклом по справочнику
+        """
 
-            # predict
-            profit_mean, profit_std = self.predict(price_hist_temp_df)
+        param_list = []
+
+        # Цикл обхода инструментов по справочнику
+        for index, spr_se in self.envir.spr_df.iterrows():
+
+            if self.calc_mode == "increm":
+                code = self.envir._instr_code[spr_se["instr_id"]]
+                hist_cnt = self.envir.hist_cnt[code]
+
+                # Если история собрана менее чем за 2 года, то не рассматривать инвестицию
+                if hist_cnt < (self.min_hist_days + self.min_rent_days):
+                    continue
+
+                with self.envir.probe.phase("estim_update"):
+                    profit_mean, profit_std = self.estim.update(
+                        spr_se["instr_id"],
+                        hist_cnt,
+                        self.envir._pack_price[:, code],
+                        self.envir._pack_day[:, code],
+                    )
+            else:
+                profit_mean, profit_std = self.calc_param_instr(spr_se["instr_id"])
+                if profit_mean is None:
+                    continue
 
             # Поправка на вознаграждения управляющих
             profit_mean = profit_mean * (1 - spr_se["fee"])
@@ -153,56 +334,119 @@ class Agent:
             # соотношение прибыли к риску
             total_2 = total_1 / (profit_std ** self.pow_st_dev)
 
-            # Сохранение в историю текущих параметров
-            self.param_hist_df = pd.concat(
-                [
-                    self.param_hist_df,
-                    pd.DataFrame.from_dict(
-                        [
-                            {
-                                "date": self.envir.date,
-                                "instr_id": spr_se["instr_id"],
-                                "profit_mean": profit_mean,
-                                "total_1": total_1,
-                                "profit_std": profit_std,
-                                "total_2": total_2,
-                            }
-                        ]
-                    ),
-                ]
+            param_list.append(
+                {
+                    "date": self.envir.date,
+                    "instr_id": spr_se["instr_id"],
+                    "profit_mean": profit_mean,
+                    "total_1": total_1,
+                    "profit_std": profit_std,
+                    "total_2": total_2,
+                }
             )
 
-        # Получение текущих параметров обратно из истории
-        self.param_df = self.param_hist_df[self.param_hist_df["date"] == self.envir.date]
+        # Текущие параметры инструментов
+        self.param_df = pd.DataFrame(
+            param_list, columns=["date", "instr_id", "profit_mean", "total_1", "profit_std", "total_2"]
+        )
 
-        # Сохранение в историю текущего портфеля
-        port_temp_df = self.envir.port_df.copy()
-        port_temp_df["date"] = self.envir.date
-        self.port_hist_df = pd.concat([self.port_hist_df, port_temp_df])
+        return True
 
-        # Сохранение в историю текущих цен
-        price_temp_df = self.envir.price_df.copy()
-        price_temp_df["date"] = self.envir.date
-        self.price_hist_df = pd.concat([self.price_hist_df, price_temp_df])
+    def calc_param_batch(self):
+        """
+        Расчёт показателей сразу всех инструментов одним 2-D проходом по матрице цен
+        """
+        code_arr, profit_mean_arr, profit_std_arr = self.calc_stat()
+
+        registry = self.envir.registry
+        # Поправка на вознаграждения управляющих
+        profit_mean_arr = profit_mean_arr * (1 - registry.fee[code_arr])
+
+        total_1_arr = profit_mean_arr / (1 + registry.surcharge[code_arr]) * (1 - registry.discount[code_arr])
+        # соотношение прибыли к риску
+        total_2_arr = total_1_arr / (profit_std_arr ** self.pow_st_dev)
+
+        # Текущие параметры инструментов
+        self.param_df = pd.DataFrame(
+            {
+                "date": self.envir.date,
+                "instr_id": self.envir._instr_ids[code_arr],
+                "profit_mean": profit_mean_arr,
+                "total_1": total_1_arr,
+                "profit_std": profit_std_arr,
+                "total_2": total_2_arr,
+            }
+        )
 
-        # Сохранение в историю полных данных портфеля с долями
-        port_data_df = pd.merge(self.envir.port_df, self.envir.spr_df, on=["instr_id"])
-        port_data_df = pd.merge(port_data_df, self.envir.price_df, on=["instr_id"])
-        port_data_df["value"] = port_data_df["quantity"] * port_data_df["price"] * (1 - port_data_df["discount"])
-        port_data_df["part"] = (
-            0 if port_data_df["value"].sum() == 0 else port_data_df["value"] / port_data_df["value"].sum()
+        return True
+
+    def calc_stat(self):
+        """
+        Средняя доходность и волатильность всех инструментов с достаточной историей на дату среды.
+        Не зависят от порогов и pow_st_dev, поэтому при заданном param_cache считаются 1 раз на дату
+        и переиспользуются другими прогонами (окнами, комбинациями параметров).
+
+        Returns:
+            code_arr, profit_mean_arr, profit_std_arr
+        """
+        key = (np.datetime64(self.envir.date, "ns"), self.horizon_days, self.min_hist_days, self.min_rent_days)
+        if (self.param_cache is not None) and (key in self.param_cache):
+            self.envir.probe.count("calc_stat_cached")
+            return self.param_cache[key]
+
+        hist_cnt_arr = self.envir.hist_cnt
+
+        # Если история собрана менее чем за 2 года, то не рассматривать инвестицию
+        code_arr = np.flatnonzero(
+            self.envir.instr_mask & (hist_cnt_arr >= (self.min_hist_days + self.min_rent_days))
         )
-        # port_data_df['date'] = self.envir.date
-        self.port_data_df = port_data_df
 
-        port_data_temp_df = self.port_data_df.copy()
-        port_data_temp_df["date"] = self.envir.date
-        self.port_data_hist_df = pd.concat([self.port_data_hist_df, port_data_temp_df])
+        with self.envir.probe.phase("calc_stat") as phase:
+            profit_mean_arr, profit_std_arr = ewm_batch(
+                hist_cnt_arr[code_arr],
+                self.envir._pack_price,
+                self.envir._pack_day,
+                code_arr,
+                horizon_days=self.horizon_days,
+                hist_days=2 * (self.min_hist_days + self.min_rent_days),
+                profit_pack=self.profit_table(),
+            )
+            phase.rows = len(code_arr)
 
-        # Подсчёт текущей суммарной стоимости портфеля в приведённых ценах
-        self.port_summ_value = port_data_df["value"].sum()
+        if self.param_cache is not None:
+            self.param_cache[key] = (code_arr, profit_mean_arr, profit_std_arr)
+        return code_arr, profit_mean_arr, profit_std_arr
 
-        return True
+    def calc_param_instr(self, instr_id):
+        """
+        Полный расчёт средней доходности и волатильности инструмента: gather/preprocess/fit/predict
+
+        Returns:
+            profit_mean, profit_std: (None, None) если истории недостаточно
+        """
+        probe = self.envir.probe
+
+        # gather
+        with probe.phase("gather") as phase:
+            price_hist_temp_df = self.gather(instr_id=instr_id)
+            phase.rows = len(price_hist_temp_df)
+
+        # Если история собрана менее чем за 2 года, то не рассматривать инвестицию
+        if len(price_hist_temp_df) < (self.min_hist_days + self.min_rent_days):
+            return None, None
+
+        # preprocess
+        with probe.phase("preprocess") as phase:
+            price_hist_temp_df = self.preprocess(price_hist_temp_df)
+            phase.rows = len(price_hist_temp_df)
+
+        # fit
+        with probe.phase("fit"):
+            price_hist_temp_df = self.fit(price_hist_temp_df)
+
+        # predict
+        with probe.phase("predict"):
+            return self.predict(price_hist_temp_df)
 
     def chang_port(
         self, cash=1000000
@@ -211,18 +455,22 @@ class Agent:
         Расчёт и при необходимости изменение долей в инвестиционном портфеле
         """
 
-        # Вычислить текущие доли паёв В ЦЕНАХ инструмент
-        part_curr_df = pd.merge(self.envir.port_df, self.envir.spr_df, on=["instr_id"])
-        part_curr_df = pd.merge(part_curr_df, self.envir.price_df, on=["instr_id"])
-        part_curr_df["value"] = part_curr_df["quantity"] * part_curr_df["price"] * (1 - part_curr_df["discount"])
-        part_curr_df["part"] = (
-            0 if part_curr_df["value"].sum() == 0 else part_curr_df["value"] / part_curr_df["value"].sum()
+        registry = self.envir.registry
+
+        # Вычислить текущие доли паёв В ЦЕНАХ инструмент (инструменты портфеля, по которым есть цена)
+        curr_code_arr = np.array(self.envir._port_codes, dtype=int)
+        curr_code_arr = curr_code_arr[self.envir.instr_mask[curr_code_arr]]
+        value_arr = (
+            self.envir._quantity[curr_code_arr]
+            * self.envir.price_arr[curr_code_arr]
+            * (1 - registry.discount[curr_code_arr])
         )
+        part_curr_arr = np.zeros(len(value_arr)) if value_arr.sum() == 0 else value_arr / value_arr.sum()
 
         # print()
         # print('портфель текущий  \n', part_curr_df)
 
-        part_curr_df = part_curr_df[["instr_id", "part"]]
+        part_curr_df = pd.DataFrame({"instr_id": registry.instr_ids[curr_code_arr], "part": part_curr_arr})
         # Текущие доли паёв В ЦЕНАХ инструмент
         # Поля: instr_id, part
         self.part_curr_df = part_curr_df
@@ -232,16 +480,16 @@ class Agent:
 
         # Оставить инструменты выше порога прибыльности
         part_req_df = self.param_df[self.param_df["total_2"] > self.min_thres]
-        part_req_df = (
-            part_req_df.sort_values(by=["total_2"], ascending=False).reset_index(drop=True).loc[0 : self.top_thres - 1]
-        )
+        if self.select is not None:
+            part_req_df = self.select.apply(self, part_req_df)
+        else:
+            part_req_df = part_req_df.sort_values(by=["total_2"], ascending=False)
+        part_req_df = part_req_df.reset_index(drop=True).loc[0 : self.top_thres - 1]
 
         # Вычислить требуемые доли инструментов
         part_req_df.loc[:, "bet_thres"] = part_req_df["total_2"] - self.min_thres
         part_req_df["bet_thres^pow"] = part_req_df["bet_thres"] ** 1
-        part_req_df["part"] = (
-            0 if part_req_df["total_2"].sum() == 0 else part_req_df["total_2"] / part_req_df["total_2"].sum()
-        )
+        part_req_df["part"] = self.calc_part(part_req_df)
         # part_req_df['part'] = (0 if part_req_df['bet_thres^pow'].sum() == 0 else part_req_df['bet_thres^pow'] / part_req_df['bet_thres^pow'].sum()) #part_req_df['bet_thres'] / part_req_df['bet_thres'].sum()
 
         # print()
@@ -253,31 +501,37 @@ class Agent:
         self.part_req_df = part_req_df
 
         # Сохранить в историю требуемые доли паёв В ЦЕНАХ инструмент
-        part_req_temp_df = part_req_df
-        part_req_temp_df["date"] = self.envir.date
         # История требуемых долей паёв В ЦЕНАХ инструмент
         # Поля: date, instr_id, part
-        # self.part_req_hist_df = self.part_req_hist_df.append(part_req_temp_df, ignore_index = True)
-        self.part_req_hist_df = pd.concat([self.part_req_hist_df, part_req_temp_df])
+        req_code_arr = registry.codes(part_req_df["instr_id"])
+        self.part_req_hist.append(
+            **{
+                "date": self.envir.date,
+                "instr_id": req_code_arr,
+                "bet_thres^pow": part_req_df["bet_thres^pow"].values,
+                "part": part_req_df["part"].values,
+                "total_2": part_req_df["total_2"].values,
+            }
+        )
 
         # Вычислить доли паёв, которые необходимо купить/продать
-        port_chang_df = pd.merge(
-            pd.DataFrame(part_curr_df[["instr_id", "part"]].values, columns=["instr_id", "part_curr"]),
-            pd.DataFrame(part_req_df[["instr_id", "part"]].values, columns=["instr_id", "part_req"]),
-            how="outer",
-            on="instr_id",
-        ).fillna(value=0)
-
-        if port_chang_df.shape[0] == 0:
-            port_chang_df["part_sell"] = None
-            port_chang_df["part_buy"] = None
-        else:
-            port_chang_df["part_sell"] = port_chang_df.apply(
-                lambda row: (row["part_curr"] - row["part_req"]) if (row["part_curr"] > row["part_req"]) else 0, axis=1
-            )
-            port_chang_df["part_buy"] = port_chang_df.apply(
-                lambda row: (row["part_req"] - row["part_curr"]) if (row["part_curr"] < row["part_req"]) else 0, axis=1
-            )
+        # Инструменты текущего и требуемого портфелей по возрастанию instr_id (как при внешнем соединении)
+        part_curr_full_arr = np.zeros(len(registry))
+        part_curr_full_arr[curr_code_arr] = part_curr_arr
+        part_req_full_arr = np.zeros(len(registry))
+        part_req_full_arr[req_code_arr] = part_req_df["part"].values
+        chang_code_arr = np.union1d(curr_code_arr, req_code_arr)
+        chang_code_arr = chang_code_arr[np.argsort(registry.instr_ids[chang_code_arr], kind="stable")]
+
+        port_chang_df = pd.DataFrame(
+            {
+                "instr_id": registry.instr_ids[chang_code_arr],
+                "part_curr": part_curr_full_arr[chang_code_arr],
+                "part_req": part_req_full_arr[chang_code_arr],
+            }
+        )
+        port_chang_df["part_sell"] = (port_chang_df["part_curr"] - port_chang_df["part_req"]).clip(lower=0)
+        port_chang_df["part_buy"] = (port_chang_df["part_req"] - port_chang_df["part_curr"]).clip(lower=0)
         # Доли паёв, которые необходимо купить/продать
         # Поля: instr_id, part_curr, part_req, part_sell, part_buy
         self.port_chang_df = port_chang_df
@@ -289,112 +543,116 @@ class Agent:
             cash_temp = cash
 
             # Проверка на соответствие требованиям минимальной стоимости приобретения , и пересчёт долей при необходимости
-            part_req_df = pd.merge(part_req_df, self.envir.spr_df[["instr_id", "min_sum"]], on="instr_id")
+            part_req_df["min_sum"] = registry.min_sum[req_code_arr]
             part_req_df["value_buy"] = part_req_df["part"] * cash_temp
             part_req_df = part_req_df[part_req_df["value_buy"] >= part_req_df["min_sum"]]
-            part_req_df["part"] = (
-                0 if part_req_df["total_2"].sum() == 0 else part_req_df["total_2"] / part_req_df["total_2"].sum()
-            )  # part_req_df['bet_thres'] / part_req_df['bet_thres'].sum()
+            # part_req_df['bet_thres'] / part_req_df['bet_thres'].sum()
+            part_req_df["part"] = self.calc_part(part_req_df)
             # part_req_df['part'] = (0 if part_req_df['bet_thres^pow'].sum() == 0 else part_req_df['bet_thres^pow'] / part_req_df['bet_thres^pow'].sum()) #part_req_df['bet_thres'] / part_req_df['bet_thres'].sum()
 
             # print()
             # print('part_req_df \n', part_req_df)
 
-            part_req_df = part_req_df[["instr_id", "part"]]
-
-            for index, row_buy in part_req_df.iterrows():
-                part_temp = row_buy["part"]
-
-                # Проверка на соответствие требованиям минимальной стоимости приобретения инструмента
-                if (
-                    part_temp * cash_temp
-                    > self.envir.spr_df[self.envir.spr_df["instr_id"] == row_buy["instr_id"]].iloc[0]["min_sum"]
-                ):
-
-                    # Покупка инструмента
-                    self.buy(row_buy["instr_id"], part_temp * cash_temp)
-                    self.prim_state = False
+            # Покупка инструментов, прошедших проверку на минимальную стоимость приобретения, одним пакетом
+            value_buy_arr = part_req_df["part"].values * cash_temp
+            orders = [
+                ("buy", instr_id, value_buy)
+                for instr_id, value_buy, min_sum in zip(part_req_df["instr_id"], value_buy_arr, part_req_df["min_sum"])
+                if value_buy > min_sum
+            ]
+            if len(orders) > 0:
+                self.execute(orders)
+                self.prim_state = False
         else:
             # Рассчитать матрицу выгодности перекупки паёв
             # Выгода от смены паёв
-            self.benef_shar = pd.DataFrame(columns=["instr_id_sell", "instr_id_buy", "benef"])
-            port_ch_param_df = pd.merge(port_chang_df, self.param_df[["instr_id", "total_2"]], on="instr_id")
-            port_ch_param_df = pd.merge(
-                port_ch_param_df, self.envir.spr_df[["instr_id", "surcharge", "discount"]], on="instr_id"
-            )
+            # Только инструменты с рассчитанными параметрами
+            total_2_full_arr = np.full(len(registry), np.nan)
+            param_mask = np.zeros(len(registry), dtype=bool)
+            param_code_arr = registry.codes(self.param_df["instr_id"])
+            total_2_full_arr[param_code_arr] = self.param_df["total_2"].values
+            param_mask[param_code_arr] = True
+
+            code_arr = chang_code_arr[param_mask[chang_code_arr]]
+            port_ch_param_df = port_chang_df[param_mask[chang_code_arr]].reset_index(drop=True)
+            port_ch_param_df["total_2"] = total_2_full_arr[code_arr]
+            port_ch_param_df["surcharge"] = registry.surcharge[code_arr]
+            port_ch_param_df["discount"] = registry.discount[code_arr]
             # Доли паёв, которые необходимо купить/продать с параметрами
-            # Поля: instr_id, part_curr, part_req, part_sell, part_buy, profit_mean
+            # Поля: instr_id, part_curr, part_req, part_sell, part_buy, total_2, surcharge, discount
             self.port_ch_param_df = port_ch_param_df
 
-            # Распечатка всех показателей
-            # print ('Смена портфеля: \n', port_chang_df)
-            # print ('Параметры инструментов: \n', port_ch_param_df)
-
-            # Цикл расчёта выгодности перехода по необходимым инструментам
-            for index_sell in port_ch_param_df[
-                port_ch_param_df["part_req"] < port_ch_param_df["part_curr"]
-            ].index:  # После отладки убрать объединение со справочником
-                instr_sell = port_ch_param_df.loc[index_sell]
-                for index_buy in port_ch_param_df[port_ch_param_df["part_req"] > port_ch_param_df["part_curr"]].index:
-                    instr_buy = port_ch_param_df.loc[index_buy]
-                    benef = instr_buy["total_2"] - (
-                        instr_sell["total_2"] * (1 + instr_sell["surcharge"]) / (1 - instr_sell["discount"])
-                    )  # Т.к. в total_2 скидка и надбавка уже учтены, то применяем их обратно
-
-                    # print ('instr_sell: ', instr_sell['instr_id'], 'instr_buy: ', instr_buy['instr_id'], 'benef: ', benef)
-                    self.benef_shar = self.benef_shar.append(
-                        {
-                            "instr_id_sell": instr_sell["instr_id"],
-                            "instr_id_buy": instr_buy["instr_id"],
-                            "benef": benef,
-                        },
-                        ignore_index=True,
-                    )
-            self.benef_shar = self.benef_shar[self.benef_shar["benef"] > 0].sort_values(by="benef", ascending=False)
+            part_curr_arr = port_ch_param_df["part_curr"].values
+            part_req_arr = port_ch_param_df["part_req"].values
+            total_2_arr = port_ch_param_df["total_2"].values.astype(float)
+            sell_arr = np.flatnonzero(part_req_arr < part_curr_arr)
+            buy_arr = np.flatnonzero(part_req_arr > part_curr_arr)
+
+            # Матрица выгодности перехода продажа x покупка
+            # Т.к. в total_2 скидка и надбавка уже учтены, то применяем их обратно
+            total_2_sell_arr = (
+                total_2_arr[sell_arr]
+                * (1 + port_ch_param_df["surcharge"].values[sell_arr])
+                / (1 - port_ch_param_df["discount"].values[sell_arr])
+            )
+            benef_mat = total_2_arr[buy_arr][None, :] - total_2_sell_arr[:, None]
+
+            # Выгодные пары по убыванию выгоды
+            pair_arr = np.flatnonzero(benef_mat > 0)
+            pair_arr = pair_arr[np.argsort(-benef_mat.ravel()[pair_arr], kind="stable")]
+            pair_sell_arr = sell_arr[pair_arr // max(len(buy_arr), 1)]
+            pair_buy_arr = buy_arr[pair_arr % max(len(buy_arr), 1)]
+
+            instr_id_arr = port_ch_param_df["instr_id"].values
+            self.benef_shar = pd.DataFrame(
+                {
+                    "instr_id_sell": instr_id_arr[pair_sell_arr],
+                    "instr_id_buy": instr_id_arr[pair_buy_arr],
+                    "benef": benef_mat.ravel()[pair_arr],
+                }
+            )
 
             # Продать/купить доли паёв
-            # Таблица у которой будут учитываться (убавляться) доли для смены
-            temp_chang_df = port_chang_df[["instr_id", "part_sell", "part_buy"]]
-            self.temp_chang_df = temp_chang_df
-            for index in self.benef_shar.index:
-                # print (self.benef_shar.loc[index])
-                row_sell = temp_chang_df[temp_chang_df["instr_id"] == self.benef_shar.loc[index]["instr_id_sell"]].iloc[
-                    0
-                ]
-                row_buy = temp_chang_df[temp_chang_df["instr_id"] == self.benef_shar.loc[index]["instr_id_buy"]].iloc[0]
-                # print('part_sell: ', row_sell['part_sell'], 'index: ', row_sell.name)
-                # print('part_buy: ',  row_buy['part_buy'], 'index: ', row_buy.name)
-
+            # Доли, которые будут учитываться (убавляться) при смене
+            part_sell_list = port_ch_param_df["part_sell"].values.tolist()
+            part_buy_list = port_ch_param_df["part_buy"].values.tolist()
+            min_sum_list = registry.min_sum[code_arr].tolist()
+            instr_id_list = instr_id_arr.tolist()
+
+            orders = []
+            for index_sell, index_buy in zip(pair_sell_arr.tolist(), pair_buy_arr.tolist()):
                 # Выбираем меньшую долю из необходимых покупки и продажи
-                if row_sell["part_sell"] > row_buy["part_buy"]:
-                    # print ('buy smaller')
-                    part_temp = row_buy["part_buy"]
-                else:
-                    # print ('sell smaller')
-                    part_temp = row_sell["part_sell"]
+                part_temp = min(part_sell_list[index_sell], part_buy_list[index_buy])
 
                 # Проверка на соответствие требованиям минимальной стоимости приобретения инструмента
-                if (
-                    part_temp * self.port_summ_value
-                    > self.envir.spr_df[self.envir.spr_df["instr_id"] == row_buy["instr_id"]].iloc[0]["min_sum"]
-                ):
-
-                    # Продажа инструмента
-                    self.sell(row_sell["instr_id"], part_temp * self.port_summ_value)
-
-                    # temp_chang_df.loc[row_sell.name]['part_sell'] = row_sell['part_sell'] - part_temp
-                    temp_chang_df.set_value(row_sell.name, "part_sell", row_sell["part_sell"] - part_temp)
+                if part_temp * self.port_summ_value > min_sum_list[index_buy]:
+                    # Продажа и покупка инструмента
+                    orders.append(("sell", instr_id_list[index_sell], part_temp * self.port_summ_value))
+                    orders.append(("buy", instr_id_list[index_buy], part_temp * self.port_summ_value))
 
+                    part_sell_list[index_sell] -= part_temp
+                    part_buy_list[index_buy] -= part_temp
                     # исправление ошибки float
-                    if temp_chang_df.loc[row_sell.name]["part_sell"] < 1e-9:
-                        temp_chang_df.loc[row_sell.name]["part_sell"] = 0
+                    if part_sell_list[index_sell] < 1e-9:
+                        part_sell_list[index_sell] = 0
+                    if part_buy_list[index_buy] < 1e-9:
+                        part_buy_list[index_buy] = 0
+
+            # Остатки долей к смене
+            self.temp_chang_df = pd.DataFrame(
+                {"instr_id": instr_id_arr, "part_sell": part_sell_list, "part_buy": part_buy_list}
+            )
 
-                    # Покупка инструмента
-                    self.buy(row_buy["instr_id"], part_temp * self.port_summ_value)
-                    temp_chang_df.loc[row_buy.name]["part_buy"] = row_buy["part_buy"] - part_temp
-                    # исправление ошибки float
-                    if temp_chang_df.loc[row_sell.name]["part_buy"] < 1e-9:
-                        temp_chang_df.loc[row_sell.name]["part_buy"] = 0
+            if len(orders) > 0:
+                self.execute(orders)
+
+    def calc_part(self, part_req_df):
+        """
+        Требуемые доли отобранных инструментов: пропорционально total_2 или по заданному распределению alloc
+        """
+        if self.alloc is not None:
+            return self.alloc.part(self, part_req_df)
+        return 0 if part_req_df["total_2"].sum() == 0 else part_req_df["total_2"] / part_req_df["total_2"].sum()
 
     def gather(self, instr_id):
         # Получение истории цен инструмента отсортированной по дате
@@ -405,8 +663,34 @@ class Agent:
         )
         return price_hist_temp_df
 
+    def profit_table(self):
+        # Таблица доходностей на горизонт из кэша (только для среды с полной сжатой историей)
+        if (self.profit_cache is None) or not hasattr(self.envir, "_price_mat"):
+            return None
+        return self.profit_cache.get(self.envir, self.horizon_days)
+
     def preprocess(self, price_hist_temp_df):
 
+        profit_mat = self.profit_table()
+        if (profit_mat is not None) and (len(price_hist_temp_df) > 0):
+            # Срез готовой таблицы: строки сжатой истории инструмента на дату (hist_cnt) с ценой через горизонт.
+            # Строки берутся из сжатой истории, а не по номеру строки price_hist_temp_df
+            instr_id = price_hist_temp_df["instr_id"].iloc[0]
+            code = self.envir._instr_code[instr_id]
+            n = int(self.envir.hist_cnt[code])
+            row_from = max(0, n - 1 - 2 * (self.min_hist_days + self.min_rent_days))
+            row_to = max(row_from, n - self.horizon_days)
+            pack_price = self.envir._pack_price
+            return pd.DataFrame(
+                {
+                    "date": np.asarray(self.envir._dates)[self.envir._pack_row[row_from:row_to, code]],
+                    "instr_id": instr_id,
+                    "price": pack_price[row_from:row_to, code],
+                    "price_next": pack_price[row_from + self.horizon_days : row_to + self.horizon_days, code],
+                    "profit": profit_mat[row_from:row_to, code],
+                }
+            )
+
         # Непосредственный рассчёт показателей
         price_hist_temp_df["price_next"] = price_hist_temp_df["price"].shift(
             -self.horizon_days
@@ -422,6 +706,8 @@ class Agent:
         return price_hist_temp_df
 
     def fit(self, price_hist_temp_df):
+        from scipy.stats.mstats import gmean  # Импорт по требованию - нужен только в calc_mode 'full'
+
         # расчёт sample weight для среднего всзвешенного
         date_max = price_hist_temp_df["date"].max()
         price_hist_temp_df["diff_day"] = (price_hist_temp_df["date"].apply(lambda x: x - date_max)).dt.days #envir.date
@@ -450,42 +736,47 @@ class Agent:
         return profit_mean, profit_std
 
     def buy(self, instr_id, value):
-
-        # исправление ошибки float
-        if ((value - self.envir.cash) < 1e-9) & ((value - self.envir.cash) > -1e-9):
-            value = self.envir.cash
-
-        self.envir.buy(instr_id, value)
-        return True
+        return self.execute([("buy", instr_id, value)])
 
     def sell(self, instr_id, value):
+        return self.execute([("sell", instr_id, value)])
 
-        # Получение справочной информации по инструменту
-        spr_instr_temp_df = self.envir.spr_df[self.envir.spr_df["instr_id"] == instr_id]
-        if spr_instr_temp_df.shape[0] == 0:
-            raise Exc("There is no such instr " + str(instr_id) + " in spr")
-        spr_instr = spr_instr_temp_df.iloc[0]
-
-        # Получение текущей цены по инструменту
-        price_temp_df = self.envir.price_df[(self.envir.price_df["instr_id"] == instr_id)]
-        if price_temp_df.shape[0] == 0:
-            raise Exc("There is no such instr " + str(instr_id) + " in price")
-        price_se = price_temp_df.iloc[0]
-
-        # Получение портфельной записи по инструменту
-        port_temp_df = self.envir.port_df[self.envir.port_df["instr_id"] == instr_id]
-        if port_temp_df.shape[0] == 0:
-            raise Exc("There is no such instr " + str(instr_id) + " in port")
-        port_se = port_temp_df.iloc[0]
-
-        # Вычисление количетсва инструментов на продажу
-        instr_quantity = value / (price_se["price"] * (1 - spr_instr.discount))
-
-        # исправление ошибки float
-        # if ((value - (port_se['quantity'] * price_se['price'] * (1 - spr_instr.discount))) < 1e-9) & ((value - (port_se['quantity'] * price_se['price'] * (1 - spr_instr.discount))) > -1e-9):
-        #    value = port_se['quantity'] * price_se['price'] * (1 - spr_instr.discount)
-        if (port_se["quantity"] - instr_quantity < 1e-9) & (port_se["quantity"] - instr_quantity > -1e-9):
-            value = port_se["quantity"] * (price_se["price"] * (1 - spr_instr.discount))
-
-        self.envir.sell(instr_id, value)
+    def execute(self, orders):
+        """
+        Пакетное исполнение заявок (action, instr_id, value) средой с исправлением ошибок float:
+        покупка на сумму, почти равную остатку кэша, - на весь кэш; продажа почти всего количества - всего количества
+        """
+        cash = self.envir.cash
+        quantity_dict = {}
+        orders_fix = []
+
+        for action, instr_id, value in orders:
+            code = self.envir._instr_code.get(instr_id)
+            # Ошибки по неизвестным инструментам выдаёт среда
+            if (code is None) or (not self.envir.instr_mask[code]):
+                orders_fix.append((action, instr_id, value))
+                continue
+            price = self.envir.price_arr[code]
+            quantity = quantity_dict.get(code, self.envir._quantity[code])
+
+            if action == "buy":
+                # исправление ошибки float
+                if ((value - cash) < 1e-9) & ((value - cash) > -1e-9):
+                    value = cash
+                quantity_dict[code] = quantity + value / (price * (1 + self.envir._surcharge_arr[code]))
+                cash = cash - value
+            elif action == "sell":
+                # Вычисление количетсва инструментов на продажу
+                price_sell = price * (1 - self.envir._discount_arr[code])
+                instr_quantity = value / price_sell
+
+                # исправление ошибки float
+                if (quantity - instr_quantity < 1e-9) & (quantity - instr_quantity > -1e-9):
+                    value = quantity * price_sell
+                quantity_dict[code] = quantity - value / price_sell
+                cash = cash + value
+
+            orders_fix.append((action, instr_id, value))
+
+        self.envir.execute(orders_fix)
         return True
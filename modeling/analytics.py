@@ -0,0 +1,423 @@
+import numpy as np
+import pandas as pd
+
+from modeling.environment import Environment
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def _stack(hist, run_ids, name):
+    # Список историй по прогонам или одна таблица с полем run -> одна таблица с полем run
+    if isinstance(hist, pd.DataFrame):
+        if "run" not in hist.columns:
+            raise Exc("Field run is required in " + name + " of several runs")
+        return hist
+    if len(hist) != len(run_ids):
+        raise Exc(
+            "Length of " + name + " " + str(len(hist)) + " is not equal to the number of runs " + str(len(run_ids))
+        )
+    return pd.concat([hist_df.assign(run=run_id) for run_id, hist_df in zip(run_ids, hist)], ignore_index=True)
+
+
+class Analytics:
+    """
+    Показатели эффективности множества прогонов по записанным историям агента (port_hist_df, price_hist_df):
+    кривая стоимости, CAGR, волатильность, Sharpe, максимальная просадка, оборот и потери на надбавке/скидке.
+    Все прогоны считаются одновременно операциями над массивами прогон x период (без циклов по прогонам).
+
+    История портфеля записывается на дату до ребалансировки, поэтому сделки ребалансировки даты t - разница
+    количеств на даты t+1 и t по цене даты t. Наличные восстанавливаются по сделкам от cash_start
+    (прогон начинается с пустого портфеля, как после Environment.start); сделки на последнюю дату прогона
+    в истории не видны и не учитываются. Стоимость инструментов - с учётом скидки при продаже (как port_summ_value),
+    инструменты без цены на дату не оцениваются.
+
+    Attributes:
+        registry:     Реестр инструментов (коды, надбавка, скидка)
+        run_ids:      Id прогонов в порядке строк матриц
+        cash_start:   Денежные средства стартовые по прогонам
+        rate_free:    Безрисковая ставка годовая (для Sharpe)
+        year_days:    Дней в году
+        n_step:       Количество периодов по прогонам
+        date_mat:     Даты периодов прогон x период (NaT после окончания прогона)
+        value_mat:    Стоимость инструментов портфеля прогон x период
+        cash_mat:     Денежные средства
+        equity_mat:   Полная стоимость (инструменты + денежные средства)
+        buy_mat:      Покупки ребалансировки даты в ценах инструментов
+        sell_mat:     Продажи ребалансировки даты в ценах инструментов
+        cost_mat:     Надбавка при покупке и скидка при продаже ребалансировки даты
+        day_arr:      Торговые дни дневной оценки (после nav)
+        nav_mat:      Полная стоимость на торговый день прогон x день (после nav, nan вне прогона)
+
+    Example:
+        analytics = Analytics.from_agents(agent_list, run_ids=key_list)
+        metrics_df = analytics.rank('sharpe')
+    """
+
+    METRICS = [
+        "date_start",
+        "date_finish",
+        "equity_start",
+        "equity_finish",
+        "cagr",
+        "volatility",
+        "sharpe",
+        "max_drawdown",
+        "turnover",
+        "cost",
+        "cost_drag",
+    ]
+
+    def __init__(
+        self,
+        registry,
+        port_hist,
+        price_hist,
+        run_ids=None,
+        windows=None,
+        cash_start=1_000_000,
+        rate_free=0.0,
+        year_days=365.25,
+    ):
+        """
+            Расчёт матриц прогон x период по историям прогонов
+
+        Args:
+            registry:    Реестр инструментов (Environment.registry)
+            port_hist:   История портфеля (date, instr_id, quantity): список по прогонам или таблица с полем run
+            price_hist:  История цен (date, instr_id, price): список по прогонам, таблица с полем run
+                         или одна общая для всех прогонов таблица (цены на дату у прогонов совпадают)
+            run_ids:     Id прогонов (для списков; None - номера)
+            windows:     Окна прогонов (date_start, date_finish) - нужны, если история цен общая
+            cash_start:  Денежные средства стартовые (число или по прогонам)
+            rate_free:   Безрисковая ставка годовая
+            year_days:   Дней в году
+
+        Raises:
+            Exc: Даты прогонов не определить, дата истории портфеля вне дат прогона
+        """
+        if run_ids is None:
+            is_df = isinstance(port_hist, pd.DataFrame)
+            run_ids = list(pd.unique(port_hist["run"])) if is_df else list(range(len(port_hist)))
+        port_df = _stack(port_hist, run_ids, "port_hist")
+        price_shared = isinstance(price_hist, pd.DataFrame) and ("run" not in price_hist.columns)
+        price_df = price_hist if price_shared else _stack(price_hist, run_ids, "price_hist")
+
+        self.registry = registry
+        self.run_ids = np.asarray(run_ids, dtype=object)
+        self.rate_free = rate_free
+        self.year_days = year_days
+        n_run = len(self.run_ids)
+        self.cash_start = np.broadcast_to(np.asarray(cash_start, dtype=float), (n_run,)).copy()
+        run_index = pd.Index(self.run_ids)
+
+        # Даты периодов прогонов: (прогон, дата) по возрастанию
+        if windows is not None:
+            # Окон обычно немного (перебор параметров на одних окнах) - даты считаются 1 раз на окно
+            window_dict = {}
+            date_list = []
+            for window in windows:
+                window = (pd.Timestamp(window[0]), pd.Timestamp(window[1]))
+                if window not in window_dict:
+                    window_dict[window] = np.array(Environment.period_dates(*window), dtype="datetime64[ns]")
+                date_list.append(window_dict[window])
+            grid_run_arr = np.repeat(np.arange(n_run), [len(dates) for dates in date_list])
+            grid_date_arr = np.concatenate(date_list)
+        elif not price_shared:
+            grid_df = price_df[["run", "date"]].drop_duplicates()
+            grid_run_arr = self._run_codes(run_index, grid_df["run"])
+            grid_date_arr = grid_df["date"].values.astype("datetime64[ns]")
+        else:
+            raise Exc("Dates of runs are unknown: set windows or price_hist by runs")
+
+        # Общая шкала дат и плотная матрица цен дата x инструмент (цены на дату у прогонов совпадают)
+        price_date_arr = price_df["date"].values.astype("datetime64[ns]")
+        port_date_arr = port_df["date"].values.astype("datetime64[ns]")
+        self._udates = np.unique(np.concatenate([grid_date_arr, price_date_arr, port_date_arr]))
+        price_mat = np.full((len(self._udates), len(registry)), np.nan)
+        price_mat[np.searchsorted(self._udates, price_date_arr), registry.codes(price_df["instr_id"])] = price_df[
+            "price"
+        ].values
+
+        grid_key_arr = np.unique(grid_run_arr * len(self._udates) + np.searchsorted(self._udates, grid_date_arr))
+        grid_run_arr = grid_key_arr // len(self._udates)
+        self.n_step = np.bincount(grid_run_arr, minlength=n_run)
+        run_first = np.concatenate([[0], np.cumsum(self.n_step)[:-1]])
+        grid_step_arr = np.arange(len(grid_key_arr)) - run_first[grid_run_arr]
+        n_step_max = max(int(self.n_step.max()), 1) if n_run > 0 else 1
+
+        # Номер даты общей шкалы для (прогон, период), -1 после окончания прогона
+        date_idx_mat = np.full((n_run, n_step_max), -1)
+        date_idx_mat[grid_run_arr, grid_step_arr] = grid_key_arr % len(self._udates)
+        self._date_idx_mat = date_idx_mat
+        self.date_mat = np.where(date_idx_mat >= 0, self._udates[np.maximum(date_idx_mat, 0)], np.datetime64("NaT"))
+        step_mask = date_idx_mat >= 0
+
+        # Строки истории портфеля -> (прогон, период, инструмент)
+        run_arr = self._run_codes(run_index, port_df["run"])
+        code_arr = registry.codes(port_df["instr_id"])
+        quantity_arr = port_df["quantity"].values.astype(float)
+        row_key_arr = run_arr * len(self._udates) + np.searchsorted(self._udates, port_date_arr)
+        row_pos_arr = np.minimum(np.searchsorted(grid_key_arr, row_key_arr), len(grid_key_arr) - 1)
+        if (len(row_key_arr) > 0) and (grid_key_arr[row_pos_arr] != row_key_arr).any():
+            bad = np.flatnonzero(grid_key_arr[row_pos_arr] != row_key_arr)[0]
+            raise Exc(
+                "Date " + str(port_df["date"].iloc[bad]) + " of port_hist is not a period date of run "
+                + str(port_df["run"].iloc[bad])
+            )
+        step_arr = row_pos_arr - run_first[run_arr]
+        self._port_rows = (run_arr, step_arr, code_arr, quantity_arr)
+
+        # Стоимость инструментов на дату периода
+        price_row_arr = price_mat[date_idx_mat[run_arr, step_arr], code_arr]
+        value_arr = np.nan_to_num(quantity_arr * price_row_arr * (1 - registry.discount[code_arr]))
+        flat_arr = run_arr * n_step_max + step_arr
+        self.value_mat = np.bincount(flat_arr, weights=value_arr, minlength=n_run * n_step_max).reshape(n_run, -1)
+
+        # Сделки ребалансировки периода t: +количество на t+1, -количество на t (нет строки - 0).
+        # Количества первого периода (покупки до начала прогона) и сделки последнего (не видны) не учитываются
+        trade_run_arr = np.concatenate([run_arr, run_arr])
+        trade_step_arr = np.concatenate([step_arr - 1, step_arr])
+        trade_mask = (trade_step_arr >= 0) & (trade_step_arr < self.n_step[trade_run_arr] - 1)
+        trade_key_arr = (trade_run_arr * n_step_max + trade_step_arr)[trade_mask] * len(registry) + np.concatenate(
+            [code_arr, code_arr]
+        )[trade_mask]
+        trade_key_arr, trade_inv = np.unique(trade_key_arr, return_inverse=True)
+        dq_arr = np.bincount(trade_inv, weights=np.concatenate([quantity_arr, -quantity_arr])[trade_mask])
+        trade_flat_arr, trade_code_arr = np.divmod(trade_key_arr, len(registry))
+        dq_mask = dq_arr != 0
+        trade_flat_arr, trade_code_arr, dq_arr = trade_flat_arr[dq_mask], trade_code_arr[dq_mask], dq_arr[dq_mask]
+        trade_price_arr = price_mat[date_idx_mat.ravel()[trade_flat_arr], trade_code_arr]
+        buy_arr = np.where(dq_arr > 0, dq_arr * trade_price_arr, 0)
+        sell_arr = np.where(dq_arr < 0, -dq_arr * trade_price_arr, 0)
+        cost_arr = buy_arr * registry.surcharge[trade_code_arr] + sell_arr * registry.discount[trade_code_arr]
+
+        def step_sum(weight_arr):
+            return np.bincount(trade_flat_arr, weights=weight_arr, minlength=n_run * n_step_max).reshape(n_run, -1)
+
+        self.buy_mat = step_sum(buy_arr)
+        self.sell_mat = step_sum(sell_arr)
+        self.cost_mat = step_sum(cost_arr)
+
+        # Наличные на дату периода - до ребалансировки этой даты
+        flow_mat = self.sell_mat - self.buy_mat - self.cost_mat
+        self.cash_mat = self.cash_start[:, None] + np.concatenate(
+            [np.zeros((n_run, 1)), np.cumsum(flow_mat, axis=1)[:, :-1]], axis=1
+        )
+        self.equity_mat = np.where(step_mask, self.value_mat + self.cash_mat, np.nan)
+        self.value_mat[~step_mask] = np.nan
+        self.cash_mat[~step_mask] = np.nan
+        self.day_arr = None
+        self.nav_mat = None
+
+    @staticmethod
+    def _run_codes(run_index, run_s):
+        run_arr = run_index.get_indexer(run_s)
+        if (run_arr < 0).any():
+            raise Exc("There is no such run " + str(np.asarray(run_s)[run_arr < 0][0]))
+        return run_arr
+
+    @classmethod
+    def from_agents(cls, agent_list, run_ids=None, rate_free=0.0):
+        """
+            Показатели по агентам после action (каждый агент - отдельный прогон со своей средой)
+
+        Args:
+            agent_list:  Агенты
+            run_ids:     Id прогонов (None - номера)
+            rate_free:   Безрисковая ставка годовая
+
+        Returns:
+            Analytics
+        """
+        return cls(
+            agent_list[0].envir.registry,
+            [agent.port_hist_df for agent in agent_list],
+            [agent.price_hist_df for agent in agent_list],
+            run_ids=list(range(len(agent_list))) if run_ids is None else run_ids,
+            cash_start=[agent.envir.cash_start for agent in agent_list],
+            rate_free=rate_free,
+        )
+
+    def nav(self, envir, mem_mb=256):
+        """
+            Дневная оценка стоимости между ребалансировками: портфель и наличные постоянны между датами периодов
+            (для дней (date_t-1, date_t] - записанные на date_t), цены - последние известные на торговый день
+            по матрицам цен среды. Все прогоны - одним произведением количеств на цены по группам прогонов.
+            На торговый день даты периода (или последний перед ней) стоимость совпадает с equity_mat.
+
+        Args:
+            envir:   Среда прогонов (матрицы цен _dates, _hist_cnt, _pack_price)
+            mem_mb:  Ограничение памяти на 1 группу прогонов
+
+        Returns:
+            ndarray: nav_mat - прогон x торговый день (day_arr)
+
+        Raises:
+            Exc: Справочник среды не совпадает с реестром
+        """
+        if len(envir.registry) != len(self.registry):
+            raise Exc("Registry of envir does not match registry of runs")
+        n_run = len(self.run_ids)
+        run_all_arr = np.arange(n_run)
+        last_arr = np.maximum(self.n_step - 1, 0)
+        date_first = self.date_mat[:, 0]
+        date_last = self.date_mat[run_all_arr, last_arr]
+
+        row_from = np.searchsorted(envir._dates, date_first.min(), side="left")
+        row_to = np.searchsorted(envir._dates, date_last.max(), side="right")
+        self.day_arr = np.asarray(envir._dates[row_from:row_to])
+
+        # Количества по (прогон, период, инструмент портфелей) и цены дней со скидкой при продаже
+        run_arr, step_arr, code_arr, quantity_arr = self._port_rows
+        held_arr, held_inv = np.unique(code_arr, return_inverse=True)
+        quantity_mat = np.zeros((n_run, self.date_mat.shape[1], len(held_arr)))
+        quantity_mat[run_arr, step_arr, held_inv] = quantity_arr
+        cnt_mat = np.asarray(envir._hist_cnt[row_from:row_to][:, held_arr])
+        price_mat = np.asarray(envir._pack_price[np.maximum(cnt_mat - 1, 0), held_arr])
+        price_mat = np.where(cnt_mat > 0, price_mat * (1 - self.registry.discount[held_arr]), 0)
+
+        # Период дня: количество дат периодов прогона раньше дня (поиск по ключам прогон * span + день)
+        day_int = self.day_arr.astype("datetime64[D]").astype(np.int64)
+        date_int = self.date_mat.astype("datetime64[D]").astype(np.int64)
+        base = min(day_int.min(initial=0), date_int[self._date_idx_mat >= 0].min(initial=0))
+        span = max(day_int.max(initial=0), date_int[self._date_idx_mat >= 0].max(initial=0)) - base + 1
+        period_key_arr = (run_all_arr[:, None] * span + date_int - base)[self._date_idx_mat >= 0]
+        run_first = np.concatenate([[0], np.cumsum(self.n_step)[:-1]])
+
+        self.nav_mat = np.full((n_run, len(self.day_arr)), np.nan)
+        chunk = max(1, int(mem_mb * 2**20 / 8 / max(1, len(self.day_arr) * max(1, len(held_arr)))))
+        for start in range(0, n_run, chunk):
+            run_chunk = run_all_arr[start : start + chunk]
+            key_mat = run_chunk[:, None] * span + (day_int - base)[None, :]
+            step_mat = np.searchsorted(period_key_arr, key_mat, side="left") - run_first[run_chunk][:, None]
+            in_mask = (self.day_arr[None, :] >= date_first[run_chunk][:, None]) & (
+                self.day_arr[None, :] <= date_last[run_chunk][:, None]
+            )
+            step_mat = np.minimum(np.where(in_mask, step_mat, 0), last_arr[run_chunk][:, None])
+
+            value_mat = np.einsum("rdk,dk->rd", quantity_mat[run_chunk[:, None], step_mat], price_mat, optimize=True)
+            cash_mat = self.cash_mat[run_chunk[:, None], step_mat]
+            self.nav_mat[run_chunk] = np.where(in_mask, value_mat + cash_mat, np.nan)
+        return self.nav_mat
+
+    def nav_df(self, envir=None):
+        """
+            Дневная стоимость всех прогонов (nav, если ещё не рассчитана - по envir)
+
+        Returns:
+            DataFrame: run, date, equity, drawdown (доля от предыдущего максимума)
+        """
+        if self.nav_mat is None:
+            self.nav(envir)
+        day_mask = ~np.isnan(self.nav_mat)
+        drawdown_mat = 1 - self.nav_mat / np.fmax.accumulate(self.nav_mat, axis=1)
+        return pd.DataFrame(
+            {
+                "run": np.broadcast_to(self.run_ids[:, None], day_mask.shape)[day_mask],
+                "date": np.broadcast_to(self.day_arr[None, :], day_mask.shape)[day_mask],
+                "equity": self.nav_mat[day_mask],
+                "drawdown": drawdown_mat[day_mask],
+            }
+        )
+
+    def metrics(self):
+        """
+            Показатели прогонов
+
+        Returns:
+            DataFrame: По прогонам (индекс - run):
+                date_start, date_finish:     Первая и последняя даты периода прогона
+                equity_start, equity_finish: Полная стоимость на эти даты
+                cagr:          Среднегодовая доходность
+                volatility:    Волатильность доходности периодов в годовом выражении
+                sharpe:        (Средняя доходность периода в годовом выражении - rate_free) / volatility
+                max_drawdown:  Максимальная просадка полной стоимости (доля от предыдущего максимума)
+                turnover:      Оборот в год: (покупки + продажи) / 2 к полной стоимости на дату, сумма за год
+                cost:          Сумма надбавки при покупке и скидки при продаже
+                cost_drag:     Потеря среднегодовой доходности на надбавке и скидке
+                max_drawdown_daily:  Максимальная просадка дневной стоимости (только после nav)
+        """
+        run_arr = np.arange(len(self.run_ids))
+        last_arr = np.maximum(self.n_step - 1, 0)
+        equity_start = self.equity_mat[:, 0]
+        equity_finish = self.equity_mat[run_arr, last_arr]
+        date_start = self.date_mat[:, 0]
+        date_finish = self.date_mat[run_arr, last_arr]
+        years = (date_finish - date_start) / np.timedelta64(1, "D") / self.year_days
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cagr = (equity_finish / equity_start) ** (1 / years) - 1
+
+            ret_mat = self.equity_mat[:, 1:] / self.equity_mat[:, :-1] - 1
+            n_ret = np.sum(~np.isnan(ret_mat), axis=1)
+            step_year = n_ret / years
+            ret_mean = np.nansum(ret_mat, axis=1) / n_ret
+            ret_var = np.nansum((ret_mat - ret_mean[:, None]) ** 2, axis=1) / (n_ret - 1)
+            volatility = np.sqrt(ret_var * step_year)
+            sharpe = (ret_mean * step_year - self.rate_free) / volatility
+
+            max_drawdown = 1 - np.nanmin(self.equity_mat / np.fmax.accumulate(self.equity_mat, axis=1), axis=1)
+            turnover = np.nansum((self.buy_mat + self.sell_mat) / 2 / self.equity_mat, axis=1) / years
+
+            # Стоимость без надбавки и скидки: + сумма потерь по предыдущим ребалансировкам
+            cost = self.cost_mat.sum(axis=1)
+            cost_prev = cost - self.cost_mat[run_arr, last_arr]
+            cagr_gross = ((equity_finish + cost_prev) / equity_start) ** (1 / years) - 1
+            cost_drag = cagr_gross - cagr
+
+        metrics_df = pd.DataFrame(
+            {
+                "date_start": date_start,
+                "date_finish": date_finish,
+                "equity_start": equity_start,
+                "equity_finish": equity_finish,
+                "cagr": cagr,
+                "volatility": volatility,
+                "sharpe": sharpe,
+                "max_drawdown": max_drawdown,
+                "turnover": turnover,
+                "cost": cost,
+                "cost_drag": cost_drag,
+            },
+            index=pd.Index(self.run_ids, name="run"),
+        )[self.METRICS]
+
+        if self.nav_mat is not None:
+            with np.errstate(invalid="ignore"):
+                metrics_df["max_drawdown_daily"] = 1 - np.nanmin(
+                    self.nav_mat / np.fmax.accumulate(self.nav_mat, axis=1), axis=1
+                )
+        return metrics_df
+
+    def rank(self, by="sharpe", ascending=False):
+        """
+            Показатели прогонов, упорядоченные по показателю by (по умолчанию - лучшие по Sharpe первыми)
+        """
+        return self.metrics().sort_values(by, ascending=ascending, kind="stable")
+
+    def equity_df(self):
+        """
+            Кривые стоимости всех прогонов
+
+        Returns:
+            DataFrame: run, date, value, cash, equity, buy, sell, cost (сделки ребалансировки даты)
+        """
+        step_mask = self._date_idx_mat >= 0
+        return pd.DataFrame(
+            {
+                "run": np.broadcast_to(self.run_ids[:, None], step_mask.shape)[step_mask],
+                "date": self.date_mat[step_mask],
+                "value": self.value_mat[step_mask],
+                "cash": self.cash_mat[step_mask],
+                "equity": self.equity_mat[step_mask],
+                "buy": self.buy_mat[step_mask],
+                "sell": self.sell_mat[step_mask],
+                "cost": self.cost_mat[step_mask],
+            }
+        )
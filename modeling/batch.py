@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import sys
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+# Параметры конфигурации по умолчанию
+DEFAULTS = {
+    "mode": "backtest",
+    "type_instr": "stock",
+    "data_path": "3. Data preparation",
+    "offline": True,
+    "mmap": False,
+    "date_start": "2010-01-01",
+    "date_finish": "2020-01-01",
+    "cash_start": 1_000_000,
+    "agent": {},
+    "sink_path": None,
+    "run_id": None,
+    "grid": {},
+    "windows": None,
+    "result_path": "result_grid_search.csv",
+    "n_jobs": None,
+    "out": None,
+}
+
+
+def load_config(path):
+    """
+        Чтение конфигурации прогона (json) с подстановкой значений по умолчанию
+
+    Args:
+        path:  Путь к файлу конфигурации
+
+    Returns:
+        dict: Конфигурация (ключи DEFAULTS)
+
+    Raises:
+        Exc: Неизвестные ключи или режим
+    """
+    with open(path, encoding="utf-8") as file:
+        config = json.load(file)
+    unknown_list = sorted(set(config) - set(DEFAULTS))
+    if len(unknown_list) > 0:
+        raise Exc("Unknown config keys: " + ", ".join(unknown_list))
+    config = {**DEFAULTS, **config}
+    if config["mode"] not in ("backtest", "sweep"):
+        raise Exc("Unknown mode " + str(config["mode"]) + ": backtest or sweep")
+    return config
+
+
+def windows(config):
+    # Окна перебора: windows или одно окно date_start - date_finish
+    import pandas as pd
+
+    window_list = config["windows"]
+    if window_list is None:
+        window_list = [(config["date_start"], config["date_finish"])]
+    return [(pd.Timestamp(date_start), pd.Timestamp(date_finish)) for date_start, date_finish in window_list]
+
+
+def run_errors():
+    # Исключения модулей modeling (у каждого модуля свой Exc), загруженных к моменту ошибки
+    return tuple(
+        module.Exc
+        for name, module in list(sys.modules.items())
+        if name.startswith("modeling.") and isinstance(getattr(module, "Exc", None), type)
+    )
+
+
+def new_envir(config):
+    # Тяжёлые модули (pandas, среда) импортируются только при запуске прогона, не при разборе аргументов
+    import pandas as pd
+
+    from modeling.environment import Environment
+
+    # Среда строится с самой ранней даты прогонов - в режиме sweep это начало первого окна
+    if config["mode"] == "sweep":
+        date_start = min(date_start for date_start, _ in windows(config))
+    else:
+        date_start = pd.Timestamp(config["date_start"])
+    return Environment(
+        date_start,
+        config["cash_start"],
+        config["type_instr"],
+        "csv",
+        offline=config["offline"],
+        data_path=config["data_path"],
+        mmap=config["mmap"],
+    )
+
+
+def run_backtest(config):
+    """
+        Один прогон агента на окне date_start - date_finish
+
+    Returns:
+        DataFrame: Показатели прогона (modeling.analytics) с port_summ_value и cash на окончание
+    """
+    import pandas as pd
+
+    from modeling.agent import Agent
+    from modeling.analytics import Analytics
+    from modeling.sink import SinkParquet
+    from modeling.superviser import Superviser
+
+    envir = new_envir(config)
+    envir.start(
+        date_start=pd.Timestamp(config["date_start"]),
+        date_finish=pd.Timestamp(config["date_finish"]),
+        cash_start=config["cash_start"],
+    )
+    agent = Agent(envir)
+    agent.start(**config["agent"])
+
+    # История прогона пишется в приёмник только при заданном sink_path
+    if config["sink_path"] is not None:
+        Superviser(envir, agent, config["type_instr"], sink=SinkParquet(config["sink_path"], run_id=config["run_id"]))
+    agent.action(finish=config["sink_path"] is not None)
+
+    result_df = Analytics.from_agents([agent]).metrics()
+    result_df["port_summ_value"] = agent.port_summ_value
+    result_df["cash"] = envir.cash
+    return result_df.reset_index(drop=True)
+
+
+def run_sweep(config):
+    """
+        Перебор параметров агента по сетке grid на окнах windows (modeling.sweep.Sweep)
+
+    Returns:
+        DataFrame: Таблица результатов по всем посчитанным комбинациям, лучшие по port_summ_value первыми
+    """
+    from modeling.sweep import Sweep
+
+    envir = new_envir(config)
+    result_df = Sweep(
+        envir,
+        config["grid"],
+        windows(config),
+        config["result_path"],
+        n_jobs=config["n_jobs"],
+        agent_param=config["agent"],
+        cash_start=config["cash_start"],
+    ).run()
+    return result_df.sort_values("port_summ_value", ascending=False, kind="stable")
+
+
+def main(argv=None):
+    """
+        python -m modeling.batch config.json                  - прогон по конфигурации, результат в stdout
+        python -m modeling.batch config.json --out result.csv - и в csv
+
+    Конфигурация (json, ключи DEFAULTS): mode - 'backtest' (1 прогон, показатели modeling.analytics,
+    история в sink_path при заданном) или 'sweep' (перебор grid по windows в result_path);
+    agent - параметры Agent.start (скалярные), остальное - параметры среды и окна.
+    Код возврата: 0 - успешно, 1 - ошибка моделирования (Exc модулей), 2 - ошибка конфигурации.
+    """
+    parser = argparse.ArgumentParser(description="Headless backtest or parameter sweep from a json config")
+    parser.add_argument("config", help="json config")
+    parser.add_argument("--out", default=None, help="csv for results (overrides config out)")
+    parser.add_argument("--top", type=int, default=20, help="rows to print")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError, Exc) as exc:
+        print("Config error: " + str(exc), file=sys.stderr)
+        return 2
+
+    try:
+        result_df = run_backtest(config) if config["mode"] == "backtest" else run_sweep(config)
+    except Exception as exc:
+        # Ошибки моделирования (Exc модулей) - кратким сообщением и кодом возврата, остальные - как есть
+        if not isinstance(exc, run_errors()):
+            raise
+        print("Run error: " + str(exc), file=sys.stderr)
+        return 1
+    print(result_df.head(args.top).to_string(index=False))
+
+    out = config["out"] if args.out is None else args.out
+    if out is not None:
+        if os.path.dirname(out):
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+        result_df.to_csv(out, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from modeling.agent import Agent
+from modeling.environment import Environment
+from modeling.ingest import Source
+
+try:
+    import resource  # Нет в Windows - там пиковая память не измеряется
+except ImportError:
+    resource = None
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+# Сетки замеров: количество инструментов x длина истории в годах
+GRIDS = {
+    "quick": {"n_instr": [1, 10, 100, 500], "n_years": [5, 10]},
+    "full": {"n_instr": [1, 10, 100, 1000, 5000], "n_years": [5, 10, 20, 40]},
+}
+
+# Замеряемые показатели (все - чем меньше, тем лучше)
+METRICS = ["build_sec", "period_sec", "period_sec_max", "run_sec", "peak_mb"]
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+class SourceRandom(Source):
+    """
+    Источник истории цен - случайные доходности (как в Markowitz portfolio random.ipynb) вместо yfinance.
+    История инструмента воспроизводима: зависит только от seed и номера инструмента во вселенной.
+
+    Attributes:
+        dates:        Торговые дни полной истории
+        instr_index:  Номер инструмента вселенной по инструменту
+        seed:         Начальное значение генератора
+    """
+
+    def __init__(self, instr_list, n_years, seed=123, date_finish="2021-12-31"):
+        self.dates = pd.bdate_range(end=date_finish, periods=252 * n_years)
+        self.instr_index = {instr: index for index, instr in enumerate(instr_list)}
+        self.seed = seed
+
+    def fetch(self, instr, start=None, end=None):
+        index = self.instr_index[instr]
+        rng = np.random.default_rng([self.seed, index])
+
+        # Дневные ln доходности: у части инструментов положительный сдвиг среднего
+        shift = 0.0006 if index % 2 == 1 else 0.0
+        ln_profit_arr = rng.normal(shift, 0.01 + 0.01 * rng.random(), len(self.dates))
+        price_arr = 100 * np.exp(np.cumsum(ln_profit_arr))
+
+        # Инструменты появляются в разные даты первой трети истории
+        row_first = int(rng.integers(0, max(len(self.dates) // 3, 1)))
+        hist_df = pd.DataFrame(
+            {
+                "date": self.dates[row_first:],
+                "open": price_arr[row_first:],
+                "high": price_arr[row_first:],
+                "low": price_arr[row_first:],
+                "close": price_arr[row_first:],
+                "adj_close": price_arr[row_first:],
+                "volume": 1.0,
+            }
+        )
+        if start is not None:
+            hist_df = hist_df[hist_df["date"] >= pd.Timestamp(start)]
+        if end is not None:
+            hist_df = hist_df[hist_df["date"] < pd.Timestamp(end)]
+        return hist_df.reset_index(drop=True)
+
+
+def make_universe(data_path, n_instr, type_instr="bench"):
+    """
+        Справочник синтетической вселенной инструментов
+
+    Returns:
+        list: Инструменты
+    """
+    instr_list = ["R%05d" % index for index in range(n_instr)]
+    os.makedirs(os.path.join(data_path, type_instr), exist_ok=True)
+    pd.DataFrame(
+        {
+            "instr_id": instr_list,
+            "manager": "bench",
+            "instr": instr_list,
+            "min_sum": 0,
+            "surcharge": 0.001,
+            "discount": 0.002,
+            "fee": 0.01,
+        }
+    ).to_csv(os.path.join(data_path, type_instr, "spr.csv"), index=False)
+    return instr_list
+
+
+def bench_case(n_instr, n_years, n_period=24, agent_param=None, seed=123, repeat=3):
+    """
+        Замер одного варианта: загрузка синтетической истории в хранилище, построение среды
+        (офлайн, из хранилища) и прогон агента на последних n_period периодах истории.
+        Построение и прогон повторяются repeat раз, берётся лучшее время (меньше шума).
+
+    Args:
+        n_instr:      Количество инструментов
+        n_years:      Длина истории в годах
+        n_period:     Количество периодов прогона агента
+        agent_param:  Параметры Agent.start
+        seed:         Начальное значение генератора
+        repeat:       Количество повторов замера
+
+    Returns:
+        dict: n_instr, n_years, n_period и показатели METRICS
+              (build_sec - построение среды, period_sec/period_sec_max - среднее/максимальное время
+              Agent.new_period, run_sec - полный прогон, peak_mb - пиковая память процесса с заполнением хранилища)
+
+    Raises:
+        Exc: repeat меньше 1
+    """
+    if repeat < 1:
+        raise Exc("Benchmark repeat must be at least 1, got " + str(repeat))
+    agent_param = {} if agent_param is None else agent_param
+    data_path = tempfile.mkdtemp(prefix="bench_")
+    try:
+        instr_list = make_universe(data_path, n_instr)
+        source = SourceRandom(instr_list, n_years, seed=seed)
+
+        # Заполнение хранилища (не замеряется)
+        Environment(source.dates[-1], 1_000_000, "bench", "csv", data_path=data_path, source=source)
+
+        result = {"n_instr": n_instr, "n_years": n_years, "n_period": 0}
+        for metric in METRICS:
+            result[metric] = np.inf
+
+        for _ in range(repeat):
+            time_start = time.perf_counter()
+            envir = Environment(source.dates[-1], 1_000_000, "bench", "csv", data_path=data_path, offline=True)
+            result["build_sec"] = min(result["build_sec"], time.perf_counter() - time_start)
+
+            agent = Agent(envir)
+            date_start = envir.date_max - envir.PERIOD * n_period
+            envir.start(date_start=date_start, date_finish=envir.date_max, cash_start=1_000_000)
+            agent.start(**agent_param)
+
+            period_sec_list = []
+            time_start = time.perf_counter()
+            while True:
+                time_period = time.perf_counter()
+                agent.new_period()
+                period_sec_list.append(time.perf_counter() - time_period)
+                if not envir.new_period():
+                    break
+            result["run_sec"] = min(result["run_sec"], time.perf_counter() - time_start)
+            result["period_sec"] = min(result["period_sec"], float(np.mean(period_sec_list)))
+            result["period_sec_max"] = min(result["period_sec_max"], float(np.max(period_sec_list)))
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+    result["n_period"] = len(period_sec_list)
+    result["peak_mb"] = peak_mb()
+    return result
+
+
+def peak_mb():
+    if resource is None:
+        return float("nan")
+    # ru_maxrss: в Linux - Кб, в macOS - байты
+    scale = 1 / 1024 ** 2 if sys.platform == "darwin" else 1 / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def run(grid="quick", n_period=24, agent_param=None, repeat=3, verbose=False):
+    """
+        Замер всех вариантов сетки. Каждый вариант - в отдельном процессе, чтобы пиковая память
+        и кэши не переходили между вариантами.
+
+    Args:
+        grid:         Имя сетки из GRIDS или словарь n_instr, n_years
+        n_period:     Количество периодов прогона агента
+        agent_param:  Параметры Agent.start
+        repeat:       Количество повторов замера
+        verbose:      Печатать показатели каждого варианта по готовности
+
+    Returns:
+        DataFrame: Показатели по вариантам
+    """
+    grid = GRIDS[grid] if isinstance(grid, str) else grid
+
+    result_list = []
+    for n_years in grid["n_years"]:
+        for n_instr in grid["n_instr"]:
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                result = pool.submit(bench_case, n_instr, n_years, n_period, agent_param, repeat=repeat).result()
+            if verbose:
+                print(result)
+            result_list.append(result)
+    return pd.DataFrame(result_list)
+
+
+def case_key(n_instr, n_years):
+    return "n_instr=%d|n_years=%d" % (n_instr, n_years)
+
+
+def save_baseline(result_df, path=BASELINE_PATH):
+    baseline = {
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__},
+        "cases": {
+            case_key(row["n_instr"], row["n_years"]): {metric: row[metric] for metric in METRICS}
+            for row in result_df.to_dict("records")
+        },
+    }
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2)
+
+
+def check(result_df, path=BASELINE_PATH, tolerance=0.5, min_sec=0.05):
+    """
+        Сравнение замеров с сохранённым базовым уровнем
+
+    Args:
+        result_df:  Результат run
+        path:       Путь к базовому уровню
+        tolerance:  Допустимое относительное ухудшение показателя
+        min_sec:    Показатели времени меньше этой величины не сравниваются (шум замера)
+
+    Returns:
+        DataFrame: Ухудшения сверх допустимого (пустой - регрессий нет)
+
+    Raises:
+        Exc: Нет базового уровня или в нём нет части замеренных вариантов (сравнивать не с чем)
+    """
+    if not os.path.isfile(path):
+        raise Exc("There is no benchmark baseline " + path)
+    with open(path) as file:
+        case_dict = json.load(file)["cases"]
+
+    # Вариант без базового уровня не считается прошедшим проверку - базовый уровень нужно записать (--save)
+    missing_list = [
+        case_key(row["n_instr"], row["n_years"])
+        for row in result_df.to_dict("records")
+        if case_key(row["n_instr"], row["n_years"]) not in case_dict
+    ]
+    if len(missing_list) > 0:
+        raise Exc("There is no benchmark baseline in " + path + " for cases: " + ", ".join(missing_list))
+
+    regress_list = []
+    for row in result_df.to_dict("records"):
+        base = case_dict[case_key(row["n_instr"], row["n_years"])]
+        for metric in METRICS:
+            value, value_base = row[metric], base[metric]
+            if (value_base is None) or np.isnan(value) or np.isnan(value_base):
+                continue
+            if metric.endswith("_sec") and max(value, value_base) < min_sec:
+                continue
+            if value > value_base * (1 + tolerance):
+                regress_list.append(
+                    {
+                        "n_instr": row["n_instr"],
+                        "n_years": row["n_years"],
+                        "metric": metric,
+                        "value": value,
+                        "baseline": value_base,
+                        "ratio": value / value_base,
+                    }
+                )
+    return pd.DataFrame(regress_list, columns=["n_instr", "n_years", "metric", "value", "baseline", "ratio"])
+
+
+def positive_int(text):
+    # Тип аргумента командной строки: целое не меньше 1
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got " + text)
+    return value
+
+
+def main(argv=None):
+    """
+        python -m modeling.bench --grid quick --check     - замер и проверка на регрессию (код возврата 1)
+        python -m modeling.bench --grid quick --save      - замер и сохранение базового уровня
+
+    Код возврата 2 - проверять не с чем (нет базового уровня для замеренных вариантов).
+    """
+    parser = argparse.ArgumentParser(description="Environment/Agent benchmark on synthetic prices")
+    parser.add_argument("--grid", default="quick", choices=sorted(GRIDS))
+    parser.add_argument("--n-period", type=int, default=24)
+    parser.add_argument("--repeat", type=positive_int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--save", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--out", default=None, help="csv for results")
+    parser.add_argument("--verbose", action="store_true", help="print each case when done")
+    args = parser.parse_args(argv)
+
+    result_df = run(args.grid, n_period=args.n_period, repeat=args.repeat, verbose=args.verbose)
+    print(result_df.to_string(index=False))
+    if args.out is not None:
+        result_df.to_csv(args.out, index=False)
+
+    if args.save:
+        save_baseline(result_df, args.baseline)
+    if args.check:
+        try:
+            regress_df = check(result_df, args.baseline, tolerance=args.tolerance)
+        except Exc as exc:
+            print("Benchmark check error: " + str(exc), file=sys.stderr)
+            return 2
+        if regress_df.shape[0] > 0:
+            print("Performance regression:")
+            print(regress_df.to_string(index=False))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
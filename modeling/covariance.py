@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+
+class EwmCov:
+    """
+    Экспоненциально взвешенная ковариация/корреляция дневных ln доходностей инструментов, обновляемая
+    по мере смены периодов среды. Вес дня 0.5**(дней назад/half_life), как в Agent.fit.
+    Хранятся взвешенные суммы по парам инструментов (по дням, когда цены есть у обоих), поэтому
+    обновление обрабатывает только новые дни, а старые суммы лишь умножаются на затухание.
+
+    Подключается к среде: envir.attach(EwmCov()) - далее обновляется в каждом calc_data
+    (для StreamEnvironment - по барам, накопленным с прошлого обновления).
+
+    Attributes:
+        half_life:   Количество календарных дней, за которое вес падает до 0.5
+        n_warm:      Количество дней истории, с которых начинается расчёт при старте или скачке даты
+        code_arr:    Номера инструментов (столбцов матриц цен), по которым ведётся расчёт (None - все)
+        day_ref:     День (с 1970-01-01), к которому приведены веса сумм
+        cut:         Количество строк _dates, уже учтённых в суммах
+        price_last:  Последние известные цены инструментов
+        s0, s1, s2, s11:
+                     Суммы весов, w*x_i, w*x_i**2 (по дням, когда есть x_j) и w*x_i*x_j - матрицы инструмент x инструмент
+        bar_list:    Бары потоковой среды, ещё не учтённые в суммах
+    """
+
+    def __init__(self, half_life=365, n_warm=2 * (248 + 248), code_arr=None):
+        self.half_life = half_life
+        self.n_warm = n_warm
+        self.code_arr = None if code_arr is None else np.asarray(code_arr, dtype=int)
+        self.envir = None
+        self.bar_list = []
+
+    def start(self, envir):
+        """
+            Сброс сумм
+        """
+        self.envir = envir
+        n = len(envir._instr_ids) if self.code_arr is None else len(self.code_arr)
+        self.day_ref = None
+        self.cut = 0
+        self.price_last = np.full(n, np.nan)
+        self.s0 = np.zeros((n, n))
+        self.s1 = np.zeros((n, n))
+        self.s2 = np.zeros((n, n))
+        self.s11 = np.zeros((n, n))
+        self.bar_list = []
+
+    def push(self, date, price_row):
+        # Бар потоковой среды - учитывается при следующем update
+        self.bar_list.append((np.datetime64(date, "D").astype(np.int64), price_row.copy()))
+
+    def update(self, envir):
+        """
+            Учёт новых дней истории среды до её текущей даты
+        """
+        if envir is not self.envir:
+            self.start(envir)
+
+        if len(self.bar_list) > 0:
+            day_arr = np.array([day for day, _ in self.bar_list])
+            price_mat = np.array([price_row for _, price_row in self.bar_list])
+            self.bar_list = []
+        elif hasattr(envir, "_price_mat"):
+            cut = envir._date_cut
+            if (cut < self.cut) or (cut - self.cut > self.n_warm):
+                # Дата ушла назад или вперёд дальше окна прогрева - расчёт заново с прогревом
+                self.start(envir)
+                self.cut = max(cut - self.n_warm, 0)
+            if cut == self.cut:
+                return True
+            day_arr = envir._dates[self.cut : cut].astype("datetime64[D]").astype(np.int64)
+            price_mat = envir._price_mat[self.cut : cut]
+            self.cut = cut
+        else:
+            return True
+
+        if self.code_arr is not None:
+            price_mat = price_mat[:, self.code_arr]
+        self.add(day_arr, price_mat)
+
+        return True
+
+    def add(self, day_arr, price_mat):
+        # ln доходности к последней известной цене; нет цены сегодня или раньше - нет доходности
+        price_fill_mat = pd.DataFrame(np.vstack([self.price_last[None, :], price_mat])).ffill().values
+        self.price_last = price_fill_mat[-1]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ln_profit_mat = np.log(price_fill_mat[1:] / price_fill_mat[:-1])
+        mask_mat = ~np.isnan(price_mat) & ~np.isnan(ln_profit_mat)
+        x_mat = np.where(mask_mat, ln_profit_mat, 0.0)
+        m_mat = mask_mat.astype(float)
+
+        # Приведение накопленных сумм к новой дате отсчёта весов
+        day_max = day_arr[-1]
+        if self.day_ref is not None:
+            factor = 0.5 ** ((day_max - self.day_ref) / self.half_life)
+            self.s0 *= factor
+            self.s1 *= factor
+            self.s2 *= factor
+            self.s11 *= factor
+        self.day_ref = day_max
+
+        weight_arr = 0.5 ** ((day_max - day_arr) / self.half_life)
+        wx_mat = x_mat * weight_arr[:, None]
+        wm_mat = m_mat * weight_arr[:, None]
+        self.s0 += wm_mat.T @ m_mat
+        self.s1 += wx_mat.T @ m_mat
+        self.s2 += (wx_mat * x_mat).T @ m_mat
+        self.s11 += wx_mat.T @ x_mat
+
+    def cov(self):
+        """
+            Ковариационная матрица (nan - нет общих дней у пары инструментов)
+
+        Returns:
+            ndarray: инструмент x инструмент в порядке code_arr (или _instr_ids)
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            s0 = np.where(self.s0 > 0, self.s0, np.nan)
+            return self.s11 / s0 - (self.s1 / s0) * (self.s1.T / s0)
+
+    def corr(self):
+        """
+            Корреляционная матрица по парно общим дням
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            s0 = np.where(self.s0 > 0, self.s0, np.nan)
+            mean_mat = self.s1 / s0
+            var_mat = np.maximum(self.s2 / s0 - mean_mat ** 2, 0.0)
+            corr_mat = (self.s11 / s0 - mean_mat * mean_mat.T) / np.sqrt(var_mat * var_mat.T)
+        return np.clip(corr_mat, -1.0, 1.0)
+
+    def instr_ids(self):
+        return self.envir._instr_ids if self.code_arr is None else self.envir._instr_ids[self.code_arr]
+
+    def cov_df(self):
+        return pd.DataFrame(self.cov(), index=self.instr_ids(), columns=self.instr_ids())
+
+    def corr_df(self):
+        return pd.DataFrame(self.corr(), index=self.instr_ids(), columns=self.instr_ids())
@@ -1,7 +1,14 @@
+import numpy as np
 import pandas as pd
-import yfinance as yf
 from pandas.tseries.offsets import *
 import os
+import hashlib
+import json
+
+from modeling.price_store import PriceStore
+from modeling.mat_store import MatStore, pack_mat
+from modeling.registry import Registry
+from modeling.probe import PROBE_OFF
 
 class Exc(Exception):
     def __init__(self, msg):
@@ -19,9 +26,12 @@ class Environment:
         spr_df:         Справочник инструментов
         _spr_df:        Справочник инструментов полный
         price_df:       Цены инструментов
-        price_hist_df:  Цены инструментов история видимая для агента на определённую дату
+        price_hist_df:  Цены инструментов история видимая для агента на определённую дату (срез _price_hist_df при обращении)
         _price_hist_df: Цены инструментов история полная
-        port_df:        Портфель инструментов
+        port_df:        Портфель инструментов (формируется из _quantity и _port_codes при обращении)
+        _quantity:      Количество инструментов в портфеле в порядке _instr_ids
+        _port_codes:    Номера инструментов, когда-либо купленных в портфель, в порядке первой покупки
+        _port_mask:     Признак наличия записи инструмента в портфеле в порядке _instr_ids
         cash:           Денежные средства
         cash_start:     Денежные средства стартовые
         date_min:       Дата минимальная
@@ -29,44 +39,118 @@ class Environment:
         date:           Дата
         date_start:     Дата стартовая
         date_finish:    Дата стартовая
+        price_store:    Локальное хранилище истории цен
+        mat_store:      Хранилище матриц цен на диске (mmap = True - матрицы открыты через memmap, иначе None)
+        registry:       Реестр инструментов (коды и реквизиты справочника массивами)
+        _instr_ids:     Id инструментов - порядок столбцов матриц цен (совпадает с _spr_df)
+        _dates:         Торговые дни - порядок строк матриц цен
+        _price_mat:     Плотная матрица цен дата x инструмент (nan - нет цены на дату)
+        _hist_cnt:      Количество дней с ценой инструмента накопительно на дату (дата x инструмент)
+        _pack_price:    Цены инструментов, сжатые к началу столбца без пропусков (строка - номер дня истории инструмента)
+        _pack_row:      Номер строки _dates для каждой ячейки _pack_price
+        _pack_day:      День (с 1970-01-01) для каждой ячейки _pack_price
+        _instr_code:    Номер столбца матриц цен по id инструмента
+        _min_sum_arr:   Минимальная сумма покупки в порядке _instr_ids
+        _surcharge_arr: Надбавка при покупке в порядке _instr_ids
+        _discount_arr:  Скидка при продаже в порядке _instr_ids
+        hist_cnt:       Количество дней истории инструментов на дату
+        instr_mask:     Признак наличия истории инструментов на дату
+        price_arr:      Цены инструментов на дату в порядке _instr_ids
+        probe:          Замеры хода моделирования (по умолчанию выключены)
+        engines:        Расчёты, обновляемые при каждом расчёте данных периода (например, covariance.EwmCov)
     """
+
+    probe = PROBE_OFF
+    engines = ()
+    mat_store = None
+
+    # Матрицы цен, только читаемые при работе - могут разделяться между средами и процессами
+    MAT_NAMES = ['_dates', '_price_mat', '_hist_cnt', '_pack_price', '_pack_row', '_pack_day']
+
+    # Только читаемые данные, общие для копий состояния среды (snapshot.Snapshot)
+    SHARED_NAMES = MAT_NAMES + ['_spr_df', 'registry', '_instr_ids', '_instr_code', '_min_sum_arr', '_surcharge_arr',
+                                '_discount_arr', '_price_hist_df', '_hist_date_arr', 'price_store', 'mat_store']
+
+    # Шаг смены периода
+    PERIOD = MonthBegin(n=1)
     
     
-    def __init__(self, date_start, cash_start, type_instr, file_extension): # Данная величина cash устанволена и при первичном закупе у agent. Менять синхорнно
+    def __init__(self, date_start, cash_start, type_instr, file_extension, offline = False, data_path = '3. Data preparation', source = None, mmap = False, ingest = None): # Данная величина cash устанволена и при первичном закупе у agent. Менять синхорнно
         
         self.type_instr = type_instr
 
         #self._spr_df = pd.read_excel(os.path.join('3. Data preparation', self.type_instr, 'spr.xlsx'))
         # self._spr_df = pd.read_parquet(os.path.join('3. Data preparation', self.type_instr, 'spr.parquet'))
-        self._spr_df = pd.read_csv(os.path.join('3. Data preparation', self.type_instr, 'spr.csv'))
-        self._price_hist_df = pd.DataFrame (columns = ['date', 'instr_id', 'price', 'volume'])
-        
-        # Загрузка полной истории цен ниструментов
+        self._spr_df = pd.read_csv(os.path.join(data_path, self.type_instr, 'spr.csv'))
         
-        for index, row in self._spr_df.iterrows():
-            # filename = self._spr_df.loc[index]['manager'] + ' - ' + self._spr_df.loc[index]['instr'] + '.' + file_extension
-
-            # hist_instr_temp_df = pd.read_excel(os.path.join('3. Data preparation', self.type_instr, filename), sheet_name = 0, header = 2)
+        # Загрузка полной истории цен ниструментов из локального хранилища с догрузкой недостающих дат
+        # offline = True - только хранилище, без обращения к сети
+        # ingest - параллельная загрузка недостающих дат (modeling.ingest.Ingest), по умолчанию из source
+        self.price_store = PriceStore(self.type_instr, data_path = data_path, source = source, offline = offline, ingest = ingest)
+
+        if mmap:
+            # Матрицы цен на диске, открытые через memmap - полная история в память не загружается
+            self.price_store.update(list(self._spr_df['instr']))
+            self.mat_store = MatStore(self.price_store)
+            for name, mat in self.mat_store.open(self._spr_df).items():
+                setattr(self, name, mat)
+            self._price_hist_df = None
+            self.build_spr()
+        else:
+            self._price_hist_df = self.price_store.load(list(self._spr_df['instr']))
 
-            hist_instr_temp_df = yf.download(row['instr']) #, start='1990-01-01', end='2022-03-01'
-            hist_instr_temp_df = hist_instr_temp_df.reset_index()
-            hist_instr_temp_df = hist_instr_temp_df.rename(columns = {'Date': 'date', 'Open': 'open', 'High':'high', 'Low':'low', 'Close':'close', 'Adj Close': 'adj_close', 'Volume': 'volume'})
+            # self._price_hist_df['instr_id'] = self._price_hist_df['instr_id'].astype(int)
+            self._price_hist_df['date'] = pd.to_datetime(self._price_hist_df['date'], dayfirst = True)
+            self._price_hist_df['price'] = self._price_hist_df['close']
 
-            hist_instr_temp_df['instr_id'] = row['instr']
-            #self._price_hist_df = self._price_hist_df.append(hist_instr_temp_df, ignore_index=True)
-            self._price_hist_df = pd.concat([self._price_hist_df, hist_instr_temp_df])
-        # self._price_hist_df['instr_id'] = self._price_hist_df['instr_id'].astype(int)
-        self._price_hist_df['date'] = pd.to_datetime(self._price_hist_df['date'], dayfirst = True)
-        self._price_hist_df['price'] = self._price_hist_df['close']
+            self.build_mat()
 
-        #Установка дат
-        self.date_min = min(self._price_hist_df['date'])# + MonthBegin(n=0)
-        self.date_max = max(self._price_hist_df['date'])# + MonthBegin(n=1) - MonthBegin(n=1)
+        self.set_dates()
 
         self.start(date_start = date_start, cash_start = cash_start)
 
         return
 
+
+    @classmethod
+    def from_mat(cls, type_instr, spr_df, mat_dict, date_start, cash_start):
+        """
+            Создание среды из готовых матриц цен (например, из разделяемой памяти) без загрузки истории.
+
+        Args:
+            type_instr:     Тип инсрумента инвестиций
+            spr_df:         Справочник инструментов полный (порядок строк - порядок столбцов матриц)
+            mat_dict:       Матрицы цен по именам из MAT_NAMES
+            date_start:     Дата стартовая
+            cash_start:     Денежные средства стартовые
+
+        Returns:
+            Environment
+        """
+        envir = cls.__new__(cls)
+        envir.type_instr = type_instr
+        envir._spr_df = spr_df
+        envir.price_store = None
+        envir._price_hist_df = None
+        for name in cls.MAT_NAMES:
+            setattr(envir, name, mat_dict[name])
+        envir.build_spr()
+        envir.set_dates()
+
+        envir.start(date_start = date_start, date_finish = envir.date_max, cash_start = cash_start)
+
+        return envir
+
+
+    def mat_dict(self):
+        return {name: getattr(self, name) for name in self.MAT_NAMES}
+
+
+    def set_dates(self):
+        #Установка дат
+        self.date_min = pd.Timestamp(self._dates[0])# + MonthBegin(n=0)
+        self.date_max = pd.Timestamp(self._dates[-1])# + MonthBegin(n=1) - MonthBegin(n=1)
+
     
     def start(self, date_start = pd.to_datetime('2010-01-01'), date_finish = pd.to_datetime('2020-01-01'), cash_start = 1_000_000):
         """
@@ -101,7 +185,9 @@ class Environment:
         self.cash = self.cash_start
         self.date = date
 
-        self.port_df = pd.DataFrame (columns = ['instr_id', 'quantity'])
+        self._quantity = np.zeros(len(self._instr_ids))
+        self._port_codes = []
+        self._port_mask = np.zeros(len(self._instr_ids), dtype = bool)
         
         self.calc_data()
 
@@ -120,15 +206,43 @@ class Environment:
         Raises:
 
         """
-        if (self.date + MonthBegin(n=1) > self.date_finish):
+        if (self.date + self.PERIOD > self.date_finish):
             return False
         else:
-            self.date = self.date + MonthBegin(n=1)
+            self.date = self.date + self.PERIOD
             self.calc_data()
             # print('    new_period:', self.date)
             return True
     
     
+    @classmethod
+    def period_dates(cls, date_start, date_finish):
+        """
+            Даты периодов, которые пройдёт среда от date_start до date_finish (как в new_period)
+        """
+        date_list = [date_start]
+        while date_list[-1] + cls.PERIOD <= date_finish:
+            date_list.append(date_list[-1] + cls.PERIOD)
+        return date_list
+
+
+    def bars(self, date_start = None, date_finish = None):
+        """
+            Поток баров из загруженной истории - источник для StreamEnvironment
+
+        Args:
+            date_start:     Дата первого бара (None - с начала истории)
+            date_finish:    Дата последнего бара (None - до конца истории)
+
+        Returns:
+            Генератор (date, price_arr): цены торгового дня в порядке _instr_ids (nan - нет цены)
+        """
+        row_from = 0 if date_start is None else np.searchsorted(self._dates, np.datetime64(date_start, 'ns'), side = 'left')
+        row_to = len(self._dates) if date_finish is None else np.searchsorted(self._dates, np.datetime64(date_finish, 'ns'), side = 'right')
+        for row in range(row_from, row_to):
+            yield pd.Timestamp(self._dates[row]), self._price_mat[row]
+
+
     def calc_data(self):
         """
             Рассчёт данных для периода
@@ -141,13 +255,160 @@ class Environment:
         Raises:
         """
 
-        self.price_hist_df = self._price_hist_df[(self._price_hist_df['date'] <= self.date)]
-        self.price_df = pd.merge(self.price_hist_df.groupby(['instr_id'], as_index = False)['date'].max(), self._price_hist_df, on = ['instr_id', 'date'])[['instr_id', 'price']]
-        self.spr_df = self._spr_df[self._spr_df['instr_id'].isin(self.price_hist_df['instr_id'].unique()) == True]
+        with self.probe.phase('calc_data') as phase:
+            # Срезы по дате бинарным поиском вместо фильтрации всей истории
+            date = np.datetime64(self.date, 'ns')
+            self._date_cut = np.searchsorted(self._dates, date, side = 'right')
+
+            if self._date_cut > 0:
+                self.hist_cnt = self._hist_cnt[self._date_cut - 1]
+            else:
+                self.hist_cnt = np.zeros(len(self._instr_ids), dtype = np.int32)
+            self.instr_mask = self.hist_cnt > 0
+
+            # Последняя известная цена - последняя строка сжатой истории инструмента.
+            # Читаются только инструменты с историей на дату (для memmap - только их страницы)
+            code_arr = np.flatnonzero(self.instr_mask)
+            self.price_arr = np.full(len(self._instr_ids), np.nan)
+            self.price_arr[code_arr] = self._pack_price[self.hist_cnt[code_arr] - 1, code_arr]
+
+            self.price_df = pd.DataFrame({'instr_id': self._instr_ids[self.instr_mask], 'price': self.price_arr[self.instr_mask]})
+            self.spr_df = self._spr_df[self.instr_mask]
+            phase.rows = len(self.price_df)
+
+        self.update_engines()
         
         return True
+
+
+    def attach(self, engine):
+        """
+            Подключение расчёта, обновляемого при смене периода (методы start(envir) и update(envir))
+        """
+        self.engines = list(self.engines) + [engine]
+        engine.start(self)
+        engine.update(self)
+
+        return engine
+
+
+    def update_engines(self):
+        for engine in self.engines:
+            with self.probe.phase(type(engine).__name__):
+                engine.update(self)
     
     
+    @property
+    def price_hist_df(self):
+        if self.mat_store is not None:
+            return self.hist_view()
+        if self._price_hist_df is None:
+            self.build_hist_df()
+        row_cut = np.searchsorted(self._hist_date_arr, np.datetime64(self.date, 'ns'), side = 'right')
+        return self._price_hist_df.iloc[:row_cut]
+
+
+    def build_hist_df(self):
+        """
+            Построение полной истории цен (date, instr_id, price) из матрицы цен, если среда создана без неё
+        """
+        row_arr, col_arr = np.nonzero(~np.isnan(self._price_mat))
+        self._price_hist_df = pd.DataFrame({'date': self._dates[row_arr], 'instr_id': self._instr_ids[col_arr], 'price': self._price_mat[row_arr, col_arr]})
+        self._hist_date_arr = self._price_hist_df['date'].values.astype('datetime64[ns]')
+
+        return True
+
+
+    def hist_view(self):
+        """
+            История цен на дату только инструментов текущего spr_df - из их столбцов сжатой истории
+            (для матриц memmap читаются только эти столбцы). Запоминается до смены даты.
+        """
+        hist_view = getattr(self, '_hist_view', None)
+        if (hist_view is not None) and (hist_view[0] == self.date):
+            return hist_view[1]
+
+        code_arr = np.flatnonzero(self.instr_mask)
+        cnt_arr = self.hist_cnt[code_arr]
+        row_arr = np.concatenate([np.zeros(0, dtype = np.int32)] + [self._pack_row[:cnt, code] for code, cnt in zip(code_arr, cnt_arr)])
+        price_arr = np.concatenate([np.zeros(0)] + [self._pack_price[:cnt, code] for code, cnt in zip(code_arr, cnt_arr)])
+        col_arr = np.repeat(code_arr, cnt_arr)
+
+        # Порядок как в build_hist_df: по дате, затем по столбцу
+        order_arr = np.lexsort((col_arr, row_arr))
+        hist_df = pd.DataFrame({'date': np.asarray(self._dates)[row_arr[order_arr]], 'instr_id': self._instr_ids[col_arr[order_arr]], 'price': price_arr[order_arr]})
+        self._hist_view = (self.date, hist_df)
+
+        return hist_df
+
+
+    def data_version(self):
+        """
+            Версия данных среды - короткий хэш истории цен (ключ кэшей, рассчитанных по истории).
+            Считается 1 раз; для матриц memmap - по версии хранилища матриц, без чтения матриц.
+        """
+        if getattr(self, '_data_version', None) is None:
+            digest = hashlib.blake2b(digest_size = 8)
+            if self.mat_store is not None:
+                digest.update(json.dumps(self.mat_store.version(self._spr_df)).encode())
+            else:
+                digest.update(str(list(self._instr_ids)).encode())
+                for name in ['_dates', '_pack_price']:
+                    digest.update(np.ascontiguousarray(getattr(self, name)).view(np.uint8).data)
+            self._data_version = digest.hexdigest()
+
+        return self._data_version
+
+
+    def build_spr(self):
+        """
+            Массивы справочника инструментов в порядке столбцов матриц цен
+        """
+        self.registry = Registry(self._spr_df)
+        self._instr_ids = self.registry.instr_ids
+        self._instr_code = self.registry.instr_code
+        self._min_sum_arr = self.registry.min_sum
+        self._surcharge_arr = self.registry.surcharge
+        self._discount_arr = self.registry.discount
+
+        return True
+
+
+    def build_mat(self):
+        """
+            Построение плотной матрицы цен дата x инструмент и производных от неё индексов.
+            Выполняется 1 раз при загрузке, далее период - это только срез по дате.
+        """
+
+        # Строки без цены (nan close) отбрасываются 1 раз при загрузке - история на дату, матрицы и сжатая история
+        # содержат одни и те же строки (расчёт full и batch по ним совпадает)
+        self._price_hist_df = self._price_hist_df[self._price_hist_df['price'].notna()]
+
+        # История сортируется по дате, чтобы история на дату была срезом первых строк
+        self._price_hist_df = self._price_hist_df.sort_values(by = ['date', 'instr_id'], kind = 'stable').reset_index(drop = True)
+        self._hist_date_arr = self._price_hist_df['date'].values.astype('datetime64[ns]')
+
+        self.build_spr()
+        self._dates = np.unique(self._hist_date_arr)
+
+        row_arr = np.searchsorted(self._dates, self._hist_date_arr)
+        col_arr = pd.Index(self._instr_ids).get_indexer(self._price_hist_df['instr_id'])
+        price_arr = self._price_hist_df['price'].values.astype(float)
+        keep_arr = col_arr >= 0
+
+        self._price_mat = np.full((len(self._dates), len(self._instr_ids)), np.nan)
+        self._price_mat[row_arr[keep_arr], col_arr[keep_arr]] = price_arr[keep_arr]
+
+        self._hist_cnt, self._pack_price, self._pack_row, self._pack_day = pack_mat(self._price_mat, self._dates)
+
+        return True
+
+
+    @property
+    def port_df(self):
+        return pd.DataFrame({'instr_id': self._instr_ids[self._port_codes], 'quantity': self._quantity[self._port_codes]})
+
+
     def buy(self, instr_id, value):
         """
             Осуществление покупки инструмента в портфель.
@@ -171,42 +432,7 @@ class Environment:
                 Value _ is more than balance of cash _
         """
 
-        # Получение справочной информации по инструменту
-        spr_instr_temp_df = self.spr_df[self.spr_df['instr_id'] == instr_id]
-        if (spr_instr_temp_df.shape[0] == 0):
-            raise Exc('There is no such instr ' + str(instr_id) + ' in spr')
-        spr_instr = spr_instr_temp_df.iloc[0]
-        
-        # Порверка, что сумма покупки не меньше минимальной в приведёной стоимости
-        if (value < spr_instr.min_sum):
-            raise Exc('Value ' + str(value) + ' is less than the minimum sum ' + str(spr_instr.min_sum))
-
-        # Получение текущей цены по инструменту
-        price_temp_df = self.price_df[(self.price_df['instr_id'] == instr_id)]
-        if (price_temp_df.shape[0] == 0):
-            raise Exc('There is no such instr ' + str(instr_id) + ' in price')
-        price_se = price_temp_df.iloc[0]
-        
-        # Получение портфельной записи по инструменту
-        port_temp_df = self.port_df[self.port_df['instr_id'] == instr_id]
-        if (port_temp_df.shape[0] == 0):
-            self.port_df = pd.concat([self.port_df, pd.DataFrame.from_dict([{'instr_id': instr_id, 'quantity': 0}])])
-            port_temp_df = self.port_df[self.port_df['instr_id'] == instr_id]
-            
-        port_se = port_temp_df.iloc[0]
-
-        # Вычисление количетсва инструментов на приобретение
-        instr_quantity = value / (price_se['price'] * (1 + spr_instr.surcharge))
-
-        # Проверка остатка на балансе кэша
-        if (value - self.cash  > 1e-9):
-            raise Exc('Value ' + str(value) + ' is more than balance of cash ' + str(self.cash) + '. Difference: ' + str(value - self.cash))
-            
-        # Покупка
-        self.cash = self.cash - value
-        self.port_df.loc[port_se.name, 'quantity'] = port_se['quantity'] + instr_quantity
-
-        return True
+        return self.execute([('buy', instr_id, value)])
     
     
     def sell(self, instr_id, value):
@@ -232,35 +458,93 @@ class Environment:
                 Value _ is more than balance of instr _
         """
 
-        # Получение справочной информации по инструменту
-        spr_instr_temp_df = self.spr_df[self.spr_df['instr_id'] == instr_id]
-        if (spr_instr_temp_df.shape[0] == 0):
-            raise Exc('There is no such instr ' + str(instr_id) + ' in spr')
-        spr_instr = spr_instr_temp_df.iloc[0]
-        
-        # Получение текущей цены по инструменту
-        price_temp_df = self.price_df[(self.price_df['instr_id'] == instr_id)]
-        if (price_temp_df.shape[0] == 0):
-            raise Exc('There is no such instr ' + str(instr_id) + ' in price')
-        price_se = price_temp_df.iloc[0]
-
-        # Получение портфельной записи по инструменту
-        port_temp_df = self.port_df[self.port_df['instr_id'] == instr_id]
-        if (port_temp_df.shape[0] == 0):
-            raise Exc('There is no such instr ' + str(instr_id) + ' in port')
-        port_se = port_temp_df.iloc[0]
-            
-        #Вычисление количетсва инструментов на продажу
-        instr_quantity = value / (price_se['price'] * (1 - spr_instr.discount))
-            
-        # Проверка остатка на балансе инструмента
-        #if (value > (port_se['quantity'] * price_se['price'] * (1 - spr_instr.discount))):
-        #    raise Exc('Value ' + str(value) + ' is more than balance of instr ' + str(port_se['quantity'] * (price_se['price'] * (1 - spr_instr.discount))) + '. Difference: ' + str(value - (port_se['quantity'] * (price_se['price'] * (1 - spr_instr.discount)))))
-        if (instr_quantity - port_se['quantity'] > 1e-9):
-            raise Exc('Value ' + str(value) + ' is more than balance of instr ' + str(port_se['quantity'] * (price_se['price'] * (1 - spr_instr.discount))) + '. Difference: ' + str(value - (port_se['quantity'] * (price_se['price'] * (1 - spr_instr.discount)))))
-
-        # Продажа
-        self.port_df.set_value(port_se.name, 'quantity',  port_se['quantity'] - instr_quantity)
-        self.cash = self.cash + value
-
-        return True
\ No newline at end of file
+        return self.execute([('sell', instr_id, value)])
+
+
+    def execute(self, orders):
+        """
+            Пакетное исполнение заявок на покупку и продажу инструментов.
+            Заявки проверяются по порядку с теми же условиями, что и в buy/sell, с учётом предыдущих заявок пакета.
+            Если хотя бы одна заявка не проходит проверку, то ни одна заявка пакета не исполняется.
+
+        Args:
+            orders: 
+                Список заявок (action, instr_id, value), где action - 'buy' или 'sell',
+                value - приведёная стоимость заявки (как в buy/sell).
+
+        Returns:
+            True: Если всё отработало правильно
+
+        Raises:
+            IOError: 
+                Unknown action _
+                и ошибки buy/sell
+        """
+
+        with self.probe.phase('execute') as phase:
+            phase.rows = len(orders)
+
+            cash = self.cash
+            quantity_dict = {}     # Изменённые количества инструментов: код -> количество
+            port_new_codes = []    # Инструменты, впервые попадающие в портфель
+
+            for action, instr_id, value in orders:
+
+                # Получение справочной информации по инструменту
+                code = self._instr_code.get(instr_id)
+                if (code is None) or (not self.instr_mask[code]):
+                    raise Exc('There is no such instr ' + str(instr_id) + ' in spr')
+
+                # Получение текущей цены по инструменту
+                price = self.price_arr[code]
+                if np.isnan(price):
+                    raise Exc('There is no such instr ' + str(instr_id) + ' in price')
+
+                quantity = quantity_dict.get(code, self._quantity[code])
+
+                if action == 'buy':
+                    # Порверка, что сумма покупки не меньше минимальной в приведёной стоимости
+                    if (value < self._min_sum_arr[code]):
+                        raise Exc('Value ' + str(value) + ' is less than the minimum sum ' + str(self._min_sum_arr[code]))
+
+                    # Вычисление количетсва инструментов на приобретение
+                    instr_quantity = value / (price * (1 + self._surcharge_arr[code]))
+
+                    # Проверка остатка на балансе кэша
+                    if (value - cash  > 1e-9):
+                        raise Exc('Value ' + str(value) + ' is more than balance of cash ' + str(cash) + '. Difference: ' + str(value - cash))
+
+                    # Покупка
+                    if (not self._port_mask[code]) and (code not in port_new_codes):
+                        port_new_codes.append(code)
+                    cash = cash - value
+                    quantity_dict[code] = quantity + instr_quantity
+
+                elif action == 'sell':
+                    # Получение портфельной записи по инструменту
+                    if (not self._port_mask[code]) and (code not in port_new_codes):
+                        raise Exc('There is no such instr ' + str(instr_id) + ' in port')
+
+                    #Вычисление количетсва инструментов на продажу
+                    price_sell = price * (1 - self._discount_arr[code])
+                    instr_quantity = value / price_sell
+
+                    # Проверка остатка на балансе инструмента
+                    if (instr_quantity - quantity > 1e-9):
+                        raise Exc('Value ' + str(value) + ' is more than balance of instr ' + str(quantity * price_sell) + '. Difference: ' + str(value - quantity * price_sell))
+
+                    # Продажа
+                    quantity_dict[code] = quantity - instr_quantity
+                    cash = cash + value
+
+                else:
+                    raise Exc('Unknown action ' + str(action))
+
+            # Применение пакета
+            for code, quantity in quantity_dict.items():
+                self._quantity[code] = quantity
+            self._port_codes.extend(port_new_codes)
+            self._port_mask[port_new_codes] = True
+            self.cash = cash
+
+        return True
@@ -0,0 +1,178 @@
+import numpy as np
+
+
+class EwmState:
+    """
+    Состояние оценки по инструменту
+
+    Attributes:
+        lo:       Номер первого дня истории инструмента в окне
+        hi:       Номер последнего дня истории инструмента в окне (для него уже известна цена через горизонт)
+        day_max:  День (с 1970-01-01), к которому приведены веса
+        s0:       Сумма весов
+        s1:       Сумма весов * ln(доходности)
+        s2:       Сумма весов * ln(доходности)**2
+        c1:       Сумма ln(доходности) без весов (для среднегеометрической)
+    """
+
+    def __init__(self, lo, day_max):
+        self.lo = lo
+        self.hi = lo - 1
+        self.day_max = day_max
+        self.s0 = 0.0
+        self.s1 = 0.0
+        self.s2 = 0.0
+        self.c1 = 0.0
+
+
+class EwmEstimator:
+    """
+    Инкрементальный расчёт средней доходности и волатильности инструментов с весами 0.5**(дней назад/half_life).
+    Даёт те же profit_mean, profit_std что и Agent.preprocess/fit/predict, но хранит накопленные суммы по инструменту
+    и на каждом периоде обрабатывает только новые дни (и выпавшие из окна), а не всё окно.
+
+    Attributes:
+        horizon_days:  Горизонт прогнозирования рабочих дней
+        hist_days:     Максимальная глубина окна в днях истории инструмента
+        half_life:     Количество календарных дней, за которое вес падает до 0.5
+        state_dict:    Состояния по инструментам
+    """
+
+    def __init__(self, horizon_days, hist_days, half_life=365):
+        self.horizon_days = horizon_days
+        self.hist_days = hist_days
+        self.half_life = half_life
+        self.state_dict = {}
+
+    def update(self, key, n, price_col, day_col):
+        """
+            Обновление оценки инструмента по его истории
+
+        Args:
+            key:        Id инструмента
+            n:          Количество дней истории инструмента, видимых на дату
+            price_col:  Цены инструмента по дням истории (не короче n)
+            day_col:    Дни (с 1970-01-01) по дням истории инструмента (не короче n)
+
+        Returns:
+            profit_mean, profit_std
+        """
+        hi = n - 1 - self.horizon_days
+        lo = max(0, n - 1 - self.hist_days)
+        if hi < lo:
+            # Как и при пустой выборке в fit/predict
+            self.state_dict.pop(key, None)
+            return 1.0, 1.0
+
+        day_max = day_col[hi]
+
+        state = self.state_dict.get(key)
+        if state is None or hi < state.hi or lo < state.lo or lo > state.hi:
+            # Нет состояния, история сдвинулась назад или окно обновилось целиком - расчёт с нуля
+            state = EwmState(lo, day_max)
+            self.state_dict[key] = state
+
+        # Приведение накопленных сумм к новой дате отсчёта весов
+        if day_max != state.day_max:
+            factor = 0.5 ** ((day_max - state.day_max) / self.half_life)
+            state.s0 *= factor
+            state.s1 *= factor
+            state.s2 *= factor
+            state.day_max = day_max
+
+        if hi > state.hi:
+            self._add(state, price_col, day_col, state.hi + 1, hi + 1, 1)
+        if lo > state.lo:
+            self._add(state, price_col, day_col, state.lo, lo, -1)
+        state.lo = lo
+        state.hi = hi
+
+        return self.predict(state)
+
+    def _add(self, state, price_col, day_col, i_from, i_to, sign):
+        # Добавление (sign=1) или исключение (sign=-1) дней истории [i_from, i_to)
+        ln_profit = np.log(
+            price_col[i_from + self.horizon_days : i_to + self.horizon_days] / price_col[i_from:i_to]
+        )
+        weight = 0.5 ** ((state.day_max - day_col[i_from:i_to]) / self.half_life)
+        state.s0 += sign * weight.sum()
+        state.s1 += sign * (weight * ln_profit).sum()
+        state.s2 += sign * (weight * ln_profit ** 2).sum()
+        state.c1 += sign * ln_profit.sum()
+
+    def predict(self, state):
+        # ln_dif = ln(profit) - ln(gmean); sum(weight_rel * ln_dif**2) раскрывается через накопленные суммы
+        ln_gmean = state.c1 / (state.hi - state.lo + 1)
+        ln_mean = state.s1 / state.s0
+        ln_var = state.s2 / state.s0 - 2 * ln_gmean * ln_mean + ln_gmean ** 2
+
+        profit_mean = np.exp(ln_mean)
+        profit_std = np.exp(max(ln_var, 0.0) ** 0.5)
+        return profit_mean, profit_std
+
+
+def ewm_batch(
+    hist_cnt_arr, pack_price, pack_day, code_arr, horizon_days, hist_days, half_life=365, chunk=512, profit_pack=None
+):
+    """
+        Расчёт средней доходности и волатильности сразу для группы инструментов (2-D проход по окнам истории).
+        Результат совпадает с Agent.preprocess/fit/predict и EwmEstimator.update.
+
+    Args:
+        hist_cnt_arr:  Количество дней истории инструментов на дату
+        pack_price:    Цены, сжатые к началу столбца (Environment._pack_price) или их кольцевой буфер
+        pack_day:      Дни (с 1970-01-01) сжатых цен (Environment._pack_day)
+        code_arr:      Номера столбцов инструментов
+        horizon_days:  Горизонт прогнозирования рабочих дней
+        hist_days:     Максимальная глубина окна в днях истории инструмента
+        half_life:     Количество календарных дней, за которое вес падает до 0.5
+        chunk:         Количество инструментов, обрабатываемых за 1 проход (ограничение памяти)
+        profit_pack:   Готовая доходность на горизонт по сжатой истории (profit_cache.profit_table),
+                       None - расчёт по ценам
+
+    Returns:
+        profit_mean_arr, profit_std_arr
+    """
+    profit_mean_arr = np.ones(len(code_arr))
+    profit_std_arr = np.ones(len(code_arr))
+
+    rows = hist_days + 1 - horizon_days  # Строк окна, для которых известна цена через горизонт
+    if rows <= 0:
+        return profit_mean_arr, profit_std_arr
+
+    win_arr = np.arange(hist_days + 1)[:, None]
+    for start in range(0, len(code_arr), chunk):
+        code_chunk_arr = code_arr[start : start + chunk]
+
+        # Строка r окна - день истории инструмента n - 1 - hist_days + r
+        index_mat = hist_cnt_arr[start : start + chunk][None, :] - 1 - hist_days + win_arr
+        valid_mat = index_mat[:rows] >= 0
+        # Остаток от деления - для кольцевого буфера истории (StreamEnvironment), для полной истории индекс не меняется
+        index_mat = np.maximum(index_mat, 0) % len(pack_price)
+
+        day_mat = pack_day[index_mat, code_chunk_arr]
+        if profit_pack is None:
+            price_mat = pack_price[index_mat, code_chunk_arr]
+            profit_mat = price_mat[horizon_days:] / price_mat[:rows]
+        else:
+            profit_mat = profit_pack[index_mat[:rows], code_chunk_arr]
+
+        ln_profit_mat = np.where(valid_mat, np.log(profit_mat), 0.0)
+        weight_mat = np.where(valid_mat, 0.5 ** ((day_mat[rows - 1] - day_mat[:rows]) / half_life), 0.0)
+
+        cnt_arr = valid_mat.sum(axis=0)
+        s0_arr = weight_mat.sum(axis=0)
+        s1_arr = (weight_mat * ln_profit_mat).sum(axis=0)
+        s2_arr = (weight_mat * ln_profit_mat ** 2).sum(axis=0)
+        c1_arr = ln_profit_mat.sum(axis=0)
+
+        fill_arr = cnt_arr > 0
+        s0_arr = np.where(fill_arr, s0_arr, 1.0)
+        ln_gmean_arr = c1_arr / np.maximum(cnt_arr, 1)
+        ln_mean_arr = s1_arr / s0_arr
+        ln_var_arr = s2_arr / s0_arr - 2 * ln_gmean_arr * ln_mean_arr + ln_gmean_arr ** 2
+
+        profit_mean_arr[start : start + chunk] = np.where(fill_arr, np.exp(ln_mean_arr), 1.0)
+        profit_std_arr[start : start + chunk] = np.where(fill_arr, np.exp(np.maximum(ln_var_arr, 0.0) ** 0.5), 1.0)
+
+    return profit_mean_arr, profit_std_arr
@@ -0,0 +1,133 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class Source(ABC):
+    """
+    Источник истории цен - интерфейс (price_store.SourceYf, bench.SourceRandom или тестовая подмена).
+    fetch вызывается из нескольких потоков одновременно.
+    """
+
+    @abstractmethod
+    def fetch(self, instr, start=None, end=None):
+        """
+            Загрузка истории цен инструмента
+
+        Args:
+            instr:  Тикер инструмента
+            start:  Дата, начиная с которой нужна история (None - вся история)
+            end:    Дата, раньше которой нужна история (не включительно, None - до последнего бара)
+
+        Returns:
+            DataFrame: История цен с полями date, open, high, low, close, adj_close, volume
+        """
+
+
+class RateLimit:
+    """
+    Ограничение частоты обращений к источнику: не больше rate запросов в секунду на все потоки
+
+    Attributes:
+        interval:   Минимальный интервал между началами запросов в секундах
+        time_next:  Время, раньше которого не начинается следующий запрос
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 0.0 if not rate else 1.0 / rate
+        self.time_next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            time_now = time.monotonic()
+            time_start = max(time_now, self.time_next)
+            self.time_next = time_start + self.interval
+        if time_start > time_now:
+            time.sleep(time_start - time_now)
+
+
+class Ingest:
+    """
+    Параллельная загрузка истории цен многих инструментов: пул потоков, ограничение частоты запросов,
+    повтор неудачных запросов с растущей паузой. Ошибка по инструменту не прерывает загрузку остальных -
+    неудачи собираются в fail_df.
+
+    Attributes:
+        source:     Источник истории цен (Source)
+        n_thread:   Количество одновременных запросов
+        rate:       Ограничение запросов в секунду (None - без ограничения)
+        retry:      Количество повторов неудачного запроса
+        backoff:    Пауза перед первым повтором в секундах (далее удваивается)
+        fail_df:    Неудачи последней загрузки: instr, start, attempts, error
+
+    Example:
+        ingest = Ingest(SourceYf(), n_thread=16, rate=5, retry=3)
+        hist_df = ingest.run({'SPY': None, 'QQQ': pd.Timestamp('2021-01-04')})
+    """
+
+    def __init__(self, source, n_thread=8, rate=None, retry=3, backoff=0.5):
+        self.source = source
+        self.n_thread = n_thread
+        self.rate = rate
+        self.retry = retry
+        self.backoff = backoff
+        self.fail_df = pd.DataFrame(columns=["instr", "start", "attempts", "error"])
+
+    def fetch(self, rate_limit, instr, start, end=None):
+        # Загрузка 1 инструмента с повторами: (история или None, количество попыток, последняя ошибка)
+        error = None
+        for attempt in range(self.retry + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            rate_limit.wait()
+            try:
+                return self.source.fetch(instr, start=start, end=end), attempt + 1, None
+            except Exception as exc:
+                error = exc
+        return None, self.retry + 1, error
+
+    def run(self, missing_dict, end=None):
+        """
+            Загрузка истории инструментов
+
+        Args:
+            missing_dict:  instr -> дата начала загрузки (None - вся история), как PriceStore.missing
+            end:           Дата, раньше которой нужна история (не включительно, None - до последнего бара)
+
+        Returns:
+            DataFrame: История цен загруженных инструментов с полем instr_id (1 объединение в конце)
+        """
+        rate_limit = RateLimit(self.rate)
+        with ThreadPoolExecutor(max_workers=max(1, self.n_thread)) as pool:
+            future_dict = {
+                instr: pool.submit(self.fetch, rate_limit, instr, start, end) for instr, start in missing_dict.items()
+            }
+
+        hist_list, fail_list = [], []
+        for instr, future in future_dict.items():
+            hist_instr_temp_df, attempts, error = future.result()
+            if error is not None:
+                fail_list.append(
+                    {"instr": instr, "start": missing_dict[instr], "attempts": attempts, "error": repr(error)}
+                )
+                continue
+            if hist_instr_temp_df.shape[0] == 0:
+                continue
+            hist_list.append(hist_instr_temp_df.assign(instr_id=instr))
+        self.fail_df = pd.DataFrame(fail_list, columns=["instr", "start", "attempts", "error"])
+
+        if len(hist_list) == 0:
+            return pd.DataFrame(columns=["date", "instr_id"])
+        return pd.concat(hist_list, ignore_index=True)
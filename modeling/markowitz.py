@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def random_weights(n_asset, n_portf, rng=None):
+    """
+        Случайные веса портфелей (как rand_weights в Markowitz portfolio random.ipynb), сразу матрицей
+
+    Returns:
+        ndarray: n_portf x n_asset, сумма по строке - 1
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    weight_mat = rng.random((n_portf, n_asset))
+    return weight_mat / weight_mat.sum(axis=1, keepdims=True)
+
+
+def portfolio_stats(weight_mat, mean_arr, cov_mat):
+    """
+        Доходность и риск портфелей: w * p.T и sqrt(w * C * w.T) для всех строк weight_mat одним умножением матриц
+
+    Returns:
+        ret_arr, risk_arr
+    """
+    ret_arr = weight_mat @ mean_arr
+    risk_arr = np.sqrt(np.maximum(np.einsum("ij,ij->i", weight_mat @ cov_mat, weight_mat), 0.0))
+    return ret_arr, risk_arr
+
+
+def random_portfolios(mean_arr, cov_mat, n_portf=1_000_000, rng=None, chunk=100_000):
+    """
+        Оценка большого количества случайных портфелей частями по chunk строк (ограничение памяти)
+
+    Returns:
+        ret_arr, risk_arr, weight_best_arr (веса портфеля с максимальным ret/risk)
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    ret_list, risk_list = [], []
+    sharpe_best, weight_best_arr = -np.inf, None
+    for start in range(0, n_portf, chunk):
+        weight_mat = random_weights(len(mean_arr), min(chunk, n_portf - start), rng)
+        ret_arr, risk_arr = portfolio_stats(weight_mat, mean_arr, cov_mat)
+        sharpe_arr = ret_arr / np.where(risk_arr > 0, risk_arr, np.nan)
+        if np.isfinite(sharpe_arr).any() and np.nanmax(sharpe_arr) > sharpe_best:
+            sharpe_best = np.nanmax(sharpe_arr)
+            weight_best_arr = weight_mat[np.nanargmax(sharpe_arr)]
+        ret_list.append(ret_arr)
+        risk_list.append(risk_arr)
+    return np.concatenate(ret_list), np.concatenate(risk_list), weight_best_arr
+
+
+def solve_qp(mu, cov_mat, mean_arr, weight_arr=None, ridge=1e-12, max_iter=None):
+    """
+        Портфель эффективной границы: min mu * w'Cw - p'w при w >= 0, sum(w) = 1
+        (та же задача, что solvers.qp(mu*S, -pbar, G, h, A, b) в ноутбуках).
+        Решается прямым методом активных ограничений: на каждой итерации - система ККТ
+        по инструментам с ненулевыми весами. Запуск от решения соседней точки границы
+        (weight_arr) сходится за несколько итераций.
+
+    Args:
+        mu:          Вес риска
+        cov_mat:     Ковариационная матрица
+        mean_arr:    Ожидаемые доходности
+        weight_arr:  Допустимое начальное решение (None - весь вес на инструменте с максимальной доходностью)
+        ridge:       Регуляризация системы ККТ (вырожденная ковариация)
+
+    Returns:
+        ndarray: Веса
+    """
+    n = len(mean_arr)
+    if weight_arr is None:
+        weight_arr = np.zeros(n)
+        weight_arr[np.argmax(mean_arr)] = 1.0
+    weight_arr = weight_arr.copy()
+    max_iter = 10 * n + 10 if max_iter is None else max_iter
+
+    quad_mat = 2 * mu * cov_mat
+    support = weight_arr > 0
+    for _ in range(max_iter):
+        # Решение задачи с ограничением-равенством на текущем носителе
+        index_arr = np.flatnonzero(support)
+        k = len(index_arr)
+        kkt_mat = np.zeros((k + 1, k + 1))
+        kkt_mat[:k, :k] = quad_mat[np.ix_(index_arr, index_arr)] + ridge * np.eye(k)
+        kkt_mat[:k, k] = 1.0
+        kkt_mat[k, :k] = 1.0
+        rhs_arr = np.append(mean_arr[index_arr], 1.0)
+        try:
+            sol_arr = np.linalg.solve(kkt_mat, rhs_arr)
+        except np.linalg.LinAlgError:
+            sol_arr = np.linalg.lstsq(kkt_mat, rhs_arr, rcond=None)[0]
+        weight_new_arr = sol_arr[:k]
+
+        if (weight_new_arr < -1e-12).any():
+            # Шаг к решению до первого обнуления веса, инструмент выходит из носителя
+            dir_arr = weight_new_arr - weight_arr[index_arr]
+            neg_arr = dir_arr < 0
+            ratio_arr = np.full(k, np.inf)
+            ratio_arr[neg_arr] = -weight_arr[index_arr][neg_arr] / dir_arr[neg_arr]
+            block = np.argmin(ratio_arr)
+            weight_arr[index_arr] += min(ratio_arr[block], 1.0) * dir_arr
+            weight_arr[index_arr[block]] = 0.0
+            support[index_arr[block]] = False
+            continue
+
+        weight_arr[:] = 0.0
+        weight_arr[index_arr] = np.maximum(weight_new_arr, 0.0)
+
+        # Множители ограничений w >= 0 вне носителя: grad_i + nu >= 0
+        grad_arr = quad_mat @ weight_arr - mean_arr
+        lambda_arr = grad_arr + sol_arr[k]
+        lambda_arr[support] = np.inf
+        enter = np.argmin(lambda_arr)
+        if lambda_arr[enter] >= -1e-12:
+            break
+        support[enter] = True
+
+    return weight_arr / weight_arr.sum()
+
+
+def frontier(mean_arr, cov_mat, n_point=200):
+    """
+        Эффективная граница по сетке mus = 100**(5 * t / n_point - 1), как в optimal_portfolio ноутбуков.
+        Точки решаются от большего веса риска к меньшему, каждая - от решения предыдущей.
+
+    Returns:
+        DataFrame: mu, ret, risk, sharpe и weight (веса портфеля)
+    """
+    mu_arr = np.array([100 ** (5.0 * t / n_point - 1.0) for t in range(n_point)])[::-1]
+
+    # Старт для наибольшего веса риска - портфель с минимальной дисперсией по диагонали
+    weight_arr = np.zeros(len(mean_arr))
+    weight_arr[np.argmin(np.diag(cov_mat))] = 1.0
+
+    weight_list = []
+    for mu in mu_arr:
+        weight_arr = solve_qp(mu, cov_mat, mean_arr, weight_arr)
+        weight_list.append(weight_arr)
+    weight_mat = np.array(weight_list)
+
+    ret_arr, risk_arr = portfolio_stats(weight_mat, mean_arr, cov_mat)
+    frontier_df = pd.DataFrame(
+        {
+            "mu": mu_arr,
+            "ret": ret_arr,
+            "risk": risk_arr,
+            "sharpe": ret_arr / np.where(risk_arr > 0, risk_arr, np.nan),
+            "weight": list(weight_mat),
+        }
+    )
+    return frontier_df.iloc[::-1].reset_index(drop=True)
+
+
+class AllocMarkowitz:
+    """
+    Распределение долей портфеля агента по Марковицу (вместо долей, пропорциональных total_2):
+    портфель эффективной границы с максимальным отношением доходности к риску.
+    Доходность инструмента - ln(total_1) прогноза агента на горизонт, ковариация - по дневным
+    ln доходностям последних n_days дней (или из подключённого к среде covariance.EwmCov),
+    приведённая к горизонту агента.
+
+    Attributes:
+        n_days:     Глубина истории для ковариации в днях
+        n_point:    Количество точек эффективной границы
+        ret_min:    Минимальная доходность портфеля на границе (как отбор ret > 1**(1/260)-1 в ноутбуке)
+        cov_engine: Взвешенная ковариация, обновляемая средой (None - выборочная ковариация окна n_days)
+        cache_key:  Дата и инструменты закэшированной ковариации
+        cov_mat:    Закэшированная ковариация
+        frontier_df: Эффективная граница последнего расчёта
+    """
+
+    def __init__(self, n_days=248, n_point=200, ret_min=0.0, cov_engine=None):
+        self.n_days = n_days
+        self.n_point = n_point
+        self.ret_min = ret_min
+        self.cov_engine = cov_engine
+        self.cache_key = None
+        self.cov_mat = None
+        self.frontier_df = None
+
+    def cov(self, agent, code_arr):
+        # Ковариация кэшируется на дату: повторный расчёт на подмножестве инструментов - выборка из неё
+        envir = agent.envir
+        if self.cov_engine is not None:
+            engine = self.cov_engine
+            index_arr = code_arr if engine.code_arr is None else pd.Index(engine.code_arr).get_indexer(code_arr)
+            if (index_arr < 0).any():
+                raise Exc("Covariance engine does not track all selected instruments")
+            return np.nan_to_num(engine.cov()[np.ix_(index_arr, index_arr)]) * agent.horizon_days
+        if not hasattr(envir, "_price_mat"):
+            raise Exc("Markowitz allocation needs the price matrix of Environment or cov_engine")
+
+        key = np.datetime64(envir.date, "ns")
+        if (self.cache_key is None) or (self.cache_key[0] != key) or not np.isin(code_arr, self.cache_key[1]).all():
+            cut = envir._date_cut
+            price_mat = pd.DataFrame(envir._price_mat[max(cut - self.n_days - 1, 0) : cut, code_arr]).ffill().values
+            ln_profit_mat = np.nan_to_num(np.diff(np.log(price_mat), axis=0))
+            cov_mat = np.cov(ln_profit_mat, rowvar=False).reshape(len(code_arr), len(code_arr))
+            self.cache_key = (key, code_arr.copy())
+            self.cov_mat = cov_mat * agent.horizon_days
+
+        index_arr = pd.Index(self.cache_key[1]).get_indexer(code_arr)
+        return self.cov_mat[np.ix_(index_arr, index_arr)]
+
+    def part(self, agent, part_req_df):
+        """
+            Доли отобранных агентом инструментов
+
+        Args:
+            agent:        Агент
+            part_req_df:  Отобранные инструменты (instr_id)
+
+        Returns:
+            ndarray: Доли в порядке part_req_df
+        """
+        if part_req_df.shape[0] == 0:
+            return np.zeros(0)
+
+        code_arr = agent.envir.registry.codes(part_req_df["instr_id"])
+        total_1_se = agent.param_df.set_index("instr_id")["total_1"]
+        mean_arr = np.log(total_1_se.loc[part_req_df["instr_id"]].values.astype(float))
+        cov_mat = self.cov(agent, code_arr)
+
+        self.frontier_df = frontier(mean_arr, cov_mat, n_point=self.n_point)
+        frontier_df = self.frontier_df[self.frontier_df["ret"] > self.ret_min]
+        if frontier_df.shape[0] == 0 or frontier_df["sharpe"].isnull().all():
+            frontier_df = self.frontier_df
+        return frontier_df.loc[frontier_df["sharpe"].fillna(-np.inf).idxmax(), "weight"]
@@ -0,0 +1,175 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def pack_mat(price_mat, dates):
+    """
+        Производные от плотной матрицы цен индексы (Environment._hist_cnt, _pack_price, _pack_row, _pack_day).
+        Все расчёты - по столбцам, поэтому матрицу можно обрабатывать частями по инструментам.
+
+    Args:
+        price_mat:  Плотная матрица цен дата x инструмент (nan - нет цены на дату)
+        dates:      Торговые дни - строки price_mat
+
+    Returns:
+        hist_cnt, pack_price, pack_row, pack_day
+    """
+    valid_mat = ~np.isnan(price_mat)
+    hist_cnt = np.cumsum(valid_mat, axis=0, dtype=np.int32)
+
+    # Сжатие истории каждого инструмента к началу столбца: строка k - k-й день истории инструмента
+    order_mat = np.argsort(~valid_mat, axis=0, kind="stable")
+    pack_price = np.take_along_axis(price_mat, order_mat, axis=0)
+    pack_row = order_mat.astype(np.int32)
+    pack_day = dates.astype("datetime64[D]").astype(np.int32)[pack_row]
+    return hist_cnt, pack_price, pack_row, pack_day
+
+
+class MatStore:
+    """
+    Хранилище матриц цен среды (Environment.MAT_NAMES) в .npy файлах рядом с хранилищем истории цен.
+    Матрицы открываются через memmap: в память подгружаются только читаемые страницы, поэтому
+    объём памяти процесса не зависит от размера вселенной инструментов.
+    Матрицы по дням (_dates, _price_mat, _hist_cnt) хранятся по строкам - срез по дате непрерывен,
+    сжатая история (_pack_price, _pack_row, _pack_day) - по столбцам: история инструмента непрерывна,
+    и агент читает только столбцы инструментов, которые рассматривает.
+    Матрицы перестраиваются, если изменились хранилище истории цен или справочник инструментов.
+
+    Attributes:
+        price_store:  Хранилище истории цен (price_store.PriceStore)
+        path:         Папка матриц
+        chunk_mb:     Ограничение памяти на часть инструментов при построении
+
+    Example:
+        envir = Environment(date_start, cash_start, 'stock', 'csv', offline=True, mmap=True)
+    """
+
+    # Порядок хранения матриц: 'C' - по строкам (дням), 'F' - по столбцам (инструментам)
+    ORDER = {"_price_mat": "C", "_hist_cnt": "C", "_pack_price": "F", "_pack_row": "F", "_pack_day": "F"}
+    DTYPE = {
+        "_price_mat": np.float64,
+        "_hist_cnt": np.int32,
+        "_pack_price": np.float64,
+        "_pack_row": np.int32,
+        "_pack_day": np.int32,
+    }
+
+    def __init__(self, price_store, path=None, chunk_mb=64):
+        self.price_store = price_store
+        self.path = os.path.join(os.path.dirname(price_store.path), "mat") if path is None else path
+        self.chunk_mb = chunk_mb
+
+    def file(self, name):
+        return os.path.join(self.path, name.lstrip("_") + ".npy")
+
+    def version(self, spr_df):
+        # Версия матриц: состояние файла хранилища и инструменты справочника (порядок столбцов)
+        if not os.path.isfile(self.price_store.path):
+            raise Exc("There is no price history in store " + self.price_store.path)
+        stat = os.stat(self.price_store.path)
+        return {
+            "store_size": stat.st_size,
+            "store_mtime_ns": stat.st_mtime_ns,
+            "instr_id": [str(instr_id) for instr_id in spr_df["instr_id"]],
+            "instr": [str(instr) for instr in spr_df["instr"]],
+        }
+
+    def is_actual(self, spr_df):
+        meta_path = os.path.join(self.path, "meta.json")
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path) as file:
+            return json.load(file) == self.version(spr_df)
+
+    def build(self, spr_df):
+        """
+            Построение матриц из хранилища истории цен частями по инструментам (в памяти - только часть)
+
+        Args:
+            spr_df:  Справочник инструментов полный (порядок строк - порядок столбцов матриц)
+        """
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, "meta.json")
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)  # Пока матрицы не построены полностью, они не актуальны
+
+        # Части инструментов - соседние в хранилище (оно отсортировано по инструменту), так читаются только их строки
+        code_sort_arr = np.argsort(spr_df["instr"].values.astype(str), kind="stable")
+        instr_arr = spr_df["instr"].values[code_sort_arr]
+        instr_ids = pd.Index(spr_df["instr_id"].values[code_sort_arr])
+
+        # 1 проход: торговые дни (только столбцы даты и цены по частям инструментов), строки без цены не учитываются -
+        # как в Environment.build_mat
+        date_list = []
+        chunk = max(1, len(instr_arr) // 8)
+        for start in range(0, len(instr_arr), chunk):
+            date_df = self.price_store.read(instr_arr[start : start + chunk], columns=["date", "close"])
+            date_df = date_df[date_df["close"].notna()]
+            date_list.append(np.unique(pd.to_datetime(date_df["date"], dayfirst=True).values.astype("datetime64[ns]")))
+        dates = np.unique(np.concatenate(date_list)) if len(date_list) > 0 else np.zeros(0, dtype="datetime64[ns]")
+        if len(dates) == 0:
+            raise Exc("There is no price history in store " + self.price_store.path)
+        np.save(self.file("_dates"), dates)
+
+        shape = (len(dates), len(instr_arr))
+        mat_dict = {
+            name: np.lib.format.open_memmap(
+                self.file(name), mode="w+", dtype=self.DTYPE[name], shape=shape, fortran_order=self.ORDER[name] == "F"
+            )
+            for name in self.ORDER
+        }
+
+        # 2 проход: столбцы матриц по частям инструментов
+        chunk = max(1, self.chunk_mb * 1024 ** 2 // (len(dates) * 8 * 4))
+        for start in range(0, len(instr_arr), chunk):
+            finish = min(start + chunk, len(instr_arr))
+            hist_df = self.price_store.read(instr_arr[start:finish], columns=["date", "instr_id", "close"])
+            hist_df["date"] = pd.to_datetime(hist_df["date"], dayfirst=True)
+            hist_df = hist_df.sort_values(by=["date", "instr_id"], kind="stable")
+
+            row_arr = np.searchsorted(dates, hist_df["date"].values.astype("datetime64[ns]"))
+            col_arr = instr_ids[start:finish].get_indexer(hist_df["instr_id"])
+            price_arr = hist_df["close"].values.astype(float)
+            keep_arr = (col_arr >= 0) & ~np.isnan(price_arr)
+
+            price_mat = np.full((len(dates), finish - start), np.nan)
+            price_mat[row_arr[keep_arr], col_arr[keep_arr]] = price_arr[keep_arr]
+
+            code_arr = code_sort_arr[start:finish]
+            mat_dict["_price_mat"][:, code_arr] = price_mat
+            for name, mat in zip(["_hist_cnt", "_pack_price", "_pack_row", "_pack_day"], pack_mat(price_mat, dates)):
+                mat_dict[name][:, code_arr] = mat
+
+        for mat in mat_dict.values():
+            mat.flush()
+        del mat_dict
+
+        with open(meta_path, "w") as file:
+            json.dump(self.version(spr_df), file)
+
+        return True
+
+    def open(self, spr_df):
+        """
+            Матрицы цен только для чтения (перестраиваются, если не актуальны)
+
+        Args:
+            spr_df:  Справочник инструментов полный
+
+        Returns:
+            dict: Матрицы memmap по именам из Environment.MAT_NAMES
+        """
+        if not self.is_actual(spr_df):
+            self.build(spr_df)
+        return {name: np.load(self.file(name), mmap_mode="r") for name in ["_dates"] + list(self.ORDER)}
@@ -0,0 +1,267 @@
+import json
+import os
+import warnings
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import *
+
+from modeling.ingest import Ingest, Source
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class SourceYf(Source):
+    """
+    Источник истории цен - yfinance
+    """
+
+    def fetch(self, instr, start=None, end=None):
+        """
+            Загрузка истории цен инструмента (close - без поправки на дивиденды, adj_close - с поправкой)
+
+        Args:
+            instr:  Тикер инструмента
+            start:  Дата, начиная с которой нужна история (None - вся история)
+            end:    Дата, раньше которой нужна история (не включительно, None - до последнего бара)
+
+        Returns:
+            DataFrame: История цен с полями date, open, high, low, close, adj_close, volume
+        """
+        import yfinance as yf  # Импорт по требованию - в офлайн режиме сеть не нужна
+
+        hist_instr_temp_df = yf.download(instr, start=start, end=end, auto_adjust=False)
+        if isinstance(hist_instr_temp_df.columns, pd.MultiIndex):
+            hist_instr_temp_df.columns = hist_instr_temp_df.columns.get_level_values(0)
+        hist_instr_temp_df = hist_instr_temp_df.reset_index()
+        hist_instr_temp_df = hist_instr_temp_df.rename(
+            columns={
+                "Date": "date",
+                "Open": "open",
+                "High": "high",
+                "Low": "low",
+                "Close": "close",
+                "Adj Close": "adj_close",
+                "Volume": "volume",
+            }
+        )
+        return hist_instr_temp_df
+
+
+class PriceStore:
+    """
+    Локальное колоночное хранилище истории цен инструментов (один parquet файл на type_instr).
+    Догружаются только новые бары, начиная с последнего сохранённого: он загружается повторно и сверяется
+    с хранилищем. Если источник пересчитал историю (сплит, дивиденды - поправочные цены меняются задним числом),
+    история инструмента загружается заново целиком, чтобы старые и новые бары не оказались в разной поправке.
+    Загружаются только завершённые торговые дни (до date_actual включительно).
+
+    Attributes:
+        path:       Путь к файлу хранилища
+        fetch_path: Путь к отметкам загрузки: instr -> дата, по которую история уже запрошена у источника
+        source:     Источник для догрузки недостающих дат
+        offline:    Режим без обращения к сети - используется только хранилище
+        ingest:     Параллельная загрузка из source (modeling.ingest.Ingest)
+        fail_df:    Инструменты, которые не удалось загрузить при последней догрузке
+    """
+
+    ROW_GROUP = 100_000
+
+    # Столбцы, по которым сверяется повторно загруженный последний бар
+    CHECK_COLUMNS = ["close", "adj_close"]
+
+    def __init__(self, type_instr, data_path="3. Data preparation", source=None, offline=False, ingest=None):
+        self.path = os.path.join(data_path, type_instr, "price_hist.parquet")
+        self.fetch_path = os.path.join(data_path, type_instr, "price_hist_fetched.json")
+        if ingest is None:
+            ingest = Ingest(SourceYf() if source is None else source)
+        self.ingest = ingest
+        self.source = ingest.source
+        self.offline = offline
+        self.fail_df = ingest.fail_df
+
+    def read(self, instr_list=None, columns=None):
+        """
+            Чтение хранилища
+
+        Args:
+            instr_list:  Инструменты (None - все). Читаются только нужные группы строк файла
+            columns:     Столбцы (None - все)
+
+        Returns:
+            DataFrame: История цен инструментов хранилища (пустой, если хранилища нет)
+        """
+        if not os.path.isfile(self.path):
+            return pd.DataFrame(columns=["date", "instr_id"] if columns is None else columns)
+        filters = None
+        if instr_list is not None:
+            # Границы диапазона отсекают группы строк по статистике файла (условие "in" этого не делает)
+            instr_list = list(instr_list)
+            filters = [("instr_id", "in", instr_list)]
+            if len(instr_list) > 0:
+                filters = [("instr_id", ">=", min(instr_list)), ("instr_id", "<=", max(instr_list))] + filters
+        return pd.read_parquet(self.path, columns=columns, filters=filters)
+
+    def write(self, store_df):
+        store_df = store_df.sort_values(by=["instr_id", "date"]).reset_index(drop=True)
+        # Небольшие группы строк - чтение части инструментов (read с instr_list) не читает файл целиком
+        store_df.to_parquet(self.path + ".tmp", index=False, row_group_size=self.ROW_GROUP)
+        os.replace(self.path + ".tmp", self.path)  # Атомарная замена, чтобы не испортить хранилище при сбое
+
+    def read_fetched(self):
+        # Отметки загрузки: instr -> дата, по которую история уже запрошена (нет файла - отметок нет)
+        if not os.path.isfile(self.fetch_path):
+            return {}
+        with open(self.fetch_path, encoding="utf-8") as file:
+            return {instr: pd.Timestamp(date) for instr, date in json.load(file).items()}
+
+    def write_fetched(self, fetched_dict):
+        with open(self.fetch_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump({instr: str(date.date()) for instr, date in fetched_dict.items()}, file)
+        os.replace(self.fetch_path + ".tmp", self.fetch_path)
+
+    @staticmethod
+    def date_actual():
+        # Последний завершённый рабочий день - сегодняшний бар во время торгов неполный
+        return pd.Timestamp.today().normalize() - BDay(1)
+
+    def missing(self, store_df, instr_list, date_actual=None, fetched_dict=None):
+        """
+            Определение недостающих диапазонов дат
+
+        Args:
+            store_df:      История цен из хранилища
+            instr_list:    Необходимые инструменты
+            date_actual:   Дата, по которую история считается актуальной (по умолчанию - прошлый рабочий день)
+            fetched_dict:  Отметки загрузки (read_fetched): инструмент, уже запрошенный по date_actual, не загружается,
+                           даже если баров нет (праздник, инструмент больше не торгуется)
+
+        Returns:
+            dict: instr -> дата начала догрузки - последний сохранённый бар для сверки (None - загрузить всю историю)
+        """
+        if date_actual is None:
+            date_actual = self.date_actual()
+        fetched_dict = {} if fetched_dict is None else fetched_dict
+
+        date_last_se = store_df.groupby("instr_id")["date"].max() if store_df.shape[0] > 0 else pd.Series(dtype=object)
+
+        missing_dict = {}
+        for instr in instr_list:
+            if instr not in date_last_se.index:
+                missing_dict[instr] = None
+            elif (date_last_se[instr] < date_actual) and (fetched_dict.get(instr, date_last_se[instr]) < date_actual):
+                missing_dict[instr] = date_last_se[instr]
+        return missing_dict
+
+    def changed(self, store_df, hist_df, missing_dict):
+        """
+            Инструменты, у которых повторно загруженный последний сохранённый бар не совпал с хранилищем
+            (или не загрузился при наличии новых баров) - история пересчитана источником
+
+        Returns:
+            list: Инструменты для полной перезагрузки
+        """
+        start_se = pd.Series({instr: start for instr, start in missing_dict.items() if start is not None}, dtype=object)
+        if (len(start_se) == 0) or (hist_df.shape[0] == 0):
+            return []
+        columns = [name for name in self.CHECK_COLUMNS if (name in store_df.columns) and (name in hist_df.columns)]
+
+        hist_df = hist_df[hist_df["instr_id"].isin(start_se.index)]
+        key_df = pd.DataFrame({"instr_id": start_se.index, "date": pd.to_datetime(start_se.values)})
+        check_df = key_df.merge(store_df[["instr_id", "date"] + columns], on=["instr_id", "date"], how="left").merge(
+            hist_df[["instr_id", "date"] + columns], on=["instr_id", "date"], how="left", suffixes=("", "_new")
+        )
+        check_df = check_df[check_df["instr_id"].isin(hist_df["instr_id"])]
+
+        diff_mask = np.zeros(len(check_df), dtype=bool)
+        for name in columns:
+            old_arr = check_df[name].values.astype(float)
+            new_arr = check_df[name + "_new"].values.astype(float)
+            same_arr = np.isclose(old_arr, new_arr, rtol=1e-6, atol=0) | (np.isnan(old_arr) & np.isnan(new_arr))
+            diff_mask |= ~same_arr
+        return list(check_df["instr_id"][diff_mask])
+
+    def update(self, instr_list):
+        """
+            Догрузка в хранилище только недостающих дат инструментов (в офлайн режиме - ничего)
+
+        Args:
+            instr_list:  Необходимые инструменты
+
+        Returns:
+            True: Если хранилище изменилось
+        """
+        if self.offline:
+            return False
+
+        date_actual = self.date_actual()
+        end = date_actual + pd.Timedelta(days=1)
+        fetched_dict = self.read_fetched()
+        missing_dict = self.missing(self.read(columns=["date", "instr_id"]), instr_list, date_actual, fetched_dict)
+        if len(missing_dict) == 0:
+            return False
+
+        hist_df = self.ingest.run(missing_dict, end=end)
+        fail_df = self.ingest.fail_df
+
+        store_df = self.read()
+        if hist_df.shape[0] > 0:
+            hist_df["date"] = pd.to_datetime(hist_df["date"], dayfirst=True)
+
+        # История пересчитана источником - полная перезагрузка инструмента вместо дописывания
+        reload_list = self.changed(store_df, hist_df, missing_dict)
+        if len(reload_list) > 0:
+            reload_df = self.ingest.run({instr: None for instr in reload_list}, end=end)
+            if self.ingest.fail_df.shape[0] > 0:
+                fail_df = pd.concat([df for df in [fail_df, self.ingest.fail_df] if df.shape[0] > 0], ignore_index=True)
+            # Не перезагрузившиеся инструменты не дописываются (остаются в прежней поправке до следующей загрузки)
+            hist_df = hist_df[~hist_df["instr_id"].isin(reload_list)]
+            if reload_df.shape[0] > 0:
+                reload_df["date"] = pd.to_datetime(reload_df["date"], dayfirst=True)
+                store_df = store_df[~store_df["instr_id"].isin(reload_df["instr_id"])]
+                hist_df = pd.concat([df for df in [hist_df, reload_df] if df.shape[0] > 0], ignore_index=True)
+
+        self.fail_df = fail_df
+        if self.fail_df.shape[0] > 0:
+            # Неудачные инструменты не прерывают догрузку - в хранилище попадает всё, что загрузилось
+            warnings.warn(
+                "Price history is not loaded for %d instr: %s" % (len(self.fail_df), ", ".join(self.fail_df["instr"]))
+            )
+
+        # Отметка загрузки - только успешно запрошенным инструментам
+        fail_set = set(self.fail_df["instr"])
+        for instr in missing_dict:
+            if instr not in fail_set:
+                fetched_dict[instr] = date_actual
+        self.write_fetched(fetched_dict)
+
+        if hist_df.shape[0] == 0:
+            return False
+
+        store_df = pd.concat([df for df in [store_df, hist_df] if df.shape[0] > 0])
+        store_df["date"] = pd.to_datetime(store_df["date"], dayfirst=True)
+        store_df = store_df.drop_duplicates(subset=["instr_id", "date"], keep="last")
+        self.write(store_df)
+        return True
+
+    def load(self, instr_list):
+        """
+            Получение истории цен инструментов: догрузка только недостающих дат и чтение хранилища
+
+        Args:
+            instr_list:  Необходимые инструменты
+
+        Returns:
+            DataFrame: История цен необходимых инструментов
+        """
+        self.update(instr_list)
+
+        store_df = self.read(instr_list)
+        if store_df.shape[0] == 0:
+            raise Exc("There is no price history in store " + self.path + (" (offline mode)" if self.offline else ""))
+        return store_df.reset_index(drop=True)
@@ -0,0 +1,177 @@
+import cProfile
+import pstats
+import time
+
+import pandas as pd
+
+
+class Phase:
+    """
+    Замер одного выполнения этапа (with probe.phase(name) as phase: ...; phase.rows = n)
+    """
+
+    __slots__ = ("probe", "name", "rows", "time_start")
+
+    def __init__(self, probe, name):
+        self.probe = probe
+        self.name = name
+        self.rows = 0
+
+    def __enter__(self):
+        self.time_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.probe.add(self.name, time.perf_counter() - self.time_start, self.rows)
+        return False
+
+
+class PhaseOff:
+    """
+    Замер при выключенном замере - ничего не делает
+    """
+
+    __slots__ = ("rows",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+PHASE_OFF = PhaseOff()
+
+
+class Probe:
+    """
+    Замеры хода моделирования: время и количество вызовов этапов, количество обработанных строк по периодам.
+    Выключенный замер (enabled=False) не накапливает ничего и почти не тратит времени.
+    На одном выбранном периоде может быть включен профилировщик (cProfile или любой с enable/disable).
+
+    Attributes:
+        enabled:         Замер включен
+        profile_period:  Профилируемый период: номер периода (int) или дата (None - без профилирования)
+        profiler_class:  Класс профилировщика
+        profiler:        Профилировщик после профилируемого периода
+        stat_dict:       Замеры текущего периода: этап -> [количество вызовов, время сек., строк]
+        period_list:     Замеры завершённых периодов
+        n_period:        Количество завершённых периодов
+
+    Example:
+        probe = Probe(profile_period=12)
+        suvis = Superviser(envir, agent, type_instr, probe=probe)
+        agent.action()
+        report = suvis.report()         # report['summary'], report['period']
+        probe.profile_stats().print_stats(20)
+    """
+
+    def __init__(self, enabled=True, profile_period=None, profiler_class=cProfile.Profile):
+        self.enabled = enabled
+        self.profile_period = profile_period
+        self.profiler_class = profiler_class
+        self.clear()
+
+    def clear(self):
+        self.profiler = None
+        self._profiler = None
+        self.stat_dict = {}
+        self.period_list = []
+        self.n_period = 0
+
+    def phase(self, name):
+        """
+            Замер этапа (время включает вложенные этапы)
+
+        Args:
+            name:  Имя этапа
+        """
+        if not self.enabled:
+            return PHASE_OFF
+        return Phase(self, name)
+
+    def count(self, name, rows=0):
+        # Учёт вызова без замера времени
+        if self.enabled:
+            self.add(name, 0.0, rows)
+
+    def add(self, name, sec, rows):
+        stat = self.stat_dict.get(name)
+        if stat is None:
+            self.stat_dict[name] = [1, sec, rows]
+        else:
+            stat[0] += 1
+            stat[1] += sec
+            stat[2] += rows
+
+    def period_start(self, date):
+        """
+            Начало периода агента - включение профилировщика на выбранном периоде
+        """
+        if not self.enabled or self.profile_period is None:
+            return
+        if isinstance(self.profile_period, int):
+            match = self.profile_period == self.n_period
+        else:
+            match = pd.Timestamp(self.profile_period) == pd.Timestamp(date)
+        if match:
+            self._profiler = self.profiler_class()
+            self._profiler.enable()
+
+    def period_end(self, date):
+        """
+            Окончание периода агента: замеры периода (включая расчёт данных среды перед ним) сохраняются
+        """
+        if not self.enabled:
+            return
+        if self._profiler is not None:
+            self._profiler.disable()
+            self.profiler = self._profiler
+            self._profiler = None
+
+        for name, (calls, sec, rows) in self.stat_dict.items():
+            self.period_list.append(
+                {"period": self.n_period, "date": date, "phase": name, "calls": calls, "sec": sec, "rows": rows}
+            )
+        self.stat_dict = {}
+        self.n_period += 1
+
+    def report(self):
+        """
+            Отчёт по замерам
+
+        Returns:
+            dict:
+                period:   DataFrame period, date, phase, calls, sec, rows - замеры по периодам
+                summary:  DataFrame phase, calls, sec, sec_period, sec_max, rows - итоги по этапам
+                          (sec_period - среднее время за период, sec_max - максимальное за период)
+        """
+        period_df = pd.DataFrame(self.period_list, columns=["period", "date", "phase", "calls", "sec", "rows"])
+        summary_df = (
+            period_df.groupby("phase", sort=False)
+            .agg(
+                calls=("calls", "sum"),
+                sec=("sec", "sum"),
+                sec_period=("sec", "mean"),
+                sec_max=("sec", "max"),
+                rows=("rows", "sum"),
+            )
+            .sort_values(by="sec", ascending=False)
+            .reset_index()
+        )
+        return {"period": period_df, "summary": summary_df}
+
+    def profile_stats(self, sort="cumulative"):
+        """
+            Статистика cProfile профилируемого периода
+
+        Returns:
+            pstats.Stats
+        """
+        if self.profiler is None:
+            return None
+        return pstats.Stats(self.profiler).sort_stats(sort)
+
+
+# Замер по умолчанию - выключен
+PROBE_OFF = Probe(enabled=False)
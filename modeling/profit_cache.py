@@ -0,0 +1,136 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def profit_table(pack_price, horizon_days):
+    """
+        Доходность на горизонт вперёд по сжатой истории: строка k - price[k + horizon_days] / price[k]
+        k-го дня истории инструмента (как price_next / price в Agent.preprocess), nan - цены через горизонт нет
+
+    Args:
+        pack_price:    Цены, сжатые к началу столбца (Environment._pack_price)
+        horizon_days:  Горизонт прогнозирования рабочих дней
+
+    Returns:
+        ndarray: день истории инструмента x инструмент
+    """
+    profit_mat = np.full(pack_price.shape, np.nan)
+    if horizon_days < len(pack_price):
+        # Явная граница среза: при horizon_days = 0 срез [:-0] был бы пустым
+        n = len(pack_price) - horizon_days
+        profit_mat[:n] = pack_price[horizon_days:] / pack_price[:n]
+    return profit_mat
+
+
+def profit_table_file(pack_price, horizon_days, file, chunk_mb=64):
+    """
+        profit_table по частям столбцов сразу в файл .npy (memmap) - полная таблица в память не загружается
+        (для матриц memmap среды, Environment(mmap=True)). Порядок по столбцам, как у _pack_price
+
+    Args:
+        pack_price:    Цены, сжатые к началу столбца (Environment._pack_price)
+        horizon_days:  Горизонт прогнозирования рабочих дней
+        file:          Путь к файлу таблицы
+        chunk_mb:      Размер части столбцов в памяти, Мб
+
+    Returns:
+        True
+    """
+    profit_mat = np.lib.format.open_memmap(
+        file, mode="w+", dtype=np.float64, shape=pack_price.shape, fortran_order=True
+    )
+    chunk = max(1, chunk_mb * 1024 ** 2 // (max(1, len(pack_price)) * 8 * 2))
+    for start in range(0, pack_price.shape[1], chunk):
+        pack_chunk = np.asarray(pack_price[:, start : start + chunk])
+        profit_mat[:, start : start + chunk] = profit_table(pack_chunk, horizon_days)
+    profit_mat.flush()
+    del profit_mat
+    return True
+
+
+class ProfitCache:
+    """
+    Кэш таблиц доходности на горизонт вперёд (profit_table) по версии данных среды и horizon_days.
+    В памяти хранится не больше max_items таблиц (вытесняется давно не использованная), при заданном path
+    таблицы сохраняются на диск и при следующих запусках открываются через memmap без расчёта.
+    Для среды с матрицами memmap (Environment(mmap=True)) таблица строится по частям сразу в файл,
+    поэтому path обязателен.
+    Один кэш передаётся всем прогонам (Agent.start(profit_cache=...)), таблица на горизонт считается 1 раз.
+
+    Attributes:
+        max_items:  Максимальное количество таблиц в памяти
+        path:       Папка для сохранения таблиц (None - только в памяти)
+        table_dict: Таблицы по ключу (версия данных, horizon_days) в порядке использования
+        n_hit:      Количество обращений, обслуженных кэшем в памяти
+        n_load:     Количество таблиц, прочитанных с диска
+        n_calc:     Количество рассчитанных таблиц
+    """
+
+    def __init__(self, max_items=4, path=None):
+        self.max_items = max_items
+        self.path = path
+        self.table_dict = OrderedDict()
+        self.n_hit = 0
+        self.n_load = 0
+        self.n_calc = 0
+
+    def get(self, envir, horizon_days):
+        """
+            Таблица доходности для среды и горизонта
+
+        Args:
+            envir:         Среда с полной сжатой историей (Environment)
+            horizon_days:  Горизонт прогнозирования рабочих дней
+
+        Returns:
+            ndarray: Таблица profit_table (только для чтения)
+
+        Raises:
+            Exc: Среда с матрицами memmap, а path не задан
+        """
+        key = (envir.data_version(), int(horizon_days))
+        profit_mat = self.table_dict.get(key)
+        if profit_mat is not None:
+            self.table_dict.move_to_end(key)
+            self.n_hit += 1
+            return profit_mat
+
+        file = None if self.path is None else os.path.join(self.path, "profit_%s_%d.npy" % key)
+        if (file is not None) and os.path.isfile(file):
+            profit_mat = np.load(file, mmap_mode="r")
+            self.n_load += 1
+        elif getattr(envir, "mat_store", None) is not None:
+            # Полная таблица в памяти лишила бы смысла матрицы memmap - только по частям в файл
+            if file is None:
+                raise Exc("ProfitCache for a memory-mapped environment needs path")
+            os.makedirs(self.path, exist_ok=True)
+            profit_table_file(envir._pack_price, horizon_days, file + ".tmp.npy")
+            os.replace(file + ".tmp.npy", file)
+            profit_mat = np.load(file, mmap_mode="r")
+            self.n_calc += 1
+        else:
+            profit_mat = profit_table(envir._pack_price, horizon_days)
+            profit_mat.flags.writeable = False
+            self.n_calc += 1
+            if file is not None:
+                os.makedirs(self.path, exist_ok=True)
+                np.save(file + ".tmp.npy", profit_mat)
+                os.replace(file + ".tmp.npy", file)
+
+        self.table_dict[key] = profit_mat
+        while len(self.table_dict) > self.max_items:
+            self.table_dict.popitem(last=False)
+        return profit_mat
+
+    def clear(self):
+        self.table_dict.clear()
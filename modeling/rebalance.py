@@ -0,0 +1,100 @@
+import numpy as np
+from pandas.tseries.offsets import *
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class RebalPeriod:
+    """
+    Ребалансировка с заданной периодичностью: на первом баре, дата которого не меньше даты прошлой
+    ребалансировки + period
+
+    Attributes:
+        period:     Шаг (смещение pandas) или имя из PERIODS
+        date_next:  Дата, начиная с которой наступает следующая ребалансировка
+    """
+
+    PERIODS = {"daily": Day(n=1), "weekly": Week(weekday=0), "monthly": MonthBegin(n=1)}
+
+    def __init__(self, period="monthly"):
+        if isinstance(period, str):
+            if period not in self.PERIODS:
+                raise Exc("Unknown period " + period)
+            period = self.PERIODS[period]
+        self.period = period
+        self.date_next = None
+
+    def due(self, envir):
+        return (self.date_next is None) or (envir.date >= self.date_next)
+
+    def reset(self, envir):
+        self.date_next = envir.date + self.period
+
+
+class RebalDrift:
+    """
+    Ребалансировка при уходе долей портфеля от долей после прошлой ребалансировки из-за движения цен:
+    максимальное отклонение доли инструмента больше thres. Пока портфель пуст - на каждом баре.
+
+    Attributes:
+        thres:      Порог отклонения доли
+        price_ref:  Цены на дату прошлой ребалансировки в порядке _instr_ids
+        part_ref:   Доли портфеля после прошлой ребалансировки (по коду инструмента портфеля)
+    """
+
+    def __init__(self, thres=0.05):
+        self.thres = thres
+        self.price_ref = None
+        self.part_ref = None
+
+    def due(self, envir):
+        if self.price_ref is None:
+            return True
+
+        code_arr = np.array(envir._port_codes, dtype=int)
+        quantity_arr = envir._quantity[code_arr]
+        if quantity_arr.sum() == 0:
+            return True
+
+        # Доли после ребалансировки считаются при первой проверке - сделки агента к этому моменту уже исполнены
+        if self.part_ref is None:
+            self.part_ref = self.part(envir, code_arr, quantity_arr, self.price_ref)
+        if len(self.part_ref) != len(code_arr):
+            return True
+
+        part_arr = self.part(envir, code_arr, quantity_arr, envir.price_arr)
+        return np.abs(part_arr - self.part_ref).max() > self.thres
+
+    @staticmethod
+    def part(envir, code_arr, quantity_arr, price_arr):
+        value_arr = quantity_arr * np.nan_to_num(price_arr[code_arr]) * (1 - envir._discount_arr[code_arr])
+        return value_arr / value_arr.sum() if value_arr.sum() > 0 else value_arr
+
+    def reset(self, envir):
+        self.price_ref = envir.price_arr.copy()
+        self.part_ref = None
+
+
+class RebalAny:
+    """
+    Ребалансировка, если наступила по любому из правил (например, ежемесячно или при уходе долей)
+
+    Attributes:
+        rebal_list:  Правила ребалансировки
+    """
+
+    def __init__(self, *rebal_list):
+        self.rebal_list = rebal_list
+
+    def due(self, envir):
+        return any([rebal.due(envir) for rebal in self.rebal_list])
+
+    def reset(self, envir):
+        for rebal in self.rebal_list:
+            rebal.reset(envir)
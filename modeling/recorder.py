@@ -0,0 +1,189 @@
+import copy
+import itertools
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Номера поколений историй: новое при создании и очистке, по нему приёмник замечает начатую заново историю
+_generation = itertools.count()
+
+
+class HistRecorder:
+    """
+    Накопитель истории: строки дописываются в заранее выделенные типизированные буферы столбцов
+    (с ростом в 2 раза при заполнении), DataFrame формируется только при чтении.
+    При заданном cap старые строки сбрасываются на диск частями (parquet) и подчитываются при чтении.
+    Копия истории (copy.deepcopy, snapshot.Snapshot) не копирует строки: накопленное замораживается
+    в неизменяемую часть, общую для оригинала и копии, и каждая дальше дописывает только свои строки.
+
+    Attributes:
+        columns:     Столбцы истории: имя -> dtype
+        categories:  Столбцы, хранящиеся кодами: имя -> массив значений по кодам
+        cap:         Максимальное количество строк в памяти (None - без ограничения)
+        spill_dir:   Папка для сброса частей истории на диск
+        spill_list:  Сброшенные части: путь к parquet или DataFrame (часть, замороженная в памяти)
+        spill_size:  Количество строк в сброшенных частях
+        n_shared:    Количество первых частей, общих с копиями истории (clear их не удаляет)
+        generation:  Номер поколения истории (новый при создании, копировании и clear)
+        buf_dict:    Буферы столбцов
+        n:           Количество строк в буферах
+        n_spill:     Количество строк в сброшенных частях
+    """
+
+    def __init__(self, columns, categories=None, size=1024, cap=None, spill_dir=None):
+        self.columns = columns
+        self.categories = {} if categories is None else categories
+        self.cap = cap
+        self.spill_dir = spill_dir
+        self.spill_list = []
+        self.spill_size = []
+        self.n_shared = 0
+        self.buf_dict = {name: np.empty(size, dtype=dtype) for name, dtype in columns.items()}
+        self.n = 0
+        self.n_spill = 0
+        self.generation = next(_generation)
+        self._df = None
+
+    def __len__(self):
+        return self.n_spill + self.n
+
+    def append(self, **value_dict):
+        """
+            Добавление строк в историю. Скалярные значения распространяются на все добавляемые строки.
+
+        Args:
+            value_dict:  Значения по всем столбцам истории (скаляры или массивы одинаковой длины)
+        """
+        n_new = 1
+        for value in value_dict.values():
+            if np.ndim(value) > 0:
+                n_new = len(value)
+                break
+        if n_new == 0:
+            return
+
+        self._reserve(n_new)
+        for name in self.columns:
+            self.buf_dict[name][self.n : self.n + n_new] = value_dict[name]
+        self.n += n_new
+        self._df = None
+
+        if (self.cap is not None) and (self.n >= self.cap):
+            self.spill()
+
+    def _reserve(self, n_new):
+        size = len(next(iter(self.buf_dict.values())))
+        if self.n + n_new <= size:
+            return
+        size = max(2 * size, self.n + n_new)
+        for name, buf in self.buf_dict.items():
+            buf_new = np.empty(size, dtype=buf.dtype)
+            buf_new[: self.n] = buf[: self.n]
+            self.buf_dict[name] = buf_new
+
+    def spill(self):
+        """
+            Сброс строк из буферов на диск
+        """
+        if self.n == 0:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="hist_")
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        path = os.path.join(self.spill_dir, "part_%05d.parquet" % len(self.spill_list))
+        pd.DataFrame({name: buf[: self.n] for name, buf in self.buf_dict.items()}).to_parquet(path, index=False)
+        self.spill_list.append(path)
+        self.spill_size.append(self.n)
+        self.n_spill += self.n
+        self.n = 0
+
+    def freeze(self):
+        """
+            Перенос строк из буферов в неизменяемую часть в памяти
+        """
+        if self.n == 0:
+            return
+        self.spill_list.append(pd.DataFrame({name: buf[: self.n].copy() for name, buf in self.buf_dict.items()}))
+        self.spill_size.append(self.n)
+        self.n_spill += self.n
+        self.n = 0
+
+    def __deepcopy__(self, memo):
+        # Накопленные части общие, у копии - свои пустые буферы и своя папка сброса
+        self.freeze()
+        self.n_shared = len(self.spill_list)
+
+        hist = copy.copy(self)
+        hist.spill_dir = None
+        hist.generation = next(_generation)
+        hist.spill_list = list(self.spill_list)
+        hist.spill_size = list(self.spill_size)
+        hist.buf_dict = {name: np.empty(1024, dtype=buf.dtype) for name, buf in self.buf_dict.items()}
+        memo[id(self)] = hist
+        return hist
+
+    @staticmethod
+    def _read(part):
+        return part if isinstance(part, pd.DataFrame) else pd.read_parquet(part)
+
+    def to_df(self):
+        """
+            Формирование DataFrame истории (кэшируется до следующего добавления)
+
+        Returns:
+            DataFrame: Вся история, включая сброшенную на диск
+        """
+        if self._df is None:
+            df_list = [self._read(part) for part in self.spill_list]
+            df_list.append(pd.DataFrame({name: buf[: self.n].copy() for name, buf in self.buf_dict.items()}))
+            hist_df = pd.concat(df_list, ignore_index=True) if len(df_list) > 1 else df_list[0]
+            self._df = self._decode(hist_df)
+        return self._df
+
+    def _decode(self, hist_df):
+        # Замена кодов значениями в столбцах-категориях
+        for name, value_arr in self.categories.items():
+            hist_df[name] = value_arr[hist_df[name].values]
+        return hist_df
+
+    def frame(self, start=0):
+        """
+            Формирование DataFrame строк истории начиная с номера start (для дописывания результатов по частям)
+
+        Args:
+            start:  Номер первой строки
+
+        Returns:
+            DataFrame: Строки истории [start, len)
+        """
+        # Читаются только сброшенные части, содержащие строки начиная со start
+        df_list = []
+        part_start = 0
+        for part, size in zip(self.spill_list, self.spill_size):
+            if part_start + size > start:
+                df_list.append(self._read(part).iloc[max(start - part_start, 0) :])
+            part_start += size
+
+        row_from = max(start - self.n_spill, 0)
+        df_list.append(pd.DataFrame({name: buf[row_from : self.n].copy() for name, buf in self.buf_dict.items()}))
+        return self._decode(pd.concat(df_list, ignore_index=True))
+
+    def clear(self):
+        """
+            Очистка истории и удаление сброшенных на диск частей (кроме общих с копиями)
+        """
+        for part in self.spill_list[self.n_shared :]:
+            if isinstance(part, str) and os.path.isfile(part):
+                os.remove(part)
+        if (self.spill_dir is not None) and os.path.isdir(self.spill_dir) and (len(os.listdir(self.spill_dir)) == 0):
+            shutil.rmtree(self.spill_dir)
+        self.spill_list = []
+        self.spill_size = []
+        self.n_shared = 0
+        self.n = 0
+        self.n_spill = 0
+        self.generation = next(_generation)
+        self._df = None
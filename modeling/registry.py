@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class Registry:
+    """
+    Реестр инструментов: плотные целые коды инструментов справочника (номер строки spr.csv - он же
+    номер столбца матриц цен среды) и справочные реквизиты массивами в порядке кодов.
+    Соединения по строковому instr_id заменяются выборкой из массивов по кодам.
+
+    Attributes:
+        spr_df:     Справочник инструментов полный
+        instr_ids:  Id инструментов в порядке кодов
+        instr_code: Код по id инструмента
+        manager:    Управляющий
+        instr:      Тикер инструмента
+        min_sum:    Минимальная сумма покупки
+        surcharge:  Надбавка при покупке
+        discount:   Скидка при продаже
+        fee:        Вознаграждение управляющего
+    """
+
+    def __init__(self, spr_df):
+        self.spr_df = spr_df
+        self.instr_ids = spr_df["instr_id"].values
+        self._index = pd.Index(self.instr_ids)
+        if not self._index.is_unique:
+            raise Exc("Instr_id is not unique in spr: " + str(list(self._index[self._index.duplicated()])))
+        self.instr_code = {instr_id: code for code, instr_id in enumerate(self.instr_ids)}
+        self.manager = spr_df["manager"].values
+        self.instr = spr_df["instr"].values
+        self.min_sum = spr_df["min_sum"].values.astype(float)
+        self.surcharge = spr_df["surcharge"].values.astype(float)
+        self.discount = spr_df["discount"].values.astype(float)
+        self.fee = spr_df["fee"].values.astype(float)
+
+    @classmethod
+    def from_csv(cls, path):
+        return cls(pd.read_csv(path))
+
+    def __len__(self):
+        return len(self.instr_ids)
+
+    def codes(self, instr_ids):
+        """
+            Коды инструментов
+
+        Args:
+            instr_ids:  Id инструментов
+
+        Returns:
+            ndarray: Коды в порядке instr_ids
+
+        Raises:
+            Exc: Инструмента нет в справочнике
+        """
+        code_arr = self._index.get_indexer(instr_ids)
+        if (code_arr < 0).any():
+            raise Exc("There is no such instr " + str(np.asarray(instr_ids)[code_arr < 0][0]) + " in spr")
+        return code_arr
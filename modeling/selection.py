@@ -0,0 +1,131 @@
+from fractions import Fraction
+
+import numpy as np
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def dif_power_name(power):
+    # Имя столбца Dif**power как в Correlation.ipynb: степень простой дробью (1/64 -> "Dif^1/64")
+    return "Dif^" + str(Fraction(power).limit_denominator(1_000_000))
+
+
+def rank_decorr(
+    rate_df, corr_df, score="Итого2", name="Название", out="Итого3", power=1 / 64, n_select=None, power_name=None
+):
+    """
+        Ранжирование фондов с учётом корреляции (Итого3 из Correlation.ipynb): фонды по очереди выбираются
+        по максимуму score * Dif**power, где Dif - произведение (1 - corr) с уже выбранными фондами.
+        Dif всех невыбранных фондов обновляется 1 векторной операцией на каждый выбор.
+
+    Args:
+        rate_df:   Рейтинг фондов (столбцы name и score)
+        corr_df:   Корреляционная матрица фондов (индекс и столбцы - значения name)
+        score:     Столбец исходного рейтинга
+        name:      Столбец названия фонда
+        out:       Столбец итогового рейтинга
+        power:     Степень Dif
+        n_select:  Количество выбираемых фондов (None - все)
+        power_name: Столбец Dif**power (None - dif_power_name, для power = 1/64 "Dif^1/64")
+
+    Returns:
+        DataFrame: rate_df по убыванию score со столбцами Dif, power_name, out (nan - фонд не выбран)
+                   и order - номер выбора
+    """
+    rate_df = rate_df.sort_values(by=[score], ascending=False, kind="stable").reset_index(drop=True)
+    n = rate_df.shape[0]
+    n_select = n if n_select is None else min(n_select, n)
+
+    name_arr = rate_df[name].values
+    # Строка j - корреляции всех фондов с фондом j (одна выборка из транспонированной матрицы, непрерывно в памяти)
+    row_arr = corr_df.index.get_indexer(name_arr)
+    col_arr = corr_df.columns.get_indexer(name_arr)
+    corr_mat = corr_df.values.astype(float, copy=False).T[np.ix_(np.maximum(col_arr, 0), np.maximum(row_arr, 0))]
+    corr_mat[col_arr < 0, :] = np.nan
+    corr_mat[:, row_arr < 0] = np.nan
+    score_arr = rate_df[score].values.astype(float)
+    # Уже выбранные фонды исключаются из выбора через score = nan
+    score_free_arr = score_arr.copy()
+
+    dif_arr = np.ones(n)
+    temp_arr = np.empty(n)
+    dif_sel_arr = np.full(n, np.nan)
+    out_arr = np.full(n, np.nan)
+    order_arr = np.full(n, np.nan)
+
+    for order in range(n_select):
+        np.maximum(dif_arr, 0.0, out=temp_arr)
+        np.power(temp_arr, power, out=temp_arr)
+        temp_arr *= score_free_arr
+        temp_arr[np.isnan(temp_arr)] = -np.inf
+        pick = np.argmax(temp_arr)
+        if temp_arr[pick] == -np.inf:
+            break
+
+        out_arr[pick] = temp_arr[pick]
+        dif_sel_arr[pick] = dif_arr[pick]
+        order_arr[pick] = order
+        score_free_arr[pick] = np.nan
+        dif_arr *= 1 - corr_mat[pick]
+
+    rate_df["Dif"] = dif_sel_arr
+    rate_df[dif_power_name(power) if power_name is None else power_name] = np.maximum(dif_sel_arr, 0.0) ** power
+    rate_df[out] = out_arr
+    rate_df["order"] = order_arr
+    return rate_df
+
+
+class SelectDecorr:
+    """
+    Отбор инструментов агента с учётом корреляции: кандидаты (выше min_thres) ранжируются rank_decorr
+    по total_2 в порядке выбора, агент берёт первые top_thres из них.
+
+    Attributes:
+        corr:    Корреляция: covariance.EwmCov (текущая на дату среды) или DataFrame инструмент x инструмент
+        power:   Степень Dif
+        ranked_df: Результат последнего ранжирования
+    """
+
+    def __init__(self, corr, power=1 / 64):
+        self.corr = corr
+        self.power = power
+        self.ranked_df = None
+
+    def apply(self, agent, part_req_df):
+        """
+            Ранжирование кандидатов
+
+        Args:
+            agent:        Агент
+            part_req_df:  Кандидаты (instr_id, total_2, ...)
+
+        Returns:
+            DataFrame: Кандидаты в порядке выбора с итоговым рейтингом total_3
+
+        Raises:
+            Exc: Корреляция известна не для всех кандидатов
+        """
+        corr_df = self.corr.corr_df() if hasattr(self.corr, "corr_df") else self.corr
+        instr_arr = part_req_df["instr_id"].values
+        if not (np.isin(instr_arr, corr_df.index) & np.isin(instr_arr, corr_df.columns)).all():
+            raise Exc("Correlation does not cover all selected instruments")
+        corr_df = corr_df.reindex(index=part_req_df["instr_id"].values, columns=part_req_df["instr_id"].values)
+
+        ranked_df = rank_decorr(
+            part_req_df,
+            corr_df,
+            score="total_2",
+            name="instr_id",
+            out="total_3",
+            power=self.power,
+            n_select=agent.top_thres,
+        )
+        self.ranked_df = ranked_df
+        ranked_df = ranked_df[ranked_df["order"].notnull()].sort_values(by=["order"])
+        return ranked_df.drop(columns=["Dif", dif_power_name(self.power), "order"])
@@ -0,0 +1,80 @@
+import datetime
+import os
+import shutil
+
+import pandas as pd
+
+
+class SinkParquet:
+    """
+    Приёмник результатов - parquet. Таблица name прогона run_id хранится папкой частей
+    <path>/<type_instr>/<run_id>/<name>/part_00000.parquet, поэтому может дописываться по периодам
+    и читается целиком через read (или pd.read_parquet папки).
+
+    Attributes:
+        path:    Корневая папка результатов
+        run_id:  Id прогона (по умолчанию - дата и время создания)
+    """
+
+    increm = True  # Поддерживает дописывание по частям
+
+    def __init__(self, path=os.path.join("..", "5. Evaluation"), run_id=None):
+        self.path = path
+        self.run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S") if run_id is None else str(run_id)
+        self.part_dict = {}
+
+    def dir(self, type_instr, name):
+        return os.path.join(self.path, type_instr, self.run_id, name)
+
+    def write(self, type_instr, name, df, replace=False):
+        """
+            Дописывание части таблицы результатов
+
+        Args:
+            type_instr:  Тип инсрумента инвестиций
+            name:        Имя таблицы
+            df:          Строки таблицы
+            replace:     Записать таблицу заново (части прежней записи, в том числе прогона с тем же run_id, удаляются)
+        """
+        dir_path = self.dir(type_instr, name)
+        key = (type_instr, name)
+        if replace:
+            if os.path.isdir(dir_path):
+                shutil.rmtree(dir_path)
+            self.part_dict[key] = 0
+        if df.shape[0] == 0:
+            return
+        os.makedirs(dir_path, exist_ok=True)
+
+        if key not in self.part_dict:
+            self.part_dict[key] = len(os.listdir(dir_path))
+        df.to_parquet(os.path.join(dir_path, "part_%05d.parquet" % self.part_dict[key]), index=False)
+        self.part_dict[key] += 1
+
+    def read(self, type_instr, name):
+        return pd.read_parquet(self.dir(type_instr, name))
+
+
+class SinkExcel:
+    """
+    Приёмник результатов - Excel (только экспорт целиком в конце прогона): <path>/<type_instr>/<run_id>/<name>.xlsx
+
+    Attributes:
+        path:    Корневая папка результатов
+        run_id:  Id прогона (None - файлы прямо в папке type_instr, как раньше)
+    """
+
+    increm = False
+
+    def __init__(self, path=os.path.join("..", "5. Evaluation"), run_id=None):
+        self.path = path
+        self.run_id = run_id
+
+    def write(self, type_instr, name, df, replace=True):
+        # Таблица всегда записывается целиком
+        dir_path = os.path.join(self.path, type_instr)
+        if self.run_id is not None:
+            dir_path = os.path.join(dir_path, str(self.run_id))
+        os.makedirs(dir_path, exist_ok=True)
+        with pd.ExcelWriter(os.path.join(dir_path, name + ".xlsx")) as writer:
+            df.to_excel(writer, sheet_name="Данные")
@@ -0,0 +1,104 @@
+import copy
+
+from modeling.stream import StreamEnvironment
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+# Атрибуты агента, общие для всех ветвей (кэши статистик по датам и доходностей на горизонт - для всех прогонов)
+AGENT_SHARED_NAMES = ["param_cache", "profit_cache"]
+
+
+def copy_state(envir, agent=None):
+    """
+        Копия состояния среды и агента: деньги, портфель, дата, данные периода, состояние оценок и
+        подключённых расчётов, история агента. Матрицы цен и справочник (Environment.SHARED_NAMES),
+        замер (probe) и кэши агента (AGENT_SHARED_NAMES) не копируются, а остаются общими; история агента
+        копируется без копирования накопленных строк (HistRecorder.__deepcopy__).
+        Superviser к копии не подключается.
+
+    Args:
+        envir:  Среда
+        agent:  Агент среды (None - envir.agent, если есть)
+
+    Returns:
+        envir, agent: Копии (agent - None, если агента нет)
+    """
+    if isinstance(envir, StreamEnvironment):
+        raise Exc("Stream environment can not be copied: its bar iterator is consumed once")
+    agent = getattr(envir, "agent", None) if agent is None else agent
+
+    memo = {}
+    for name in envir.SHARED_NAMES + ["probe"]:
+        if name in envir.__dict__:
+            memo[id(envir.__dict__[name])] = envir.__dict__[name]
+    if agent is not None:
+        for name in AGENT_SHARED_NAMES:
+            if name in agent.__dict__:
+                memo[id(agent.__dict__[name])] = agent.__dict__[name]
+
+    # Superviser и его приёмник результатов остаются только у оригинала
+    suvis_dict = {}
+    for obj in [envir, agent]:
+        if (obj is not None) and ("suvis" in obj.__dict__):
+            suvis_dict[id(obj)] = obj.__dict__.pop("suvis")
+    try:
+        envir_copy, agent_copy = copy.deepcopy((envir, agent), memo)
+    finally:
+        for obj in [envir, agent]:
+            if (obj is not None) and (id(obj) in suvis_dict):
+                obj.suvis = suvis_dict[id(obj)]
+
+    return envir_copy, agent_copy
+
+
+class Snapshot:
+    """
+    Снимок состояния моделирования (среда + агент) на дату периода. Из снимка можно восстановить
+    сколько угодно независимых ветвей: каждая продолжает моделирование с даты снимка и тратит время
+    и память только на свои периоды. Большие данные (матрицы цен, справочник) у всех ветвей общие.
+
+    Attributes:
+        date:   Дата снимка
+        envir:  Замороженная копия среды
+        agent:  Замороженная копия агента
+
+    Example:
+        agent.new_period()
+        while envir.date < date_fork and envir.new_period():
+            agent.new_period()
+        snap = Snapshot(envir, agent)
+        for top_thres in [3, 5, 8]:
+            envir_branch, agent_branch = snap.restore()
+            agent_branch.top_thres = top_thres
+            while envir_branch.new_period():
+                agent_branch.new_period()
+    """
+
+    def __init__(self, envir, agent=None):
+        self.date = envir.date
+        self.envir, self.agent = copy_state(envir, agent)
+
+    def restore(self):
+        """
+            Новая ветвь моделирования с состоянием снимка (снимок не меняется)
+
+        Returns:
+            envir, agent
+        """
+        return copy_state(self.envir, self.agent)
+
+    def fork(self, n):
+        """
+            n независимых ветвей
+
+        Returns:
+            list: [(envir, agent), ...]
+        """
+        return [self.restore() for _ in range(n)]
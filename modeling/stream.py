@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+
+from modeling.environment import Environment
+from modeling.rebalance import RebalPeriod
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class StreamEnvironment(Environment):
+    """
+    Потоковая окружающая среда: цены поступают барами (1 торговый день) из итератора, состояние обновляется
+    за время, не зависящее от длины истории. Хранится только окно последних hist_days + 1 дней истории
+    каждого инструмента (кольцевой буфер), новый период (ребалансировка) наступает по правилу rebal.
+    Агент работает с ней так же, как с Environment (только calc_mode='batch').
+
+    Attributes:
+        bars:         Итератор баров (date, price_arr) - цены торгового дня в порядке строк spr_df (nan - нет цены)
+        hist_days:    Глубина хранимой истории инструмента в днях (не меньше 2 * (min_hist_days + min_rent_days) агента)
+        rebal:        Правило ребалансировки (modeling.rebalance)
+        engines:      Расчёты, обновляемые по барам (например, covariance.EwmCov)
+        n_bar:        Количество обработанных баров
+        _bar_next:    Прочитанный, но ещё не обработанный бар (дата больше date_finish)
+        _pack_price:  Кольцевой буфер цен: день истории k инструмента - строка k % (hist_days + 1)
+        _pack_day:    Кольцевой буфер дней (с 1970-01-01)
+
+    Example:
+        envir_stream = StreamEnvironment(envir.type_instr, envir._spr_df, envir.bars(), date_start, cash_start, date_finish,
+                                         rebal=RebalAny(RebalPeriod('monthly'), RebalDrift(0.05)))
+    """
+
+    def __init__(
+        self,
+        type_instr,
+        spr_df,
+        bars,
+        date_start=None,
+        cash_start=1_000_000,
+        date_finish=None,
+        hist_days=2 * (248 + 248),
+        rebal=None,
+        engines=(),
+    ):
+        self.type_instr = type_instr
+        self._spr_df = spr_df
+        self.price_store = None
+        self._price_hist_df = None
+        self.build_spr()
+
+        self.bars = iter(bars)
+        self.hist_days = hist_days
+        self.rebal = RebalPeriod() if rebal is None else rebal
+        self.n_bar = 0
+        self._bar_next = None
+
+        n_instr = len(self._instr_ids)
+        self._pack_price = np.full((hist_days + 1, n_instr), np.nan)
+        self._pack_day = np.zeros((hist_days + 1, n_instr), dtype=np.int32)
+        self.hist_cnt = np.zeros(n_instr, dtype=np.int32)
+        self.instr_mask = np.zeros(n_instr, dtype=bool)
+        self.price_arr = np.full(n_instr, np.nan)
+        self.date = None
+        self.date_min = None
+        self.date_max = None
+
+        # Расчёты подключаются до прогрева, чтобы учесть и бары прогрева
+        self.engines = list(engines)
+        for engine in self.engines:
+            engine.start(self)
+
+        self.start(date_start=date_start, date_finish=date_finish, cash_start=cash_start)
+
+    def start(self, date_start=None, date_finish=None, cash_start=1_000_000):
+        """
+            Прогрев истории барами до date_start включительно и установка начального состояния.
+            Поток читается 1 раз, поэтому повторный запуск невозможен.
+
+        Args:
+            date_start:   Дата стартовая (None - первый бар)
+            date_finish:  Дата последнего бара (None - до конца потока)
+            cash_start:   Денежные средства стартовые
+        """
+        if self.n_bar > 0:
+            raise Exc("Stream environment can not be restarted")
+
+        # Прогрев: бары до даты старта только пополняют историю
+        while self.next_bar(date_start):
+            if date_start is None:
+                break
+        if self.n_bar == 0:
+            raise Exc("There are no bars before date_start " + str(date_start))
+
+        self.date_start = self.date
+        self.date_finish = date_finish
+        self.cash_start = cash_start
+        self.cash = self.cash_start
+
+        self._quantity = np.zeros(len(self._instr_ids))
+        self._port_codes = []
+        self._port_mask = np.zeros(len(self._instr_ids), dtype=bool)
+
+        self.calc_data()
+        self.rebal.reset(self)
+
+    def next_bar(self, date_limit=None):
+        """
+            Обработка следующего бара потока
+
+        Args:
+            date_limit:  Бар с датой больше date_limit не обрабатывается и остаётся следующим
+
+        Returns:
+            True: Если бар обработан
+            False: Если поток закончился или дата бара больше date_limit
+        """
+        bar = self._bar_next if self._bar_next is not None else next(self.bars, None)
+        self._bar_next = None
+        if bar is None:
+            return False
+
+        date, price_row = bar
+        date = pd.Timestamp(date)
+        if (date_limit is not None) and (date > date_limit):
+            self._bar_next = bar
+            return False
+
+        code_arr = np.flatnonzero(~np.isnan(price_row))
+        row_arr = self.hist_cnt[code_arr] % len(self._pack_price)
+        self._pack_price[row_arr, code_arr] = price_row[code_arr]
+        self._pack_day[row_arr, code_arr] = np.datetime64(date, "D").astype(np.int32)
+        self.hist_cnt[code_arr] += 1
+        self.price_arr[code_arr] = price_row[code_arr]
+        self.instr_mask[code_arr] = True
+
+        self.probe.count("bar", len(code_arr))
+        for engine in self.engines:
+            engine.push(date, price_row)
+
+        self.date = date
+        if self.date_min is None:
+            self.date_min = date
+        self.date_max = date
+        self.n_bar += 1
+
+        return True
+
+    def new_period(self):
+        """
+            Обработка баров до наступления ребалансировки
+
+        Returns:
+            True: Если наступила ребалансировка
+            False: Если поток закончился или достигнута date_finish
+        """
+        while self.next_bar(self.date_finish):
+            if self.rebal.due(self):
+                self.calc_data()
+                self.rebal.reset(self)
+                return True
+        return False
+
+    def calc_data(self):
+        """
+            Данные для агента на дату ребалансировки (состояние цен уже обновлено барами)
+        """
+        agent = getattr(self, "agent", None)
+        if (agent is not None) and (agent.calc_mode != "batch"):
+            raise Exc("Stream environment supports only calc_mode 'batch', not " + str(agent.calc_mode))
+        # Окно истории агента глубже кольцевого буфера - индексы ewm_batch ушли бы по кругу на чужие строки
+        if (agent is not None) and (2 * (agent.min_hist_days + agent.min_rent_days) > self.hist_days):
+            raise Exc(
+                "Agent history window " + str(2 * (agent.min_hist_days + agent.min_rent_days))
+                + " is more than hist_days " + str(self.hist_days) + " of stream environment"
+            )
+
+        with self.probe.phase("calc_data") as phase:
+            self.price_df = pd.DataFrame(
+                {"instr_id": self._instr_ids[self.instr_mask], "price": self.price_arr[self.instr_mask]}
+            )
+            self.spr_df = self._spr_df[self.instr_mask]
+            phase.rows = len(self.price_df)
+
+        self.update_engines()
+
+        return True
+
+    @property
+    def price_hist_df(self):
+        raise Exc("Stream environment does not keep the price history")
+
+    def mat_dict(self):
+        raise Exc("Stream environment has no price matrices")
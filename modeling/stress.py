@@ -0,0 +1,310 @@
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import BDay
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def block_bootstrap(pool_mat, n_path, n_days, block=21, rng=None):
+    """
+        Пути дневных ln доходностей блочным бутстрепом: случайные блоки по block подряд идущих дней
+        истории (строки пула целиком - корреляция инструментов сохраняется), по кругу. block=1 - обычный бутстреп.
+
+    Args:
+        pool_mat:  ln доходности истории день x инструмент
+        n_path:    Количество путей
+        n_days:    Длина пути в днях
+        block:     Длина блока в днях
+
+    Returns:
+        ndarray: n_path x n_days x инструмент
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n_block = -(-n_days // block)
+    start_mat = rng.integers(0, len(pool_mat), size=(n_path, n_block))
+    row_mat = (start_mat[:, :, None] + np.arange(block)).reshape(n_path, -1)[:, :n_days] % len(pool_mat)
+    return pool_mat[row_mat]
+
+
+class Stress:
+    """
+    Стресс-тест стратегии агента на множестве путей цен, полученных бутстрепом из загруженной истории.
+    Логика calc_param/chang_port (оценка доходности и волатильности с весами 0.5**(дней назад/365), total_1,
+    total_2, отбор выше min_thres и топ top_thres, доли пропорционально total_2, надбавка и скидка при
+    покупке/продаже) выполняется сразу для всех путей операциями над массивами путь x инструмент.
+
+    Отличия от Agent.action (упрощения модели):
+        - календарь - общие торговые дни среды (цены без торгов переносятся с прошлого дня), в будущем - рабочие дни;
+        - при ребалансировке портфель приводится к требуемым долям целиком: отбор выгодных пар продажа/покупка
+          и минимальная сумма покупки не моделируются;
+        - инструменты - только те, что агент рассматривает на дату среды (достаточная история).
+
+    Attributes:
+        envir:        Среда (история - матрица цен до её текущей даты)
+        agent:        Агент (параметры стратегии)
+        n_path:       Количество путей
+        n_days:       Длина пути в рабочих днях
+        block:        Длина блока бутстрепа в днях
+        period_days:  Период ребалансировки в рабочих днях
+        pool_days:    Глубина истории для бутстрепа в днях (None - вся история до даты среды)
+        cash_start:   Денежные средства стартовые
+        seed:         Начальное значение генератора
+        mem_mb:       Ограничение памяти на 1 группу путей
+        code_arr:     Номера инструментов (столбцов матриц цен среды)
+        result_df:    Результат последнего run
+
+    Example:
+        stress = Stress(envir, agent, n_path=5000, n_days=2 * 248, block=21, seed=1)
+        result_df = stress.run()
+        stress.summary()
+    """
+
+    def __init__(
+        self,
+        envir,
+        agent,
+        n_path=1000,
+        n_days=2 * 248,
+        block=21,
+        period_days=21,
+        pool_days=None,
+        cash_start=None,
+        seed=None,
+        mem_mb=256,
+    ):
+        if not hasattr(envir, "_price_mat"):
+            raise Exc("Stress test needs the price matrix of Environment")
+        self.envir = envir
+        self.agent = agent
+        self.n_path = n_path
+        self.n_days = n_days
+        self.block = block
+        self.period_days = period_days
+        self.pool_days = pool_days
+        self.cash_start = envir.cash_start if cash_start is None else cash_start
+        self.seed = seed
+        self.mem_mb = mem_mb
+        self.result_df = None
+        self.prepare()
+
+    def prepare(self):
+        """
+            Инструменты, история для оценки на старте (последние hist_days + 1 дней) и пул доходностей для бутстрепа
+        """
+        envir, agent = self.envir, self.agent
+        self.hist_days = 2 * (agent.min_hist_days + agent.min_rent_days)
+
+        self.code_arr = np.flatnonzero(
+            envir.instr_mask & (envir.hist_cnt >= (agent.min_hist_days + agent.min_rent_days))
+        )
+        if len(self.code_arr) == 0:
+            raise Exc("There are no instr with enough history at " + str(envir.date))
+
+        cut = envir._date_cut
+        price_mat = pd.DataFrame(envir._price_mat[:cut, self.code_arr]).ffill().values
+        ln_price_mat = np.log(price_mat)
+
+        # История на старте: строк меньше hist_days + 1 - недостающие в начале без цены
+        self.ln_price_prefix = np.full((self.hist_days + 1, len(self.code_arr)), np.nan)
+        rows = min(cut, self.hist_days + 1)
+        self.ln_price_prefix[-rows:] = ln_price_mat[cut - rows :]
+        day_arr = envir._dates[:cut].astype("datetime64[D]").astype(np.int64)
+        self.day_prefix = np.full(self.hist_days + 1, day_arr[0] - (self.hist_days + 1 - rows), dtype=np.int64)
+        self.day_prefix[-rows:] = day_arr[cut - rows :]
+
+        # Дни пути - рабочие дни после даты среды
+        date_future_arr = pd.bdate_range(start=pd.Timestamp(envir._dates[cut - 1]) + BDay(1), periods=self.n_days)
+        day_future_arr = date_future_arr.values.astype("datetime64[D]").astype(np.int64)
+        self.day_arr = np.concatenate([self.day_prefix, day_future_arr])
+
+        # Пул - дни, когда известны доходности всех инструментов
+        pool_mat = np.diff(ln_price_mat, axis=0)
+        if self.pool_days is not None:
+            pool_mat = pool_mat[-self.pool_days :]
+        self.pool_mat = pool_mat[np.isfinite(pool_mat).all(axis=1)]
+        if len(self.pool_mat) == 0:
+            raise Exc("There are no days with prices of all instr for bootstrap")
+
+        registry = envir.registry
+        self.fee_arr = registry.fee[self.code_arr]
+        self.surcharge_arr = registry.surcharge[self.code_arr]
+        self.discount_arr = registry.discount[self.code_arr]
+
+        return True
+
+    def stat(self, ln_price_mat):
+        """
+            Средняя доходность и волатильность на датах ребалансировки для всех путей сразу
+            (те же формулы, что ewm_batch: окно hist_days дней, доходность за horizon_days).
+            Суммы по окну - разности накопленных сумм, вес дня 0.5**(-день/365) выносится за сумму.
+
+        Args:
+            ln_price_mat:  ln цены путь x день x инструмент
+
+        Returns:
+            profit_mean, profit_std: путь x ребалансировка x инструмент
+        """
+        horizon = self.agent.horizon_days
+        half_life = 365
+
+        ln_profit_mat = ln_price_mat[:, horizon:] - ln_price_mat[:, :-horizon]
+        valid_mat = ~np.isnan(ln_profit_mat)
+        ln_profit_mat = np.where(valid_mat, ln_profit_mat, 0.0)
+        weight_arr = 0.5 ** (-(self.day_arr[: ln_profit_mat.shape[1]] - self.day_arr[0]) / half_life)
+        weight_mat = valid_mat * weight_arr[None, :, None]
+
+        def cum(mat):
+            return np.concatenate([np.zeros_like(mat[:, :1]), np.cumsum(mat, axis=1)], axis=1)
+
+        # Окно ребалансировки на день e: строки доходностей [e - hist_days, e - horizon]
+        e_arr = self.rebal_rows()
+        a_arr = e_arr - self.hist_days
+        b_arr = e_arr - horizon + 1
+
+        s0 = cum(weight_mat)
+        s0 = s0[:, b_arr] - s0[:, a_arr]
+        s1 = cum(weight_mat * ln_profit_mat)
+        s1 = s1[:, b_arr] - s1[:, a_arr]
+        s2 = cum(weight_mat * ln_profit_mat ** 2)
+        s2 = s2[:, b_arr] - s2[:, a_arr]
+        c0 = cum(valid_mat.astype(float))
+        c0 = c0[:, b_arr] - c0[:, a_arr]
+        c1 = cum(ln_profit_mat)
+        c1 = c1[:, b_arr] - c1[:, a_arr]
+
+        fill_mat = c0 > 0
+        s0 = np.where(fill_mat, s0, 1.0)
+        ln_gmean = c1 / np.maximum(c0, 1)
+        ln_mean = s1 / s0
+        ln_var = s2 / s0 - 2 * ln_gmean * ln_mean + ln_gmean ** 2
+
+        profit_mean = np.where(fill_mat, np.exp(ln_mean), 1.0)
+        profit_std = np.where(fill_mat, np.exp(np.maximum(ln_var, 0.0) ** 0.5), 1.0)
+        return profit_mean, profit_std
+
+    def rebal_rows(self):
+        # Строки дней ребалансировки: старт (последний день истории) и далее каждые period_days дней
+        return np.arange(self.hist_days, self.hist_days + self.n_days + 1, self.period_days)
+
+    def simulate(self, ln_profit_path):
+        """
+            Стратегия агента на путях
+
+        Args:
+            ln_profit_path:  Дневные ln доходности путь x день x инструмент (n_days дней после даты среды)
+
+        Returns:
+            ndarray: Стоимость (деньги + приведённая стоимость портфеля) путь x день, с даты среды
+        """
+        agent = self.agent
+        n_path, n_instr = ln_profit_path.shape[0], ln_profit_path.shape[2]
+
+        ln_price_mat = np.empty((n_path, self.hist_days + 1 + self.n_days, n_instr))
+        ln_price_mat[:, : self.hist_days + 1] = self.ln_price_prefix
+        ln_price_mat[:, self.hist_days + 1 :] = self.ln_price_prefix[-1] + np.cumsum(ln_profit_path, axis=1)
+
+        profit_mean, profit_std = self.stat(ln_price_mat)
+        # Поправка на вознаграждения управляющих, total_1, total_2 - как в Agent.calc_param_batch
+        total_1 = profit_mean * (1 - self.fee_arr) / (1 + self.surcharge_arr) * (1 - self.discount_arr)
+        total_2 = total_1 / (profit_std ** agent.pow_st_dev)
+
+        cash_arr = np.full(n_path, float(self.cash_start))
+        quantity_mat = np.zeros((n_path, n_instr))
+        value_mat = np.empty((n_path, self.n_days + 1))
+
+        e_arr = self.rebal_rows()
+        for index, e in enumerate(e_arr):
+            price_mat = np.exp(ln_price_mat[:, e])
+
+            # Отбор: выше порога, топ top_thres по total_2; доли пропорционально total_2
+            total_2_mat = np.where(total_2[:, index] > agent.min_thres, total_2[:, index], -np.inf)
+            rank_mat = np.argsort(np.argsort(-total_2_mat, axis=1, kind="stable"), axis=1, kind="stable")
+            select_mat = (rank_mat < agent.top_thres) & np.isfinite(total_2_mat)
+            part_req_mat = np.where(select_mat, total_2_mat, 0.0)
+            part_sum_arr = part_req_mat.sum(axis=1, keepdims=True)
+            trade_arr = part_sum_arr[:, 0] > 0
+            part_req_mat = np.divide(
+                part_req_mat, part_sum_arr, out=np.zeros_like(part_req_mat), where=part_sum_arr > 0
+            )
+
+            # Первичная закупка на все деньги
+            buy_arr = trade_arr & (cash_arr > 0)
+            quantity_mat[buy_arr] = (
+                part_req_mat[buy_arr] * cash_arr[buy_arr, None] / (price_mat[buy_arr] * (1 + self.surcharge_arr))
+            )
+            cash_arr[buy_arr] = 0.0
+
+            # Смена долей: продажа по цене со скидкой, покупка на вырученное по цене с надбавкой
+            chang_arr = trade_arr & ~buy_arr
+            value_instr_mat = quantity_mat[chang_arr] * price_mat[chang_arr] * (1 - self.discount_arr)
+            value_sum_arr = value_instr_mat.sum(axis=1, keepdims=True)
+            part_curr_mat = np.divide(
+                value_instr_mat, value_sum_arr, out=np.zeros_like(value_instr_mat), where=value_sum_arr > 0
+            )
+            value_sell_mat = np.maximum(part_curr_mat - part_req_mat[chang_arr], 0.0) * value_sum_arr
+            value_buy_mat = np.maximum(part_req_mat[chang_arr] - part_curr_mat, 0.0) * value_sum_arr
+            quantity_mat[chang_arr] += (
+                value_buy_mat / (price_mat[chang_arr] * (1 + self.surcharge_arr))
+                - value_sell_mat / (price_mat[chang_arr] * (1 - self.discount_arr))
+            )
+
+            # Стоимость по дням до следующей ребалансировки
+            e_next = e_arr[index + 1] if index + 1 < len(e_arr) else self.hist_days + self.n_days + 1
+            col_from, col_to = e - self.hist_days, min(e_next, self.hist_days + self.n_days + 1) - self.hist_days
+            value_mat[:, col_from:col_to] = cash_arr[:, None] + np.einsum(
+                "pk,ptk->pt",
+                quantity_mat * (1 - self.discount_arr),
+                np.exp(ln_price_mat[:, e : col_to + self.hist_days]),
+            )
+
+        return value_mat
+
+    def run(self):
+        """
+            Стресс-тест на n_path путях (группами путей в пределах mem_mb)
+
+        Returns:
+            DataFrame: По путям - value_finish (итоговая стоимость), profit (к стартовой), max_drawdown
+        """
+        rng = np.random.default_rng(self.seed)
+        n_instr = len(self.code_arr)
+        # Около 10 массивов путь x день x инструмент одновременно
+        chunk = max(1, self.mem_mb * 1024 ** 2 // ((self.hist_days + 1 + self.n_days) * n_instr * 8 * 10))
+
+        value_finish_list, drawdown_list = [], []
+        for start in range(0, self.n_path, chunk):
+            n = min(chunk, self.n_path - start)
+            value_mat = self.simulate(block_bootstrap(self.pool_mat, n, self.n_days, self.block, rng))
+            value_finish_list.append(value_mat[:, -1])
+            drawdown_list.append(1 - (value_mat / np.maximum.accumulate(value_mat, axis=1)).min(axis=1))
+
+        value_finish_arr = np.concatenate(value_finish_list)
+        self.result_df = pd.DataFrame(
+            {
+                "path": np.arange(self.n_path),
+                "value_finish": value_finish_arr,
+                "profit": value_finish_arr / self.cash_start,
+                "max_drawdown": np.concatenate(drawdown_list),
+            }
+        )
+        return self.result_df
+
+    def summary(self, quantiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)):
+        """
+            Распределение итоговой стоимости и просадки по путям
+
+        Returns:
+            DataFrame: Квантили value_finish, profit, max_drawdown и среднее
+        """
+        if self.result_df is None:
+            self.run()
+        result_df = self.result_df[["value_finish", "profit", "max_drawdown"]]
+        summary_df = result_df.quantile(list(quantiles))
+        summary_df.loc["mean"] = result_df.mean()
+        return summary_df
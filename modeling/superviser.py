@@ -1,8 +1,13 @@
+import numpy as np
 import pandas as pd
 from pandas.tseries.offsets import *
 from os import listdir
 from os.path import isfile, join
 
+from modeling.sink import SinkParquet
+from modeling.probe import Probe
+from modeling.analytics import Analytics
+
 class Exc(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -16,18 +21,33 @@ class Superviser:
     Attributes:
 
         type_instr:    Тип инстурмента инвестиций
+        sink:          Приёмник результатов (modeling.sink), по умолчанию parquet
+        increm:        Дописывать историю в приёмник каждый период, а не только по окончании
+        hist_written:  Количество строк истории, уже записанных в приёмник, по имени таблицы
+        hist_gen:      Поколение истории агента (HistRecorder.generation), записанной в приёмник, по имени таблицы
+        probe:         Замеры хода моделирования (modeling.probe), общие для среды и агента
     """
     
     envir = None       # Окружающая среда
     agent = None       # Агент
+
+    # Сохраняемые истории агента: имя таблицы результатов -> накопитель истории агента
+    HIST_NAMES = {'price_hist': 'price_hist', 'port_hist': 'port_hist', 'port_data_hist': 'port_data_hist',
+                  'param_hist': 'param_hist', 'port_req_hist': 'part_req_hist'}
     
-    def __init__(self, envir, agent, type_instr):
+    def __init__(self, envir, agent, type_instr, sink = None, increm = False, probe = None):
         
         self.envir = envir
         self.agent = agent
         self.envir.suvis = self
         self.agent.suvis = self
         self.type_instr = type_instr
+        self.sink = SinkParquet() if sink is None else sink
+        self.increm = increm and self.sink.increm
+        self.hist_written = {}
+        self.hist_gen = {}
+        self.probe = Probe(enabled = False) if probe is None else probe
+        self.envir.probe = self.probe
 
     def show_port(self):
         """
@@ -46,16 +66,22 @@ class Superviser:
         Raises:
         """
 
-        port_temp_df = pd.merge (self.envir.port_df, self.envir.spr_df, on = ['instr_id'])
-        port_temp_df = pd.merge (port_temp_df, self.envir.price_df, on = ['instr_id'])
-        port_temp_df['value_instr'] = port_temp_df['quantity'] * port_temp_df['price']
-        port_temp_df['value_instr'] = port_temp_df['value_instr'].astype(int)
-        port_temp_df['value'] = port_temp_df['quantity'] * port_temp_df['price'] * (1-port_temp_df['discount'])
+        registry = self.envir.registry
+        code_arr = self.port_codes()
+        port_temp_df = pd.DataFrame({'instr_id': registry.instr_ids[code_arr], 'manager': registry.manager[code_arr], 'instr': registry.instr[code_arr]})
+        value_instr_arr = self.envir._quantity[code_arr] * self.envir.price_arr[code_arr]
+        port_temp_df['value_instr'] = value_instr_arr.astype(int)
+        port_temp_df['value'] = value_instr_arr * (1 - registry.discount[code_arr])
         port_temp_df['part'] = port_temp_df['value']/(port_temp_df['value'].sum())
-        port_temp_df = port_temp_df[['instr_id', 'manager', 'instr', 'value_instr', 'value', 'part']]
         return port_temp_df
 
 
+    def port_codes(self):
+        # Коды инструментов портфеля, по которым есть цена на дату среды
+        code_arr = np.array(self.envir._port_codes, dtype = int)
+        return code_arr[self.envir.instr_mask[code_arr]]
+
+
     def convert_xlsx(self, path):
         files = [f for f in listdir(path) if isfile(join(path, f))]
 
@@ -80,43 +106,76 @@ class Superviser:
         Raises:
         """
 
-        port_temp_df = pd.merge (self.envir.port_df, self.envir.spr_df, on = ['instr_id'])
-        port_temp_df = pd.merge (port_temp_df, self.envir.price_df, on = ['instr_id'])
-        port_temp_df['value'] = port_temp_df['quantity'] * port_temp_df['price'] * (1-port_temp_df['discount'])
-        return port_temp_df['value'].sum()
+        code_arr = self.port_codes()
+        return (self.envir._quantity[code_arr] * self.envir.price_arr[code_arr] * (1 - self.envir.registry.discount[code_arr])).sum()
+
+
+    def show_metrics(self, rate_free = 0.0, daily = False):
+        """
+            Показатели эффективности прогона по истории агента (modeling.analytics).
+
+        Args:
+            rate_free:  Безрисковая ставка годовая
+            daily:      Добавить просадку по дневной оценке стоимости (max_drawdown_daily)
+
+        Returns:
+            Series: date_start, date_finish, equity_start, equity_finish, cagr, volatility, sharpe,
+                max_drawdown, turnover, cost, cost_drag
+        """
+
+        analytics = Analytics.from_agents([self.agent], rate_free = rate_free)
+        if daily:
+            analytics.nav(self.envir)
+        return analytics.metrics().iloc[0]
 
     def action(self):
         self.envir.start()
         self.agent.start()
+        self.hist_written = {}
+        self.hist_gen = {}
+        self.probe.clear()
         
         self.agent.action()
 
 
+    def action_period(self):
+        """
+            Дописывание в приёмник истории, накопленной агентом за период (если задан increm)
+        """
+        if self.increm:
+            self.write_hist()
+
+
     def action_finish(self):
+        """
+            Сохранение истории цен, портфеля, полных данных портфеля с долями, параметров и требуемых долей портфеля
+        """
+        self.write_hist()
+
+
+    def write_hist(self):
+        for name, hist_name in self.HIST_NAMES.items():
+            hist = getattr(self.agent, hist_name)
+            # Приёмник без дописывания перезаписывает таблицу целиком
+            start = self.hist_written.get(name, 0) if self.sink.increm else 0
+            # История агента начата заново (agent.start) - таблица переписывается с начала
+            if self.hist_gen.get(name) != hist.generation:
+                start = 0
+            with self.probe.phase('write_hist') as phase:
+                hist_df = hist.frame(start)
+                self.sink.write(self.type_instr, name, hist_df, replace = (start == 0))
+                phase.rows = len(hist_df)
+            self.hist_written[name] = len(hist)
+            self.hist_gen[name] = hist.generation
+
+
+    def report(self):
+        """
+            Отчёт по замерам хода моделирования после action
 
-        # Сохранение истории цен
-        writer = pd.ExcelWriter('..\\5. Evaluation\\' + self.type_instr + '\\price_hist.xlsx')
-        self.agent.price_hist_df.to_excel(writer, 'Данные')
-        writer.save()
-
-        # Сохранение истории портфеля
-        writer = pd.ExcelWriter('..\\5. Evaluation\\' + self.type_instr + '\\port_hist.xlsx')
-        self.agent.port_hist_df.to_excel(writer, 'Данные')
-        writer.save()
-
-        # Сохранение истории полных данных портфеля с долями
-        writer = pd.ExcelWriter('..\\5. Evaluation\\' + self.type_instr + '\\port_data_hist.xlsx')
-        self.agent.port_data_hist_df.to_excel(writer, 'Данные')
-        writer.save()
-
-        # Сохранение истории параметров            
-        writer = pd.ExcelWriter('..\\5. Evaluation\\' + self.type_instr + '\\param_hist.xlsx')
-        self.agent.param_hist_df.to_excel(writer, 'Данные')
-        writer.save()
-
-        # Сохранение истории требуемых долей портфеля
-        writer = pd.ExcelWriter('..\\5. Evaluation\\' + self.type_instr + '\\port_req_hist.xlsx')
-        self.agent.part_req_hist_df.to_excel(writer, 'Данные')
-        writer.save()
+        Returns:
+            dict: summary - итоги по этапам, period - замеры по периодам (см. Probe.report)
+        """
+        return self.probe.report()
 
         
\ No newline at end of file
@@ -0,0 +1,223 @@
+import csv
+import itertools
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from modeling.agent import Agent
+from modeling.environment import Environment
+
+
+class Exc(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+# Среда и агент процесса-исполнителя (создаются 1 раз при запуске процесса)
+_envir = None
+_agent = None
+_shm_list = []
+
+
+def _init_worker(shm_spec, type_instr, spr_df, cash_start):
+    global _envir, _agent
+
+    mat_dict = {}
+    for name, (shm_name, shape, dtype) in shm_spec.items():
+        # Память принадлежит основному процессу, он же её и освобождает
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shm_list.append(shm)
+        mat = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        mat.flags.writeable = False
+        mat_dict[name] = mat
+
+    _envir = Environment.from_mat(
+        type_instr, spr_df, mat_dict, date_start=pd.Timestamp(mat_dict["_dates"][0]), cash_start=cash_start
+    )
+    _agent = Agent(_envir)
+
+
+def _run_combo(combo, agent_param, cash_start):
+    param = {name: value for name, value in combo.items() if name not in ("key", "date_start", "date_finish")}
+
+    _envir.start(date_start=combo["date_start"], date_finish=combo["date_finish"], cash_start=cash_start)
+    _agent.start(**agent_param, **param)
+    _agent.action(finish=False)
+
+    result = dict(combo)
+    result["port_summ_value"] = _agent.port_summ_value
+    result["cash"] = _envir.cash
+    return result
+
+
+class Sweep:
+    """
+    Параллельный перебор параметров агента по сетке (аналог main_GS) на пуле процессов.
+    Матрицы цен загруженной среды передаются исполнителям через разделяемую память только для чтения.
+    Результаты дописываются в одну таблицу (csv) по мере готовности; при повторном запуске
+    уже посчитанные комбинации пропускаются (недописанная при сбое последняя строка отбрасывается).
+    Ошибка прогона комбинации не прерывает перебор - комбинация попадает в fail_df.
+
+    Attributes:
+        envir:        Окружающая среда с загруженной историей цен
+        grid:         Сетка параметров Agent.start: имя -> список значений
+        windows:      Окна моделирования: список (date_start, date_finish)
+        result_path:  Путь к таблице результатов (csv)
+        n_jobs:       Количество процессов (None - по количеству ядер)
+        agent_param:  Неизменяемые параметры Agent.start
+        cash_start:   Денежные средства стартовые
+        fail_df:      Комбинации, прогон которых завершился ошибкой при последнем запуске (key, error)
+
+    Example:
+        windows = [(pd.to_datetime(str(year) + '-04-01'), pd.to_datetime(str(year + 3) + '-04-01')) for year in range(2009, 2015)]
+        grid = {'min_thres': np.arange(1.10, 1.20, 0.01), 'pow_st_dev': np.arange(0, 0.2, 0.1), 'den_pow': [124, 248, 496]}
+        result_df = Sweep(envir, grid, windows, 'result_grid_search.csv').run()
+    """
+
+    def __init__(self, envir, grid, windows, result_path, n_jobs=None, agent_param=None, cash_start=1_000_000):
+        self.envir = envir
+        self.grid = grid
+        self.windows = windows
+        self.result_path = result_path
+        self.n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+        self.agent_param = {} if agent_param is None else agent_param
+        self.cash_start = cash_start
+        self.fail_df = pd.DataFrame(columns=["key", "error"])
+
+        # Параметр сетки не может быть задан и неизменяемым, а имена окна и ключа заняты
+        both_list = sorted(set(self.grid) & (set(self.agent_param) | {"date_start", "date_finish", "key"}))
+        if len(both_list) > 0:
+            raise Exc("Grid parameters are also set in agent_param or reserved: " + ", ".join(both_list))
+
+    @staticmethod
+    def key(combo):
+        return "|".join(
+            name + "=" + (str(pd.Timestamp(value).date()) if name in ("date_start", "date_finish") else repr(value))
+            for name, value in combo.items()
+        )
+
+    def combos(self):
+        """
+            Все комбинации окон и параметров сетки
+
+        Returns:
+            list: Словари date_start, date_finish, параметры сетки, key
+        """
+        names = list(self.grid.keys())
+        combo_list = []
+        for (date_start, date_finish), values in itertools.product(
+            self.windows, itertools.product(*[self.grid[name] for name in names])
+        ):
+            combo = {"date_start": pd.Timestamp(date_start), "date_finish": pd.Timestamp(date_finish)}
+            for name, value in zip(names, values):
+                combo[name] = value.item() if isinstance(value, np.generic) else value
+            combo["key"] = self.key(combo)
+            combo_list.append(combo)
+        return combo_list
+
+    def fields(self):
+        # Столбцы таблицы результатов - постоянные, не зависят от порядка ключей результата
+        return ["date_start", "date_finish"] + list(self.grid.keys()) + ["key", "port_summ_value", "cash"]
+
+    def repair(self):
+        """
+            Отбрасывание недописанной последней строки таблицы результатов (прерванная запись)
+            и проверка заголовка
+
+        Raises:
+            Exc: Таблица результатов другой сетки (столбцы не совпадают с fields)
+        """
+        if not os.path.isfile(self.result_path):
+            return True
+        with open(self.result_path, "rb+") as file:
+            data = file.read()
+            if (len(data) > 0) and not data.endswith(b"\n"):
+                file.truncate(data.rfind(b"\n") + 1)
+        with open(self.result_path, newline="") as file:
+            header = next(csv.reader(file), None)
+        if header is None:
+            os.remove(self.result_path)
+        elif header != self.fields():
+            raise Exc("Result table " + self.result_path + " has other fields: " + ", ".join(header))
+        return True
+
+    def read(self):
+        # Таблица результатов (строки с ошибками формата пропускаются)
+        self.repair()
+        if not os.path.isfile(self.result_path):
+            return pd.DataFrame(columns=self.fields())
+        result_df = pd.read_csv(self.result_path, on_bad_lines="skip")
+        result_df = result_df[result_df["key"].notna() & result_df["port_summ_value"].notna()]
+        for name in ["date_start", "date_finish"]:
+            result_df[name] = pd.to_datetime(result_df[name])
+        return result_df.reset_index(drop=True)
+
+    def done(self):
+        return set(self.read()["key"])
+
+    def run(self):
+        """
+            Запуск перебора
+
+        Returns:
+            DataFrame: Таблица результатов по всем посчитанным комбинациям
+        """
+        done_set = self.done()
+        combo_list = [combo for combo in self.combos() if combo["key"] not in done_set]
+        fail_list = []
+
+        if len(combo_list) > 0:
+            shm_dict = {}
+            try:
+                # Размещение матриц цен в разделяемой памяти
+                shm_spec = {}
+                for name, mat in self.envir.mat_dict().items():
+                    mat = np.ascontiguousarray(mat)
+                    shm = shared_memory.SharedMemory(create=True, size=max(mat.nbytes, 1))
+                    shm_dict[name] = shm
+                    np.ndarray(mat.shape, dtype=mat.dtype, buffer=shm.buf)[...] = mat
+                    shm_spec[name] = (shm.name, mat.shape, mat.dtype.str)
+
+                with ProcessPoolExecutor(
+                    max_workers=self.n_jobs,
+                    initializer=_init_worker,
+                    initargs=(shm_spec, self.envir.type_instr, self.envir._spr_df, self.cash_start),
+                ) as pool:
+                    future_dict = {
+                        pool.submit(_run_combo, combo, self.agent_param, self.cash_start): combo
+                        for combo in combo_list
+                    }
+                    for future in as_completed(future_dict):
+                        # Ошибка одной комбинации не прерывает перебор
+                        try:
+                            result = future.result()
+                        except Exception as exc:
+                            fail_list.append({"key": future_dict[future]["key"], "error": repr(exc)})
+                            continue
+                        self.write(result)
+            finally:
+                for shm in shm_dict.values():
+                    shm.close()
+                    shm.unlink()
+
+        self.fail_df = pd.DataFrame(fail_list, columns=["key", "error"])
+        if self.fail_df.shape[0] > 0:
+            warnings.warn("Sweep failed for %d combos: %s" % (len(self.fail_df), "; ".join(self.fail_df["key"])))
+
+        return self.read()
+
+    def write(self, result):
+        # Дописывание строки результата сразу по готовности - прерванный перебор продолжится с этого места
+        is_new = not os.path.isfile(self.result_path)
+        with open(self.result_path, "a", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=self.fields())
+            if is_new:
+                writer.writeheader()
+            writer.writerow(result)
@@ -0,0 +1,71 @@
+import pandas as pd
+
+
+class WalkForward:
+    """
+    Прогон одной стратегии на множестве окон date_start/date_finish (скользящие окна main_GS).
+    Статистики инструментов (средняя доходность, волатильность) считаются 1 раз на каждую дату
+    объединения периодов всех окон, далее окна прогоняются с готовыми статистиками - на окно
+    остаются только расчёт требуемых долей и смена портфеля.
+
+    Attributes:
+        envir:        Окружающая среда
+        agent:        Агент (используется режим calc_mode='batch')
+        windows:      Окна моделирования: список (date_start, date_finish)
+        agent_param:  Параметры Agent.start
+        cash_start:   Денежные средства стартовые
+        param_cache:  Статистики инструментов по датам
+    """
+
+    def __init__(self, envir, agent, windows, agent_param=None, cash_start=1_000_000):
+        self.envir = envir
+        self.agent = agent
+        self.windows = [(pd.Timestamp(date_start), pd.Timestamp(date_finish)) for date_start, date_finish in windows]
+        self.agent_param = {} if agent_param is None else dict(agent_param)
+        self.agent_param["calc_mode"] = "batch"
+        self.cash_start = cash_start
+        self.param_cache = {}
+
+    def period_dates(self):
+        date_set = set()
+        for date_start, date_finish in self.windows:
+            date_set.update(self.envir.period_dates(date_start, date_finish))
+        return sorted(date_set)
+
+    def calc_cache(self):
+        """
+            Расчёт статистик инструментов на все даты периодов всех окон
+        """
+        self.agent.start(**self.agent_param, param_cache=self.param_cache)
+        for date in self.period_dates():
+            self.envir.date = date
+            self.envir.calc_data()
+            self.agent.calc_stat()
+
+        return True
+
+    def run(self):
+        """
+            Прогон всех окон
+
+        Returns:
+            DataFrame: date_start, date_finish, port_summ_value, cash по окнам
+        """
+        self.calc_cache()
+
+        result_list = []
+        for date_start, date_finish in self.windows:
+            self.envir.start(date_start=date_start, date_finish=date_finish, cash_start=self.cash_start)
+            self.agent.start(**self.agent_param, param_cache=self.param_cache)
+            self.agent.action(finish=False)
+
+            result_list.append(
+                {
+                    "date_start": date_start,
+                    "date_finish": date_finish,
+                    "port_summ_value": self.agent.port_summ_value,
+                    "cash": self.envir.cash,
+                }
+            )
+
+        return pd.DataFrame(result_list)
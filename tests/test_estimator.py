@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from modeling.agent import Agent
+from modeling.bench import SourceRandom, make_universe
+from modeling.environment import Environment
+from modeling.estimator import EwmEstimator, ewm_batch
+from modeling.profit_cache import Exc, ProfitCache, profit_table, profit_table_file
+
+TOL = 1e-12
+AGENT_PARAM = {"horizon_days": 20, "min_hist_days": 30, "min_rent_days": 30, "calc_mode": "full"}
+
+
+class SourceGaps(SourceRandom):
+    # Синтетическая история с пропусками: у каждого инструмента выпадает часть торговых дней,
+    # у части оставшихся нет цены (nan close)
+    def fetch(self, instr, start=None, end=None):
+        hist_df = super().fetch(instr, start=start, end=end)
+        rng = np.random.default_rng([self.seed, self.instr_index[instr], 1])
+        hist_df = hist_df[rng.random(len(hist_df)) > 0.1].reset_index(drop=True)
+        hist_df.loc[rng.random(len(hist_df)) < 0.05, ["close", "adj_close"]] = np.nan
+        return hist_df
+
+
+@pytest.fixture(scope="module")
+def envir(tmp_path_factory):
+    data_path = str(tmp_path_factory.mktemp("data"))
+    instr_list = make_universe(data_path, 8)
+    source = SourceGaps(instr_list, 3, seed=7)
+    return Environment(source.dates[0], 1_000_000, "bench", "csv", data_path=data_path, source=source)
+
+
+@pytest.fixture(scope="module")
+def envir_mmap(envir):
+    # Та же история из хранилища, матрицы memmap
+    data_path = os.path.dirname(os.path.dirname(envir.price_store.path))
+    return Environment(envir.date_min, 1_000_000, "bench", "csv", data_path=data_path, offline=True, mmap=True)
+
+
+def check_period(envir, agent, estim):
+    # На дату среды: update и ewm_batch совпадают с preprocess/fit/predict по каждому инструменту с историей
+    hist_days = 2 * (agent.min_hist_days + agent.min_rent_days)
+    code_arr = np.flatnonzero(envir.hist_cnt >= agent.min_hist_days + agent.min_rent_days)
+    mean_batch_arr, std_batch_arr = ewm_batch(
+        envir.hist_cnt[code_arr], envir._pack_price, envir._pack_day, code_arr, agent.horizon_days, hist_days
+    )
+    for code, mean_batch, std_batch in zip(code_arr, mean_batch_arr, std_batch_arr):
+        instr_id = envir._instr_ids[code]
+        mean_full, std_full = agent.calc_param_instr(instr_id)
+        mean_increm, std_increm = estim.update(
+            instr_id, envir.hist_cnt[code], envir._pack_price[:, code], envir._pack_day[:, code]
+        )
+        assert mean_increm == pytest.approx(mean_full, rel=0, abs=TOL)
+        assert std_increm == pytest.approx(std_full, rel=0, abs=TOL)
+        assert mean_batch == pytest.approx(mean_full, rel=0, abs=TOL)
+        assert std_batch == pytest.approx(std_full, rel=0, abs=TOL)
+    return len(code_arr)
+
+
+def run_periods(envir, agent, estim, date_start, date_finish):
+    envir.start(date_start=date_start, date_finish=date_finish)
+    n = check_period(envir, agent, estim)
+    while envir.new_period():
+        n += check_period(envir, agent, estim)
+    return n
+
+
+def test_nan_close_rows_are_dropped(envir):
+    # Строки без цены есть в хранилище, но не в истории среды
+    assert envir.price_store.read(columns=["close"])["close"].isna().any()
+    assert not envir._price_hist_df["price"].isna().any()
+    assert len(envir._price_hist_df) == int(envir._hist_cnt[-1].sum())
+
+
+def test_estimator_matches_predict(envir):
+    agent = Agent(envir)
+    agent.start(**AGENT_PARAM)
+    estim = EwmEstimator(horizon_days=agent.horizon_days, hist_days=2 * (agent.min_hist_days + agent.min_rent_days))
+
+    # Окно 240 дней истории при 3 годах - старые строки выпадают из окна
+    n = run_periods(envir, agent, estim, envir.date_min + pd.DateOffset(months=2), envir.date_max)
+    assert n > 0
+    assert max(state.lo for state in estim.state_dict.values()) > 0
+
+    # Переход назад по датам - состояния оценки считаются заново
+    state_dict = dict(estim.state_dict)
+    date_back = envir.date_min + pd.DateOffset(months=14)
+    n = run_periods(envir, agent, estim, date_back, date_back + pd.DateOffset(months=6))
+    assert n > 0
+    assert all(estim.state_dict[key] is not state for key, state in state_dict.items() if key in estim.state_dict)
+
+
+@pytest.mark.parametrize("horizon_days", [20, 0])
+def test_profit_cache_matches_preprocess(envir, horizon_days):
+    # Срез таблицы доходностей совпадает с непосредственным расчётом (история с пропусками и nan close)
+    param = {**AGENT_PARAM, "horizon_days": horizon_days}
+    agent = Agent(envir)
+    agent.start(**param)
+    agent_cache = Agent(envir)
+    agent_cache.start(**param, profit_cache=ProfitCache())
+
+    envir.start(date_start=envir.date_min + pd.DateOffset(months=20), date_finish=envir.date_max)
+    n = 0
+    for instr_id in envir._instr_ids[envir.instr_mask]:
+        mean_full, std_full = agent.calc_param_instr(instr_id)
+        mean_cache, std_cache = agent_cache.calc_param_instr(instr_id)
+        if mean_full is None:
+            assert mean_cache is None
+            continue
+        assert mean_cache == pytest.approx(mean_full, rel=0, abs=TOL)
+        assert std_cache == pytest.approx(std_full, rel=0, abs=TOL)
+        n += 1
+    assert n > 0
+
+
+def test_profit_cache_mmap(envir, envir_mmap, tmp_path):
+    # Для матриц memmap таблица строится по частям в файл и совпадает с построенной в памяти
+    with pytest.raises(Exc):
+        ProfitCache().get(envir_mmap, 20)
+
+    cache = ProfitCache(path=str(tmp_path))
+    profit_mat = cache.get(envir_mmap, 20)
+    assert isinstance(profit_mat, np.memmap)
+    assert np.array_equal(profit_mat, profit_table(envir._pack_price, 20), equal_nan=True)
+    assert cache.n_calc == 1
+
+    # Повторный запуск - таблица читается с диска; по 1 столбцу - тот же результат
+    cache_load = ProfitCache(path=str(tmp_path))
+    cache_load.get(envir_mmap, 20)
+    assert (cache_load.n_load, cache_load.n_calc) == (1, 0)
+    file = str(tmp_path / "profit_chunk.npy")
+    profit_table_file(envir_mmap._pack_price, 20, file, chunk_mb=0)
+    assert np.array_equal(np.load(file), profit_mat, equal_nan=True)
@@ -0,0 +1,73 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from modeling.ingest import Ingest, Source
+from modeling.price_store import PriceStore
+
+DATE_ACTUAL = pd.Timestamp("2021-03-09")
+
+
+class SourceFlaky(Source):
+    # Инструмент из fail_dict не загружается первые fail_dict[instr] раз (None - никогда)
+    def __init__(self, fail_dict):
+        self.fail_dict = fail_dict
+        self.call_dict = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, instr, start=None, end=None):
+        with self.lock:
+            self.call_dict[instr] = self.call_dict.get(instr, 0) + 1
+            call = self.call_dict[instr]
+        n_fail = self.fail_dict.get(instr, 0)
+        if (n_fail is None) or (call <= n_fail):
+            raise ConnectionError("no connection for " + instr + ", call " + str(call))
+        dates = pd.bdate_range("2021-01-04", DATE_ACTUAL)
+        price_arr = 100 + np.arange(len(dates), dtype=float)
+        return pd.DataFrame({"date": dates, "close": price_arr, "adj_close": price_arr, "volume": 1.0})
+
+
+@pytest.fixture
+def store_factory(tmp_path, monkeypatch):
+    (tmp_path / "stock").mkdir()
+    monkeypatch.setattr(PriceStore, "date_actual", staticmethod(lambda: DATE_ACTUAL))
+
+    def factory(source, retry=3):
+        return PriceStore("stock", data_path=str(tmp_path), ingest=Ingest(source, n_thread=4, retry=retry, backoff=0))
+
+    return factory
+
+
+def test_retry_until_success(store_factory):
+    source = SourceFlaky({"SPY": 2})
+    store = store_factory(source)
+
+    assert store.update(["SPY", "QQQ"])
+    assert source.call_dict == {"SPY": 3, "QQQ": 1}
+    assert store.fail_df.shape[0] == 0
+    store_df = store.read()
+    assert sorted(store_df["instr_id"].unique()) == ["QQQ", "SPY"]
+    assert (store_df.groupby("instr_id").size() == len(pd.bdate_range("2021-01-04", DATE_ACTUAL))).all()
+
+
+def test_always_failing_instr(store_factory):
+    source = SourceFlaky({"DEAD": None})
+    store = store_factory(source, retry=2)
+
+    with pytest.warns(UserWarning, match="DEAD"):
+        assert store.update(["SPY", "DEAD"])
+    assert source.call_dict == {"SPY": 1, "DEAD": 3}
+    fail_df = store.fail_df
+    assert list(fail_df["instr"]) == ["DEAD"]
+    assert fail_df["start"].isna().all()
+    assert list(fail_df["attempts"]) == [3]
+    assert "no connection for DEAD, call 3" in fail_df["error"].iloc[0]
+    # Загрузившиеся инструменты сохранены, неудачный - нет
+    assert list(store.read()["instr_id"].unique()) == ["SPY"]
+
+    # Неудачный инструмент не отмечен загруженным - запрашивается снова, загруженный - нет
+    with pytest.warns(UserWarning, match="DEAD"):
+        assert not store.update(["SPY", "DEAD"])
+    assert source.call_dict == {"SPY": 1, "DEAD": 6}
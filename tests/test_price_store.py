@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from modeling.ingest import Ingest, Source
+from modeling.price_store import PriceStore
+
+
+class SourceLocal(Source):
+    # История по торговым дням до now включительно (now - текущий, ещё не завершённый день),
+    # factor - поправка всех цен задним числом (как после сплита)
+    def __init__(self, now):
+        self.now = pd.Timestamp(now)
+        self.factor = 1.0
+        self.call_list = []
+
+    def fetch(self, instr, start=None, end=None):
+        self.call_list.append((instr, start, end))
+        if instr == "DEAD":
+            dates = pd.bdate_range("2021-01-04", "2021-02-26")
+        else:
+            dates = pd.bdate_range("2021-01-04", self.now)
+        price_arr = (100 + np.arange(len(dates), dtype=float)) * self.factor
+        hist_df = pd.DataFrame({"date": dates, "close": price_arr, "adj_close": price_arr, "volume": 1.0})
+        if start is not None:
+            hist_df = hist_df[hist_df["date"] >= pd.Timestamp(start)]
+        if end is not None:
+            hist_df = hist_df[hist_df["date"] < pd.Timestamp(end)]
+        return hist_df.reset_index(drop=True)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    source = SourceLocal("2021-03-10")
+    store = PriceStore("stock", data_path=str(tmp_path), ingest=Ingest(source, n_thread=2, backoff=0))
+    (tmp_path / "stock").mkdir()
+    monkeypatch.setattr(PriceStore, "date_actual", staticmethod(lambda: source.now - pd.offsets.BDay(1)))
+    return store, source
+
+
+def stored(store, instr):
+    return store.read([instr]).sort_values("date").reset_index(drop=True)
+
+
+def test_partial_bar_is_not_stored(store):
+    store, source = store
+    store.update(["SPY"])
+    assert stored(store, "SPY")["date"].max() == pd.Timestamp("2021-03-09")
+
+
+def test_fetched_instr_is_not_requested_again(store):
+    store, source = store
+    store.update(["SPY", "DEAD"])
+    source.call_list.clear()
+
+    # В тот же день - ни один инструмент (в том числе без новых баров) не запрашивается
+    assert not store.update(["SPY", "DEAD"])
+    assert source.call_list == []
+
+
+def test_new_bars_are_appended_from_last_bar(store):
+    store, source = store
+    store.update(["SPY"])
+    source.call_list.clear()
+
+    source.now = pd.Timestamp("2021-03-15")
+    assert store.update(["SPY"])
+    assert source.call_list == [("SPY", pd.Timestamp("2021-03-09"), pd.Timestamp("2021-03-13"))]
+    hist_df = stored(store, "SPY")
+    assert hist_df["date"].is_unique
+    assert hist_df["date"].max() == pd.Timestamp("2021-03-12")
+    assert np.array_equal(hist_df["close"].values, source.fetch("SPY", end="2021-03-13")["close"].values)
+
+
+def test_changed_history_is_reloaded(store):
+    store, source = store
+    store.update(["SPY"])
+
+    # Источник пересчитал историю задним числом - прежние бары в другой поправке
+    source.now = pd.Timestamp("2021-03-15")
+    source.factor = 0.5
+    source.call_list.clear()
+    assert store.update(["SPY"])
+    assert source.call_list[-1] == ("SPY", None, pd.Timestamp("2021-03-13"))
+    hist_df = stored(store, "SPY")
+    assert np.array_equal(hist_df["close"].values, source.fetch("SPY", end="2021-03-13")["close"].values)